@@ -1,6 +1,8 @@
 from django.contrib import admin
 
-from importer.models import CachedObject, ExternalList
+from importer.models import CachedObject, ExternalList, ImportRun, ImportProgress
 
 admin.site.register(CachedObject)
 admin.site.register(ExternalList)
+admin.site.register(ImportRun)
+admin.site.register(ImportProgress)
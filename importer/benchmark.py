@@ -0,0 +1,419 @@
+"""An offline benchmark of the importer.
+
+`SyntheticOparl` generates a deterministic oparl system of configurable size,
+which `OparlServer` serves from localhost, so the importer runs with its real
+loaders and transport but without depending on a live server.
+`run_benchmark` times the phases of an import and an update into the active
+run report (see `importer.instrumentation`).
+"""
+
+import datetime
+import json
+import logging
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qs, urlencode
+
+from django.db import connection
+from django.test import override_settings
+
+from importer import JSON
+from importer.instrumentation import timer, set_value
+from importer.importer import Importer
+from importer.loader import get_loader_from_system
+from mainapp.models import Body
+
+logger = logging.getLogger(__name__)
+
+vendor_systems = {
+    "plain": {},
+    "sternberg": {"contactName": "STERNBERG Software GmbH & Co. KG"},
+    "cc-egov": {"vendor": "http://cc-egov.de/"},
+}
+
+
+def make_pdf(text: str) -> bytes:
+    """A minimal valid pdf with one page of (ascii) text"""
+    escaped = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    content = b"BT /F1 12 Tf 72 770 Td (" + escaped.encode("ascii") + b") Tj ET"
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R"
+        b" /Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\n" % (len(objects) + 1)
+    pdf += b"startxref\n%d\n%%%%EOF\n" % xref
+    return pdf
+
+
+class SyntheticOparl:
+    """A generated oparl system with embedded objects, paginated lists and
+    the quirks of a vendor.
+
+    The same parameters and seed always give the same data, so benchmark
+    results are comparable across commits."""
+
+    old_date = "2020-01-01T12:00:00+01:00"
+
+    def __init__(
+        self,
+        base_url: str,
+        bodies: int = 1,
+        papers: int = 100,
+        files_per_paper: int = 2,
+        meetings: int = 20,
+        agenda_items_per_meeting: int = 5,
+        persons: int = 30,
+        page_size: int = 50,
+        vendor: str = "plain",
+        seed: int = 0,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.page_size = page_size
+        self.vendor = vendor
+        self.random = random.Random(seed)
+        self.schema = "https://schema.oparl.org/1.0/"
+        if vendor not in vendor_systems:
+            raise ValueError(f"Unknown vendor {vendor}")
+
+        # All objects by id, including the embedded ones
+        self.objects: Dict[str, JSON] = dict()
+        # The ids of the top level objects of each external list
+        self.lists: Dict[str, List[str]] = dict()
+        # The content of the files by access url
+        self.files: Dict[str, bytes] = dict()
+
+        self.system = {
+            "id": self.url("system"),
+            "type": self.schema + "System",
+            "oparlVersion": self.schema,
+            "name": "Synthetic OParl",
+            "body": self.url("bodies"),
+            **vendor_systems[vendor],
+        }
+        self.objects[self.system["id"]] = self.system
+        self.lists[self.system["body"]] = []
+        for body in range(bodies):
+            self.make_body(
+                body,
+                papers,
+                files_per_paper,
+                meetings,
+                agenda_items_per_meeting,
+                persons,
+            )
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}/oparl/{path}"
+
+    def make_object(self, path: str, type_name: str, **data) -> JSON:
+        return {
+            "id": self.url(path),
+            "type": self.schema + type_name,
+            **data,
+            "created": self.old_date,
+            "modified": self.old_date,
+        }
+
+    def add(self, list_url: str, data: JSON) -> None:
+        self.lists[list_url].append(data["id"])
+        self.objects[data["id"]] = data
+        for value in data.values():
+            embedded = value if isinstance(value, list) else [value]
+            for i in embedded:
+                if isinstance(i, dict) and "id" in i:
+                    self.objects[i["id"]] = i
+
+    def make_file(self, body: int, number: int) -> JSON:
+        access_url = self.url(f"body/{body}/file/{number}.pdf")
+        self.files[access_url] = make_pdf(f"Anlage {number} der Stadt {body}")
+        data = self.make_object(
+            f"body/{body}/file/{number}",
+            "File",
+            name=f"Anlage {number}",
+            fileName=f"anlage-{number}.pdf",
+            mimeType="application/pdf",
+            accessUrl=access_url,
+            date="2020-01-01",
+        )
+        if self.vendor == "cc-egov":
+            data["text"] = "N/A"
+        return data
+
+    def make_body(
+        self,
+        body: int,
+        papers: int,
+        files_per_paper: int,
+        meetings: int,
+        agenda_items_per_meeting: int,
+        persons: int,
+    ) -> None:
+        lists = {
+            name: self.url(f"body/{body}/{name}")
+            for name in ["organization", "person", "meeting", "paper"]
+        }
+        for list_url in lists.values():
+            self.lists[list_url] = []
+        ags = f"0{5315000 + body}"
+        if self.vendor == "sternberg":
+            # Sternberg drops the leading zero
+            ags = ags[1:]
+        body_data = self.make_object(
+            f"body/{body}",
+            "Body",
+            system=self.system["id"],
+            name=f"Stadt Synthetisch {body}",
+            shortName=f"Synthetisch {body}",
+            ags=ags,
+            **lists,
+        )
+        self.add(self.system["body"], body_data)
+
+        organizations = []
+        for number in range(max(1, persons // 10)):
+            organization = self.make_object(
+                f"body/{body}/organization/{number}",
+                "Organization",
+                body=body_data["id"],
+                name=f"Ausschuss {number}",
+                organizationType="Gremium",
+                classification="Ausschuss",
+            )
+            self.add(lists["organization"], organization)
+            organizations.append(organization["id"])
+
+        person_ids = []
+        for number in range(persons):
+            person_id = self.url(f"body/{body}/person/{number}")
+            membership = self.make_object(
+                f"body/{body}/membership/{number}",
+                "Membership",
+                person=person_id,
+                organization=self.random.choice(organizations),
+                role="Mitglied",
+            )
+            person = self.make_object(
+                f"body/{body}/person/{number}",
+                "Person",
+                body=body_data["id"],
+                name=f"Vorname{number} Nachname{number}",
+                givenName=f"Vorname{number}",
+                familyName=f"Nachname{number}",
+                membership=[membership],
+            )
+            self.add(lists["person"], person)
+            person_ids.append(person_id)
+
+        file_number = 0
+        agenda_items: List[Tuple[str, str]] = []
+        for number in range(meetings):
+            meeting_id = self.url(f"body/{body}/meeting/{number}")
+            items = []
+            for position in range(agenda_items_per_meeting):
+                item = self.make_object(
+                    f"body/{body}/agendaitem/{number}-{position}",
+                    "AgendaItem",
+                    meeting=meeting_id,
+                    number=str(position + 1),
+                    name=f"Tagesordnungspunkt {position + 1}",
+                    public=True,
+                )
+                items.append(item)
+                agenda_items.append((meeting_id, item["id"]))
+            start = datetime.datetime(2020, 1, 1, 17) + datetime.timedelta(days=number)
+            meeting = self.make_object(
+                f"body/{body}/meeting/{number}",
+                "Meeting",
+                name=f"Sitzung {number}",
+                start=start.isoformat() + "+01:00",
+                end=(start + datetime.timedelta(hours=2)).isoformat() + "+01:00",
+                organization=[self.random.choice(organizations)],
+                invitation=self.make_file(body, file_number),
+                agendaItem=items,
+            )
+            file_number += 1
+            self.add(lists["meeting"], meeting)
+
+        for number in range(papers):
+            paper_id = self.url(f"body/{body}/paper/{number}")
+            files = [
+                self.make_file(body, file_number + i) for i in range(files_per_paper)
+            ]
+            file_number += files_per_paper
+            consultations = []
+            if agenda_items:
+                meeting_id, item_id = self.random.choice(agenda_items)
+                consultations.append(
+                    self.make_object(
+                        f"body/{body}/consultation/{number}",
+                        "Consultation",
+                        paper=paper_id,
+                        meeting=meeting_id,
+                        agendaItem=item_id,
+                        role="Beratung",
+                    )
+                )
+            paper = self.make_object(
+                f"body/{body}/paper/{number}",
+                "Paper",
+                body=body_data["id"],
+                name=f"Vorlage {number}",
+                reference=f"VO/{number:05d}",
+                date="2020-01-01",
+                paperType="Vorlage",
+                originatorPerson=[self.random.choice(person_ids)] if person_ids else [],
+                consultation=consultations,
+            )
+            if files:
+                paper["mainFile"] = files[0]
+            if len(files) == 2 and self.vendor == "cc-egov":
+                # CC e-gov gives single auxiliary files as object
+                paper["auxiliaryFile"] = files[1]
+            elif len(files) > 1:
+                paper["auxiliaryFile"] = files[1:]
+            self.add(lists["paper"], paper)
+
+    def modify(self, fraction: float) -> List[str]:
+        """Renames a fraction of the papers and removes their auxiliary files,
+        like the changes between two runs of the hourly update.
+
+        Returns the ids of the changed papers"""
+        modified = datetime.datetime.now().astimezone().replace(microsecond=0)
+        paper_ids = [i for i in self.objects if "/paper/" in i]
+        changed = self.random.sample(paper_ids, int(len(paper_ids) * fraction))
+        for paper_id in changed:
+            paper = self.objects[paper_id]
+            paper["name"] += " (geändert)"
+            paper["modified"] = modified.isoformat()
+            paper.pop("auxiliaryFile", None)
+        return changed
+
+    def get_page(self, url: str, query: Dict[str, str]) -> JSON:
+        ids = self.lists[url]
+        if query.get("modified_since"):
+            since = datetime.datetime.fromisoformat(query["modified_since"])
+            ids = [
+                i
+                for i in ids
+                if datetime.datetime.fromisoformat(self.objects[i]["modified"]) >= since
+            ]
+        page = int(query.get("page", 1))
+        start = (page - 1) * self.page_size
+        links = {}
+        if start + self.page_size < len(ids):
+            links["next"] = url + "?" + urlencode({**query, "page": page + 1})
+        return {
+            "data": [self.objects[i] for i in ids[start : start + self.page_size]],
+            "pagination": {
+                "totalElements": len(ids),
+                "elementsPerPage": self.page_size,
+                "currentPage": page,
+                "totalPages": max(1, -(-len(ids) // self.page_size)),
+            },
+            "links": links,
+        }
+
+    def respond(self, url: str, query: Dict[str, str]) -> Tuple[int, str, bytes]:
+        """Returns the status code, the content type and the body for a request"""
+        if url in self.files:
+            return 200, "application/pdf", self.files[url]
+        if url in self.lists:
+            data = self.get_page(url, query)
+        elif url in self.objects:
+            data = self.objects[url]
+        else:
+            return 404, "application/json", b'{"error": "Not found"}'
+        return 200, "application/json", json.dumps(data).encode()
+
+
+class OparlServer:
+    """Serves a `SyntheticOparl` on a free port of localhost in a thread"""
+
+    def __init__(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                url = server.url + parsed.path
+                query = {key: value[0] for key, value in parse_qs(parsed.query).items()}
+                status, content_type, body = server.oparl.respond(url, query)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.oparl: Optional[SyntheticOparl] = None
+        self.http_server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.http_server.server_port}"
+        self.thread = threading.Thread(
+            target=self.http_server.serve_forever, daemon=True
+        )
+
+    def __enter__(self) -> "OparlServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+
+def run_benchmark(
+    oparl: SyntheticOparl,
+    update_fraction: float = 0.1,
+    load_files: bool = True,
+    store_files: bool = False,
+    force_singlethread: bool = False,
+) -> None:
+    """Imports the synthetic system, updates it after changing some papers
+    and loads the files, recording the time of each phase as
+    `benchmark.<phase>`"""
+    # The in-memory sqlite test database can neither be written concurrently
+    # nor be used by child processes
+    force_singlethread = force_singlethread or connection.vendor == "sqlite"
+    # The responses must not come from a cache
+    with override_settings(IMPORTER_HTTP_CACHE=None):
+        loader = get_loader_from_system(oparl.system["id"])
+        importer = Importer(loader, force_singlethread=force_singlethread)
+
+        with timer("benchmark.fetch_lists_initial"):
+            bodies = importer.load_bodies()
+            importer.fetch_lists_initial([body.data for body in bodies])
+        with timer("benchmark.import_objects"):
+            [body, *_others] = importer.import_bodies()
+            importer.converter.default_body = body
+            importer.import_objects()
+
+        set_value("changed_papers", len(oparl.modify(update_fraction)))
+        with timer("benchmark.update"):
+            for updated in Body.objects.filter(oparl_id__isnull=False).order_by("id"):
+                Importer(loader, updated, force_singlethread=force_singlethread).update(
+                    updated.oparl_id
+                )
+
+        if not load_files:
+            return
+        # Without PROXY_ONLY_TEMPLATE, the files would be uploaded to minio
+        proxy_only = None if store_files else oparl.base_url + "/file/{}"
+        with override_settings(PROXY_ONLY_TEMPLATE=proxy_only):
+            with timer("benchmark.load_files"):
+                importer.load_files(fallback_city=body.short_name, update=True)
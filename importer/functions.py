@@ -1,15 +1,20 @@
 import datetime
+import hashlib
+import json
 import logging
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import nullcontext
-from typing import Optional, Set, List
+from typing import Optional, Set, List, Dict, Any
 
 import requests
+from django import db
 from django.db.models import OuterRef, Q, Subquery, F
 from slugify import slugify
 from urllib3.exceptions import InsecureRequestWarning
 
-from importer import JSON
+from importer import JSON, instrumentation
 from importer.models import CachedObject, ExternalList
 from mainapp.functions.search import search_bulk_index
 from mainapp.models import (
@@ -45,13 +50,16 @@ import_order = [
 ]  # type: List[Type[DefaultFields]]
 
 
-def requests_get(url, params=None, retries: int = 3, **kwargs) -> requests.Response:
-    """Makes a request with the custom user agent and retry on connection error"""
-    user_agent = "{} ({})".format(
+def get_user_agent() -> str:
+    return "{} ({})".format(
         slugify(settings.PRODUCT_NAME), settings.TEMPLATE_META["github"]
     )
+
+
+def requests_get(url, params=None, retries: int = 3, **kwargs) -> requests.Response:
+    """Makes a request with the custom user agent and retry on connection error"""
     kwargs.setdefault("headers", {})
-    kwargs["headers"]["User-Agent"] = user_agent
+    kwargs["headers"]["User-Agent"] = get_user_agent()
     # Hack to make Landshut work with the RIS' broken SSL setup
     if settings.SSL_NO_VERIFY:
         kwargs["verify"] = False
@@ -70,6 +78,14 @@ def requests_get(url, params=None, retries: int = 3, **kwargs) -> requests.Respo
                 logger.error(f"Error {e} in request for {url}, retrying")
 
 
+def hash_json(data: JSON) -> str:
+    """A hash that doesn't depend on the order of keys or the formatting"""
+    canonical = json.dumps(
+        data, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
 def externalize(
     libobject: JSON, key_callback: Optional[Set[str]] = None
 ) -> List[CachedObject]:
@@ -124,6 +140,7 @@ def externalize(
             url=libobject["id"],
             data=libobject,
             oparl_type=libobject["type"].split("/")[-1],
+            content_hash=hash_json(libobject),
         )
     )
 
@@ -134,7 +151,10 @@ def clear_import(prefix: str, include_cache: bool = True) -> None:
     """Clear all data from the oparl api identified by the prefix"""
     for class_object in import_order:
         name = class_object.__name__
-        stats = class_object.objects.filter(oparl_id__startswith=prefix).delete()
+        objects = class_object.objects.filter(oparl_id__startswith=prefix)
+        if class_object == File:
+            File.release_duplicates(objects)
+        stats = objects.delete()
         logger.info(f"{name}: {stats}")
     if include_cache:
         deleted = CachedObject.objects.filter(url__startswith=prefix).delete()
@@ -147,25 +167,95 @@ def import_update(
     body_id: Optional[str] = None,
     ignore_modified: bool = False,
     download_files: bool = True,
-) -> None:
-    from importer.importer import Importer
-    from importer.loader import get_loader_from_body
+) -> List[Dict[str, Any]]:
+    """Updates all bodies with an oparl id (or only `body_id`).
 
+    Up to `IMPORTER_BODY_WORKERS` bodies are updated concurrently, each in its
+    own thread with its own loader, importer and database connection. A failing
+    body doesn't stop the others; instead, a RuntimeError is raised after all
+    bodies are done. Returns the result for each body."""
     if body_id:
-        bodies = Body.objects.filter(oparl_id=body_id).all()
+        bodies = Body.objects.filter(oparl_id=body_id)
+    else:
+        bodies = Body.objects.filter(oparl_id__isnull=False)
+    body_ids = list(bodies.values_list("id", flat=True))
+
+    workers = settings.IMPORTER_BODY_WORKERS
+    if workers <= 1 or len(body_ids) <= 1:
+        results = [
+            update_body(body, ignore_modified, download_files) for body in body_ids
+        ]
     else:
-        bodies = Body.objects.filter(oparl_id__isnull=False).all()
-    for body in bodies:
+        claimed_files: Set[int] = set()
+
+        def update_in_thread(body: int) -> Dict[str, Any]:
+            try:
+                return update_body(body, ignore_modified, download_files, claimed_files)
+            finally:
+                # Every thread has its own connection, which django doesn't close for us
+                db.connection.close()
+
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(update_in_thread, body_ids))
+
+    instrumentation.set_value("bodies", results)
+    for result in results:
+        if result["error"]:
+            logger.error(f"Updating {result['body']} failed: {result['error']}")
+        else:
+            logger.info(
+                f"Updated {result['body']} in {result['seconds']:.0f}s,"
+                f" {result['successful_files']} files imported and"
+                f" {result['failed_files']} files failed"
+            )
+    failed = [result["body"] for result in results if result["error"]]
+    if failed:
+        raise RuntimeError(
+            f"Updating {len(failed)} of {len(results)} bodies failed: {failed}"
+        )
+    return results
+
+
+def update_body(
+    body_id: int,
+    ignore_modified: bool,
+    download_files: bool,
+    claimed_files: Optional[Set[int]] = None,
+) -> Dict[str, Any]:
+    """Updates a single body and loads its files, catching all errors"""
+    from importer.importer import Importer, shared_objects_lock
+    from importer.loader import get_loader_from_body
+
+    body = Body.objects.get(id=body_id)
+    result = {
+        "body": body.oparl_id,
+        "seconds": 0.0,
+        "successful_files": 0,
+        "failed_files": 0,
+        "error": None,
+    }
+    start = time.perf_counter()
+    try:
         logger.info(f"Updating body {body}: {body.oparl_id}")
         loader = get_loader_from_body(body.oparl_id)
-        importer = Importer(loader, body, ignore_modified=ignore_modified)
+        # Creating the importer ensures the organization types exist
+        with shared_objects_lock:
+            importer = Importer(loader, body, ignore_modified=ignore_modified)
         importer.update(body.oparl_id)
         importer.force_singlethread = True
         if download_files:
-            importer.load_files(
+            successful, failed = importer.load_files(
                 fallback_city=settings.GEOEXTRACT_SEARCH_CITY or body.short_name,
                 update=True,
+                claimed_files=claimed_files,
             )
+            result["successful_files"] = successful
+            result["failed_files"] = failed
+    except Exception as e:
+        logger.exception(f"Updating body {body} failed")
+        result["error"] = repr(e)
+    result["seconds"] = time.perf_counter() - start
+    return result
 
 
 def fix_sort_date(import_date: datetime.datetime):
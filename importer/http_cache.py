@@ -0,0 +1,144 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Optional, Dict, Iterator
+from urllib.parse import urlencode
+
+from django.conf import settings
+from requests import Response, RequestException
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+# Only these headers are needed to rebuild a response
+stored_headers = ["Content-Type", "ETag", "Last-Modified"]
+
+
+class ReplayMiss(RequestException):
+    """The response cache is in replay mode and doesn't have the requested url"""
+
+
+class ResponseCache:
+    """Stores responses on disk, keyed by url and query.
+
+    In record mode, a stored response is revalidated with `If-None-Match` and
+    `If-Modified-Since` if the server gave us an ETag or Last-Modified, so
+    unchanged objects and files aren't downloaded again. In replay mode, the
+    network is never used and urls that weren't recorded fail with
+    `ReplayMiss`, which e.g. allows running the importer benchmark offline.
+    """
+
+    def __init__(self, directory: Path, replay: bool = False):
+        self.directory = Path(directory)
+        self.replay = replay
+
+    @classmethod
+    def from_settings(cls) -> Optional["ResponseCache"]:
+        if not settings.IMPORTER_HTTP_CACHE:
+            return None
+        replay = settings.IMPORTER_HTTP_CACHE_MODE == "replay"
+        return cls(Path(settings.IMPORTER_HTTP_CACHE), replay)
+
+    def get_path(self, url: str, params: Optional[Dict[str, str]]) -> Path:
+        key = url
+        if params:
+            key += "?" + urlencode(sorted(params.items()))
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return self.directory.joinpath(digest[:2], digest)
+
+    def get(
+        self, url: str, params: Optional[Dict[str, str]] = None
+    ) -> Optional[Response]:
+        path = self.get_path(url, params)
+        try:
+            meta = json.loads(path.with_suffix(".json").read_text())
+            content = path.with_suffix(".body").read_bytes()
+        except FileNotFoundError:
+            return None
+
+        response = Response()
+        response.url = meta["url"]
+        response.status_code = meta["status_code"]
+        response.reason = meta["reason"]
+        response.encoding = meta["encoding"]
+        response.headers = CaseInsensitiveDict(meta["headers"])
+        response._content = content
+        response._content_consumed = True
+        return response
+
+    def conditional_headers(self, cached: Response) -> Dict[str, str]:
+        headers = dict()
+        if cached.headers.get("ETag"):
+            headers["If-None-Match"] = cached.headers["ETag"]
+        if cached.headers.get("Last-Modified"):
+            headers["If-Modified-Since"] = cached.headers["Last-Modified"]
+        return headers
+
+    def _meta(self, response: Response) -> bytes:
+        meta = {
+            "url": response.url,
+            "status_code": response.status_code,
+            "reason": response.reason,
+            "encoding": response.encoding,
+            "headers": {
+                key: response.headers[key]
+                for key in stored_headers
+                if key in response.headers
+            },
+        }
+        return json.dumps(meta).encode()
+
+    def store(
+        self, url: str, params: Optional[Dict[str, str]], response: Response
+    ) -> None:
+        path = self.get_path(url, params)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # The body goes first so that a concurrent reader never finds metadata without a body
+        self._write_atomic(path.with_suffix(".body"), response.content)
+        self._write_atomic(path.with_suffix(".json"), self._meta(response))
+
+    def store_streamed(
+        self,
+        url: str,
+        params: Optional[Dict[str, str]],
+        response: Response,
+        max_size: int,
+    ) -> None:
+        """Stores a streamed response while it is read, so that it is never held
+        in memory as a whole. It is only stored if it is read to the end and is
+        at most `max_size` bytes large"""
+        path = self.get_path(url, params)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        meta = self._meta(response)
+        iter_content = response.iter_content
+
+        def iter_and_store(
+            chunk_size: int = 1, decode_unicode: bool = False
+        ) -> Iterator[bytes]:
+            tmp_file = NamedTemporaryFile(dir=path.parent, delete=False)
+            size = 0
+            complete = False
+            try:
+                for chunk in iter_content(chunk_size, decode_unicode):
+                    size += len(chunk)
+                    if size <= max_size:
+                        tmp_file.write(chunk)
+                    yield chunk
+                complete = size <= max_size
+            finally:
+                tmp_file.close()
+                if complete:
+                    os.replace(tmp_file.name, path.with_suffix(".body"))
+                    self._write_atomic(path.with_suffix(".json"), meta)
+                else:
+                    os.unlink(tmp_file.name)
+
+        response.iter_content = iter_and_store
+
+    def _write_atomic(self, path: Path, content: bytes) -> None:
+        with NamedTemporaryFile(dir=path.parent, delete=False) as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_file.name, path)
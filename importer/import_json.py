@@ -1,19 +1,18 @@
+import hashlib
+import itertools
 import logging
-from datetime import datetime
-from typing import Dict, Type, List, Tuple, TypeVar, Iterable, Any, Optional
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+from typing import Dict, Type, List, Tuple, TypeVar, Iterable, Any, Optional, Union
 
 import django.db.models
 from django.conf import settings
 from django.core.exceptions import MultipleObjectsReturned
-from django.db import transaction
-from django.utils import timezone
-from django_elasticsearch_dsl.registries import registry
-from tqdm import tqdm
 
 from importer import json_datatypes
-from importer.json_datatypes import RisData
+from importer.import_plan import ChangePlan, ModelPlan, Ref
+from importer.json_datatypes import RisData, StreamedRisData
 from mainapp import models
-from mainapp.functions.search import search_bulk_index
 from mainapp.models import DefaultFields
 from mainapp.models.file import fallback_date
 from mainapp.models.helper import SoftDeleteModelManager
@@ -94,18 +93,44 @@ def str_or_none(value: Any) -> Optional[str]:
         return None
 
 
-def get_from_db(current_model: Type[django.db.models.Model]) -> Tuple[dict, dict]:
-    db_value_list = current_model.objects.values_list("id", *field_lists[current_model])
-    db_ids = dict()
-    db_map = dict()
+def row_digest(values: Iterable[Any]) -> bytes:
+    """A compact digest of the field values of a row. Datetimes are compared in
+    UTC since the database doesn't keep the timezone of the scraper"""
+    normalized = []
+    for value in values:
+        if isinstance(value, datetime) and value.tzinfo is not None:
+            value = value.astimezone(dt_timezone.utc)
+        normalized.append(value)
+    return hashlib.blake2b(repr(normalized).encode(), digest_size=16).digest()
 
-    for db_entry in db_value_list:
-        field_dict = dict(zip(field_lists[current_model], db_entry[1:]))
-        tuple_id = tuple(field_dict[i] for i in unique_field_dict[current_model])
-        db_ids[tuple_id] = db_entry[0]
-        db_map[tuple_id] = dict(zip(field_lists[current_model], db_entry[1:]))
 
-    return db_ids, db_map
+def get_digests_from_db(
+    current_model: Type[django.db.models.Model],
+    undelete: Iterable[int] = (),
+    renames: Optional[Dict[int, Dict[str, Any]]] = None,
+) -> Dict[Tuple, Tuple[int, bytes]]:
+    """Maps the unique key of every row to its id and the digest of its fields,
+    as if the planned undeletes and renames had been applied.
+
+    Only the digest is kept of every row, so this is much smaller than the rows
+    themselves."""
+    fields = field_lists[current_model]
+    key_positions = [fields.index(i) for i in unique_field_dict[current_model]]
+    db_digests = dict()
+    db_value_list = current_model.objects.values_list("id", *fields)
+    rows = db_value_list.iterator(chunk_size=2000)
+    if undelete:
+        undeleted = current_model.objects_with_deleted.filter(pk__in=undelete)
+        rows = itertools.chain(rows, undeleted.values_list("id", *fields))
+    for db_entry in rows:
+        values = db_entry[1:]
+        if renames and db_entry[0] in renames:
+            renamed = renames[db_entry[0]]
+            values = tuple(renamed.get(i, j) for i, j in zip(fields, values))
+        tuple_id = tuple(values[i] for i in key_positions)
+        db_digests[tuple_id] = (db_entry[0], row_digest(values))
+
+    return db_digests
 
 
 T = TypeVar("T")
@@ -115,9 +140,18 @@ def incremental_import(
     current_model: Type[django.db.models.Model],
     json_objects: Iterable[Dict[str, Any]],
     soft_delete: bool = True,
+    plan: Optional[ChangePlan] = None,
+    renames: Optional[Dict[int, Dict[str, Any]]] = None,
 ):
     """Compared the objects in the database with the json data for a given objects and
-    creates, updates and (soft-)deletes the appropriate records."""
+    plans to create, update and (soft-)delete the appropriate records.
+
+    Without a plan, the changes are applied right away. `renames` are changes by id
+    that are applied before everything else."""
+
+    model_plan = ModelPlan(current_model, unique_field_dict[current_model], soft_delete)
+    if renames:
+        model_plan.renames = list(renames.items())
 
     json_map = dict()
     for json_dict in json_objects:
@@ -143,86 +177,39 @@ def incremental_import(
         to_undelete = set(deleted) & set(oparls_ids)
         if to_undelete:
             logger.info(f"{current_model.__name__}: Undeleting {len(to_undelete)}")
-            current_model.objects_with_deleted.filter(oparl_id__in=to_undelete).update(
-                deleted=False
+            model_plan.undelete = list(
+                current_model.objects_with_deleted.filter(
+                    oparl_id__in=to_undelete
+                ).values_list("id", flat=True)
             )
 
-    db_ids, db_map = get_from_db(current_model)
+    db_digests = get_digests_from_db(current_model, model_plan.undelete, renames)
 
-    common = set(json_map.keys()) & set(db_map.keys())
-    to_be_created = set(json_map.keys()) - common
-    to_be_deleted = set(db_map.keys()) - common
-    to_be_updated = []
-    for existing in common:
-        if json_map[existing] != db_map[existing]:
-            to_be_updated.append((json_map[existing], db_ids[existing]))
+    fields = field_lists[current_model]
+    for key, json_dict in json_map.items():
+        if key not in db_digests:
+            model_plan.create.append(json_dict)
+            continue
+        pk, db_digest = db_digests.pop(key)
+        if row_digest(json_dict.get(field) for field in fields) != db_digest:
+            model_plan.update.append((json_dict, pk))
+    # Everything that is left isn't in the json anymore
+    model_plan.delete = [pk for pk, _ in db_digests.values()]
 
-    # We need to delete first and then create to avoid conflicts e.g. when the start of a meeting with an oparl_id
-    # changed
-    deletion_ids = [db_ids[i1] for i1 in to_be_deleted]
     logger.info(
         f"{current_model.__name__}: "
-        f"Deleting {len(to_be_deleted)}, "
-        f"Creating {len(to_be_created)} and "
-        f"Updating {len(to_be_updated)}"
+        f"Deleting {len(model_plan.delete)}, "
+        f"Creating {len(model_plan.create)} and "
+        f"Updating {len(model_plan.update)}"
     )
+    (plan or ChangePlan()).add(model_plan)
 
-    # Since we don't get the bulk created object ids back from django (yet?),
-    # we just do this by timestamp - indexing more that necessary isn't wrong anyway
-    before_bulk_create = timezone.now()
-
-    if soft_delete:
-        deleted_rows = current_model.objects.filter(id__in=deletion_ids).update(
-            deleted=True, modified=timezone.now()
-        )
-    else:
-        current_model.objects.filter(id__in=deletion_ids).delete()
-        deleted_rows = 0
-    # TODO: Delete files
-
-    to_be_created = [current_model(**json_map[i1]) for i1 in to_be_created]
-    current_model.objects.bulk_create(to_be_created, batch_size=100)
-
-    # Bulk create doesn't update the search index, so we do this manually
-    if settings.ELASTICSEARCH_ENABLED and current_model in registry.get_models():
-        # Changed/Created
-        qs = current_model.objects.filter(modified__gte=before_bulk_create)
-        qs_count = qs.count()
-
-        assert qs_count >= len(to_be_created), (
-            f"Only {qs_count} {current_model.__name__} were found for indexing, while"
-            f" at least {len(to_be_created)} were expected"
-        )
-
-        logger.info(f"Indexing {qs_count} {current_model.__name__} new objects")
-        search_bulk_index(current_model, qs)
-
-        # Deleted
-        qs = current_model.objects_with_deleted.filter(
-            deleted=True, modified__gte=before_bulk_create
-        )
-        qs_count = qs.count()
-
-        assert qs_count >= deleted_rows, (
-            f"Only {qs_count} {current_model.__name__} for deletion, while at least"
-            f" {deleted_rows} were expected"
-        )
-
-        logger.info(f"Deleting {qs_count} {current_model.__name__} from elasticsearch")
-        search_bulk_index(current_model, qs, action="delete")
-
-    with transaction.atomic():
-        for json_object, pk in tqdm(
-            to_be_updated,
-            disable=not to_be_updated,
-            desc=f"Update or create for {current_model.__name__}",
-        ):
-            current_model.objects_with_deleted.update_or_create(
-                pk=pk, defaults=json_object
-            )
 
-
-def make_id_map(cls: Type[SoftDeleteModelManager]) -> Dict[int, int]:
+def make_id_map(
+    cls: Type[SoftDeleteModelManager], plan: Optional[ChangePlan] = None
+) -> Dict[int, Union[int, Ref]]:
+    if plan:
+        return {int(i): j for i, j in plan.values_list(cls, "oparl_id")}
     return {int(i): j for i, j in cls.values_list("oparl_id", "id")}
 
 
@@ -288,13 +275,13 @@ def convert_person(args: Tuple[str, str, str]) -> Dict[str, Any]:
     return {"name": name, "given_name": given_names, "family_name": family_name}
 
 
-def convert_location(json_meeting: json_datatypes.Meeting) -> models.Location:
+def convert_location(json_meeting: json_datatypes.Meeting) -> Dict[str, Any]:
     # TODO: Try to normalize the locations
     #   and geocode after everything else has been done
-    return models.Location(
-        description=json_meeting.location,
-        is_official=True,  # TODO: Is this true after geocoding?
-    )
+    return {
+        "description": json_meeting.location,
+        "is_official": True,  # TODO: Is this true after geocoding?
+    }
 
 
 def convert_meeting(
@@ -313,7 +300,9 @@ def convert_meeting(
 
 
 def convert_paper(
-    json_paper: json_datatypes.Paper, consultations: Dict[int, datetime]
+    json_paper: json_datatypes.Paper,
+    consultations: Dict[int, datetime],
+    paper_types: Dict[str, int],
 ) -> Dict[str, Any]:
     db_paper = {
         "short_name": json_paper.short_name[:50],  # TODO: Better normalization
@@ -326,10 +315,7 @@ def convert_paper(
         ).date(),
     }
     if json_paper.paper_type:
-        paper_type, created = models.PaperType.objects.get_or_create(
-            paper_type=json_paper.paper_type
-        )
-        db_paper["paper_type_id"] = paper_type.id
+        db_paper["paper_type_id"] = paper_types[json_paper.paper_type]
     return db_paper
 
 
@@ -400,61 +386,71 @@ def handle_counts(ris_data: RisData, allow_shrinkage: bool):
                 )
 
 
-def import_data(body: models.Body, ris_data: RisData):
-    import_papers(ris_data)
-    import_files(ris_data)
-    paper_id_map = make_id_map(models.Paper.objects)
-    file_id_map = make_id_map(models.File.objects)
-    import_paper_files(ris_data, paper_id_map, file_id_map)
-    import_organizations(body, ris_data)
-    import_meeting_locations(ris_data)
-    locations = dict(models.Location.objects.values_list("description", "id"))
-    import_meetings(ris_data, locations)
-    meeting_id_map = make_id_map(models.Meeting.objects.filter(oparl_id__isnull=False))
+def import_data(
+    body: models.Body,
+    ris_data: Union[RisData, StreamedRisData],
+    plan: Optional[ChangePlan] = None,
+):
+    """Every phase only iterates over the lists it needs, so with a
+    `StreamedRisData` only the working set of one phase is in memory.
+
+    With a plan that writes to a file, nothing is written to the database."""
+    plan = plan or ChangePlan()
+    import_papers(ris_data, plan)
+    import_files(ris_data, plan)
+    paper_id_map = make_id_map(models.Paper.objects, plan)
+    file_id_map = make_id_map(models.File.objects, plan)
+    import_paper_files(ris_data, paper_id_map, file_id_map, plan)
+    import_organizations(body, ris_data, plan)
+    import_meeting_locations(ris_data, plan)
+    locations = dict(plan.values_list(models.Location.objects, "description"))
+    import_meetings(ris_data, locations, plan)
+    meeting_id_map = make_id_map(
+        models.Meeting.objects.filter(oparl_id__isnull=False), plan
+    )
     organization_name_id_map = dict(
-        models.Organization.objects.values_list("name", "id")
+        plan.values_list(models.Organization.objects, "name")
+    )
+    import_meeting_organization(
+        meeting_id_map, organization_name_id_map, ris_data, plan
     )
-    import_meeting_organization(meeting_id_map, organization_name_id_map, ris_data)
-    import_persons(ris_data)
-    import_consultations(ris_data, meeting_id_map, paper_id_map)
+    import_persons(ris_data, plan)
+    import_consultations(ris_data, meeting_id_map, paper_id_map, plan)
     # We don't have original ids for all agenda items (yet?),
     # so we just assume meeting x paper is unique
     consultation_map = {
         (a, b): c
-        for a, b, c in models.Consultation.objects.values_list(
-            "meeting_id", "paper_id", "id"
+        for a, b, c in plan.values_list(
+            models.Consultation.objects, "meeting_id", "paper_id"
         )
     }
     # flush_model(models.AgendaItem) # It's incremental!
-    import_agenda_items(ris_data, consultation_map, meeting_id_map, paper_id_map)
-    import_memberships(ris_data)
+    import_agenda_items(ris_data, consultation_map, meeting_id_map, paper_id_map, plan)
+    import_memberships(ris_data, plan)
 
 
-def import_memberships(ris_data: RisData):
+def import_memberships(ris_data: RisData, plan: ChangePlan):
     logger.info(f"Importing {len(ris_data.memberships)} memberships")
     # TODO: Currently, the persons list is incomplete. This patches it up until that's solved
     #   properly by a rewrite of the relevant scraper part
     #   Use https://buergerinfo.ulm.de/kp0043.php?__swords=%22%22&__sgo=Suchen instead to get all persons and memberships
     #   at once and then use some custom id scheme where no original id exists
-    person_name_map = {
-        name: person_id
-        for name, person_id in models.Person.objects.values_list("name", "id")
-    }
+    person_name_map = dict(plan.values_list(models.Person.objects, "name"))
+    persons_fixup = ModelPlan(models.Person, ["name"], history=True)
     persons_fixup_done = set()
     for json_membership in ris_data.memberships:
         family_name, given_names, name = normalize_name(json_membership.person_name)
         if name not in person_name_map and name not in persons_fixup_done:
-            models.Person(
-                given_name=given_names, family_name=family_name, name=name
-            ).save()
+            persons_fixup.create.append(
+                {"given_name": given_names, "family_name": family_name, "name": name}
+            )
             persons_fixup_done.add(name)
-    person_name_map = {
-        name: person_id
-        for name, person_id in models.Person.objects.values_list("name", "id")
-    }
+    if persons_fixup.create:
+        plan.add(persons_fixup)
+        person_name_map = dict(plan.values_list(models.Person.objects, "name"))
     # Assumption: Organizations that don't have an id in the overview page aren't linked anywhere
     organization_id_map = make_id_map(
-        models.Organization.objects.filter(oparl_id__isnull=False)
+        models.Organization.objects.filter(oparl_id__isnull=False), plan
     )
 
     objects = []
@@ -471,7 +467,7 @@ def import_memberships(ris_data: RisData):
                 "organization_id": organization,
             }
         )
-    incremental_import(models.Membership, objects)
+    incremental_import(models.Membership, objects, plan=plan)
 
 
 def import_agenda_items(
@@ -479,6 +475,7 @@ def import_agenda_items(
     consultation_map: Dict[Tuple[int, int], int],
     meeting_id_map: Dict[int, int],
     paper_id_map: Dict[int, int],
+    plan: ChangePlan,
 ):
     logger.info(f"Processing {len(ris_data.agenda_items)} agenda items")
 
@@ -491,24 +488,26 @@ def import_agenda_items(
     # Handle the case where the start or name of a meeting with an id changed.
     db_data = models.AgendaItem.objects_with_deleted.filter(
         oparl_id__isnull=False
-    ).values_list("oparl_id", "name")
+    ).values_list("id", "oparl_id", "name")
 
     # We can ignore the None case
     oparl_id_to_name = {
         agenda_item["oparl_id"]: agenda_item["name"] for agenda_item in objects
     }
-    for oparl_id, name in db_data:
+    renames = dict()
+    for pk, oparl_id, name in db_data:
         if oparl_id in oparl_id_to_name:
             if name != oparl_id_to_name[oparl_id]:
-                models.AgendaItem.objects_with_deleted.filter(oparl_id=oparl_id).update(
-                    name=oparl_id_to_name[oparl_id]
-                )
+                renames[pk] = {"name": oparl_id_to_name[oparl_id]}
 
-    incremental_import(models.AgendaItem, objects)
+    incremental_import(models.AgendaItem, objects, plan=plan, renames=renames)
 
 
 def import_consultations(
-    ris_data: RisData, meeting_id_map: Dict[int, int], paper_id_map: Dict[int, int]
+    ris_data: RisData,
+    meeting_id_map: Dict[int, int],
+    paper_id_map: Dict[int, int],
+    plan: ChangePlan,
 ):
     logger.info(f"Importing {len(ris_data.agenda_items)} consultations")
 
@@ -521,20 +520,28 @@ def import_consultations(
             convert_consultation(json_agenda_item, meeting_id_map, paper_id_map)
         )
 
-    incremental_import(models.Consultation, objects)
+    incremental_import(models.Consultation, objects, plan=plan)
 
 
-def import_persons(ris_data: RisData):
+def import_persons(ris_data: RisData, plan: ChangePlan):
     logger.info(f"Importing {len(ris_data.persons)} persons")
 
     persons = [normalize_name(json_person.name) for json_person in ris_data.persons]
     objects = [convert_person(i) for i in persons]
 
-    incremental_import(models.Person, objects)
+    incremental_import(models.Person, objects, plan=plan)
 
 
-def import_meeting_organization(meeting_id_map, organization_name_id_map, ris_data):
+def import_meeting_organization(
+    meeting_id_map, organization_name_id_map, ris_data, plan: ChangePlan
+):
     logger.info("Processing the meeting-organization-associations")
+    # Meetings without id are identified by name and start
+    meetings_by_name_start: Dict[Tuple[str, datetime], List[int]] = defaultdict(list)
+    for name, start, meeting_id in plan.values_list(
+        models.Meeting.objects, "name", "start"
+    ):
+        meetings_by_name_start[(name, start)].append(meeting_id)
     objects = []
     for meeting in ris_data.meetings:
         associated_organization_id = organization_name_id_map.get(
@@ -547,19 +554,19 @@ def import_meeting_organization(meeting_id_map, organization_name_id_map, ris_da
         if meeting.original_id:
             associated_meeting_id = meeting_id_map[meeting.original_id]
         else:
-            try:
-                associated_meeting_id = models.Meeting.objects.get(
-                    name=meeting.name, start=meeting.start
-                ).id
-            except MultipleObjectsReturned:
-                meetings_found = [
-                    (i.name, i.start)
-                    for i in models.Meeting.objects.filter(
-                        name=meeting.name, start=meeting.start
-                    ).all()
-                ]
+            meeting_ids = meetings_by_name_start.get((meeting.name, meeting.start), [])
+            if not meeting_ids:
+                raise models.Meeting.DoesNotExist(
+                    f"Meeting {meeting.name} at {meeting.start} does not exist"
+                )
+            if len(meeting_ids) > 1:
+                meetings_found = [(meeting.name, meeting.start)] * len(meeting_ids)
                 logger.error(f"Multiple meetings found: {meetings_found}")
-                raise
+                raise MultipleObjectsReturned(
+                    f"Found {len(meeting_ids)} meetings {meeting.name} at"
+                    f" {meeting.start}"
+                )
+            [associated_meeting_id] = meeting_ids
 
         objects.append(
             {
@@ -567,15 +574,18 @@ def import_meeting_organization(meeting_id_map, organization_name_id_map, ris_da
                 "organization_id": associated_organization_id,
             }
         )
-    incremental_import(models.Meeting.organizations.through, objects, soft_delete=False)
+    incremental_import(
+        models.Meeting.organizations.through, objects, soft_delete=False, plan=plan
+    )
 
 
-def import_meeting_locations(ris_data: RisData):
+def import_meeting_locations(ris_data: RisData, plan: ChangePlan):
     logger.info(f"Importing {len(ris_data.meetings)} meeting locations")
-    existing_locations = set(
-        models.Location.objects.values_list("description", flat=True)
-    )
-    db_locations: Dict[str, models.Location] = dict()
+    existing_locations = {
+        description
+        for description, _ in plan.values_list(models.Location.objects, "description")
+    }
+    db_locations: Dict[str, Dict[str, Any]] = dict()
     for json_meeting in ris_data.meetings:
         if not json_meeting.location or json_meeting.location in db_locations:
             continue
@@ -583,13 +593,15 @@ def import_meeting_locations(ris_data: RisData):
         if json_meeting.location in existing_locations:
             continue
 
-        db_location = convert_location(json_meeting)
-        db_location.save()
-        db_locations[json_meeting.location] = db_location
+        db_locations[json_meeting.location] = convert_location(json_meeting)
     logger.info(f"Saving {len(db_locations)} new meeting locations")
+    if db_locations:
+        locations_plan = ModelPlan(models.Location, ["description"], history=True)
+        locations_plan.create = list(db_locations.values())
+        plan.add(locations_plan)
 
 
-def import_meetings(ris_data: RisData, locations: Dict[str, int]):
+def import_meetings(ris_data: RisData, locations: Dict[str, int], plan: ChangePlan):
     logger.info(f"Importing {len(ris_data.meetings)} meetings")
 
     objects = []
@@ -599,49 +611,60 @@ def import_meetings(ris_data: RisData, locations: Dict[str, int]):
     # Handle the case where the start or name of a meeting with an id changed.
     db_data = models.Meeting.objects_with_deleted.filter(
         oparl_id__isnull=False
-    ).values_list("start", "name", "oparl_id")
+    ).values_list("id", "start", "name", "oparl_id")
 
     # We can ignore the None case
     oparl_id_to_object = {meeting["oparl_id"]: meeting for meeting in objects}
-    for start, name, oparl_id in db_data:
+    renames = dict()
+    for pk, start, name, oparl_id in db_data:
         if oparl_id in oparl_id_to_object:
             meeting_dict = oparl_id_to_object[oparl_id]
             if start != meeting_dict["start"] or name != meeting_dict["name"]:
-                models.Meeting.objects_with_deleted.filter(oparl_id=oparl_id).update(
-                    start=meeting_dict["start"], name=meeting_dict["name"]
-                )
+                renames[pk] = {
+                    "start": meeting_dict["start"],
+                    "name": meeting_dict["name"],
+                }
 
-    incremental_import(models.Meeting, objects)
+    incremental_import(models.Meeting, objects, plan=plan, renames=renames)
 
 
-def import_organizations(body: models.Body, ris_data: RisData):
+def import_organizations(body: models.Body, ris_data: RisData, plan: ChangePlan):
     logger.info(f"Importing {len(ris_data.organizations)} organizations")
     committee = settings.COMMITTEE_TYPE
-    committee_type, _ = models.OrganizationType.objects.get_or_create(
-        id=committee[0], defaults={"name": committee[1]}
-    )
+    committee_type = models.OrganizationType(id=committee[0], name=committee[1])
+    if not models.OrganizationType.objects.filter(id=committee[0]).exists():
+        committee_plan = ModelPlan(models.OrganizationType, ["id"])
+        committee_plan.create.append({"id": committee[0], "name": committee[1]})
+        plan.add(committee_plan)
+
+    objects = []
+    for i in ris_data.organizations:
+        objects.append(convert_organization(body, committee_type, i))
 
     # FIXME: Why does removing this check break the tests?
     if settings.ELASTICSEARCH_ENABLED:
         # We want to make the main organization - if known - to get the id 1 so that
         # the user doesn't need additional config
         if ris_data.main_organization and not models.Organization.objects.first():
-            models.Organization(
-                id=1,
-                **convert_organization(
-                    body, committee_type, ris_data.main_organization
-                ),
-            ).save()
-
-    objects = []
-    for i in ris_data.organizations:
-        objects.append(convert_organization(body, committee_type, i))
+            main_organization = convert_organization(
+                body, committee_type, ris_data.main_organization
+            )
+            for organization in objects:
+                if organization["oparl_id"] == main_organization["oparl_id"]:
+                    organization["id"] = 1
+                    break
+            else:
+                # Like every organization that isn't in the list
+                objects.append({**main_organization, "id": 1, "deleted": True})
 
-    incremental_import(models.Organization, objects)
+    incremental_import(models.Organization, objects, plan=plan)
 
 
 def import_paper_files(
-    ris_data: RisData, paper_id_map: Dict[int, int], file_id_map: Dict[int, int]
+    ris_data: RisData,
+    paper_id_map: Dict[int, int],
+    file_id_map: Dict[int, int],
+    plan: ChangePlan,
 ):
     logger.info("Processing the file-paper-associations")
 
@@ -655,35 +678,58 @@ def import_paper_files(
         if str(i.original_id) not in manually_deleted:
             objects.append(convert_file_to_paper(i, file_id_map, paper_id_map))
 
-    incremental_import(models.Paper.files.through, objects, soft_delete=False)
+    incremental_import(
+        models.Paper.files.through, objects, soft_delete=False, plan=plan
+    )
 
 
-def import_papers(ris_data: RisData):
+def import_papers(ris_data: RisData, plan: ChangePlan):
     logger.info(f"Importing {len(ris_data.papers)} paper")
 
     # Heuristic to determine the sort date:
     # If there are consultations, use the date of the first consultation,
     # otherwise fall back to the year and month from the scraper (which
     # uses the date from the search)
-    meetings = {meeting.original_id: meeting for meeting in ris_data.meetings}
+    meeting_starts = {
+        meeting.original_id: meeting.start for meeting in ris_data.meetings
+    }
     consultations = dict()
     for agenda_item in ris_data.agenda_items:
         paper_id = agenda_item.paper_original_id
         if paper_id in consultations:
             # We want the first consultation
             consultations[paper_id] = min(
-                consultations[paper_id], meetings[agenda_item.meeting_id].start
+                consultations[paper_id], meeting_starts[agenda_item.meeting_id]
             )
         else:
-            consultations[paper_id] = meetings[agenda_item.meeting_id].start
+            consultations[paper_id] = meeting_starts[agenda_item.meeting_id]
 
+    paper_types = import_paper_types(ris_data, plan)
     incremental_import(
-        models.Paper, [convert_paper(i, consultations) for i in ris_data.papers]
+        models.Paper,
+        [convert_paper(i, consultations, paper_types) for i in ris_data.papers],
+        plan=plan,
     )
 
 
-def import_files(ris_data: RisData):
+def import_paper_types(
+    ris_data: RisData, plan: ChangePlan
+) -> Dict[str, Union[int, Ref]]:
+    """Creates the missing paper types at once and returns the ids of all of them"""
+    paper_types = dict(plan.values_list(models.PaperType.objects, "paper_type"))
+    missing = {i.paper_type for i in ris_data.papers if i.paper_type} - set(paper_types)
+    if missing:
+        paper_types_plan = ModelPlan(models.PaperType, ["paper_type"])
+        paper_types_plan.create = [{"paper_type": i} for i in sorted(missing)]
+        plan.add(paper_types_plan)
+        paper_types = dict(plan.values_list(models.PaperType.objects, "paper_type"))
+    return paper_types
+
+
+def import_files(ris_data: RisData, plan: ChangePlan):
     logger.info(f"Importing {len(ris_data.files)} files")
 
-    incremental_import(models.File, [convert_file(i) for i in ris_data.files])
+    incremental_import(
+        models.File, [convert_file(i) for i in ris_data.files], plan=plan
+    )
     # TODO: Move deleted files to a deleted bucket
@@ -0,0 +1,470 @@
+"""The changes of `import_json`, which can be planned without writing and applied later.
+
+Planning reads the database and the json dump and collects the rows to create,
+update and delete for every model. Rows referencing rows that the same plan
+creates hold a `Ref`, which is resolved to the id when the plan is applied.
+
+A plan is either applied right away model by model (the normal import) or
+written to a file and applied by `import_json --apply`. Applying writes every
+model in short transactions of `IMPORTER_JSON_UPDATE_BATCH_SIZE` rows.
+"""
+
+import itertools
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime, date
+from pathlib import Path
+from typing import (
+    Dict,
+    Type,
+    List,
+    Tuple,
+    Any,
+    Optional,
+    Set,
+    Iterable,
+    Iterator,
+    TextIO,
+)
+
+import attr
+import django.db.models
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction, connection
+from django.db.models import Q
+from django.utils import timezone
+from django_elasticsearch_dsl.registries import registry
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
+from tqdm import tqdm
+
+from mainapp import models
+from mainapp.functions.search import search_bulk_index
+from mainapp.models import DefaultFields
+
+logger = logging.getLogger(__name__)
+
+plan_format_version = 1
+
+# The fields by which later phases look up the rows of a model, so we remember
+# these for the rows that are only planned
+ref_fields: Dict[Type[django.db.models.Model], List[str]] = {
+    models.Consultation: ["meeting_id", "paper_id"],
+    models.File: ["oparl_id"],
+    models.Location: ["description"],
+    models.Meeting: ["oparl_id", "name", "start"],
+    models.Organization: ["oparl_id", "name"],
+    models.Paper: ["oparl_id"],
+    models.PaperType: ["paper_type"],
+    models.Person: ["name"],
+}
+
+
+@attr.frozen()
+class Ref:
+    """A row that doesn't exist yet, identified by the values of some of its fields"""
+
+    model: str
+    key: Tuple[Tuple[str, Any], ...]
+
+
+class ModelPlan:
+    """The changes to the rows of one model, which are applied in the order of the
+    attributes"""
+
+    def __init__(
+        self,
+        model: Type[django.db.models.Model],
+        key_fields: List[str],
+        soft_delete: bool = True,
+        history: bool = False,
+    ):
+        self.model = model
+        # The fields that identify a row
+        self.key_fields = key_fields
+        self.soft_delete = soft_delete
+        # Whether created rows get history records
+        self.history = history
+        # Changed fields that are applied before the others, e.g. the start of a
+        # meeting that is part of its unique key
+        self.renames: List[Tuple[int, Dict[str, Any]]] = []
+        self.undelete: List[int] = []
+        self.delete: List[int] = []
+        self.create: List[Dict[str, Any]] = []
+        self.update: List[Tuple[Dict[str, Any], int]] = []
+
+
+class ChangePlan:
+    """Collects the changes of all phases of an import.
+
+    Without a `path`, every model is applied as soon as its changes are
+    planned. With a `path`, the changes are written to that file, and the
+    lookups of later phases return a `Ref` for the rows that are only planned.
+    """
+
+    def __init__(self, path: Optional[Path] = None, body_id: Optional[int] = None):
+        self.fp: Optional[TextIO] = None
+        if path:
+            self.fp = path.open("w")
+            header = {"format_version": plan_format_version, "body": body_id}
+            self.fp.write(json.dumps(header) + "\n")
+        self.created: Dict[Type[django.db.models.Model], List[Tuple]] = defaultdict(
+            list
+        )
+        self.undeleted: Dict[Type[django.db.models.Model], Set[int]] = defaultdict(set)
+        self.deleted: Dict[Type[django.db.models.Model], Set[int]] = defaultdict(set)
+        # The renamed and updated values of the `ref_fields` of existing rows by id
+        self.changed: Dict[
+            Type[django.db.models.Model], Dict[int, Dict[str, Any]]
+        ] = defaultdict(dict)
+
+    def add(self, model_plan: ModelPlan) -> None:
+        if not self.fp:
+            apply_model_plan(model_plan)
+            return
+
+        write_model_plan(self.fp, model_plan)
+        model = model_plan.model
+        self.undeleted[model].update(model_plan.undelete)
+        self.deleted[model].update(model_plan.delete)
+        if model in ref_fields:
+            for record in model_plan.create:
+                self.created[model].append(
+                    tuple(record.get(field) for field in ref_fields[model])
+                )
+            changes = model_plan.renames + [
+                (pk, record) for record, pk in model_plan.update
+            ]
+            for pk, record in changes:
+                values = {
+                    field: record[field]
+                    for field in ref_fields[model]
+                    if field in record
+                }
+                if values:
+                    self.changed[model].setdefault(pk, dict()).update(values)
+
+    def close(self) -> None:
+        if self.fp:
+            self.fp.close()
+
+    def __enter__(self) -> "ChangePlan":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def values_list(
+        self, queryset: django.db.models.QuerySet, *fields: str
+    ) -> Iterator[Tuple]:
+        """Like `queryset.values_list(*fields, "id")`, but as if the planned
+        changes had been applied, with a `Ref` as id of the planned rows.
+
+        Planned rows with a null value in one of the fields are left out."""
+        model = queryset.model
+        undeleted = self.undeleted[model]
+        deleted = self.deleted[model]
+        changed = self.changed[model]
+        rows: Iterable[Tuple] = queryset.values_list(*fields, "id").iterator(
+            chunk_size=2000
+        )
+        if undeleted:
+            undeleted_rows = model.objects_with_deleted.filter(pk__in=undeleted)
+            rows = itertools.chain(rows, undeleted_rows.values_list(*fields, "id"))
+        for row in rows:
+            pk = row[-1]
+            if pk in deleted:
+                continue
+            if pk in changed:
+                values = zip(fields, row[:-1])
+                row = tuple(changed[pk].get(field, value) for field, value in values)
+                row += (pk,)
+            yield row
+        for created in self.created[model]:
+            values = tuple(created[ref_fields[model].index(field)] for field in fields)
+            if None not in values:
+                yield values + (Ref(model._meta.label, tuple(zip(fields, values))),)
+
+
+def resolve(refs: Set[Ref]) -> Dict[Ref, int]:
+    """Looks up the ids of rows that have been created by now, with one query per
+    model and set of fields"""
+    inner = {value for ref in refs for _, value in ref.key if isinstance(value, Ref)}
+    inner_ids = resolve(inner) if inner else dict()
+
+    groups: Dict[Tuple[str, Tuple[str, ...]], Dict[Tuple, Ref]] = defaultdict(dict)
+    for ref in refs:
+        fields = tuple(field for field, _ in ref.key)
+        values = tuple(inner_ids.get(value, value) for _, value in ref.key)
+        groups[(ref.model, fields)][values] = ref
+
+    ids = dict()
+    for (label, fields), wanted in groups.items():
+        model = apps.get_model(label)
+        rows = model.objects.filter(
+            **{fields[0] + "__in": {values[0] for values in wanted}}
+        ).values_list(*fields, "id")
+        for row in rows:
+            if row[:-1] in wanted:
+                ids[wanted[row[:-1]]] = row[-1]
+        missing = [ref for ref in wanted.values() if ref not in ids]
+        if missing:
+            raise RuntimeError(f"{len(missing)} planned rows are missing: {missing}")
+    return ids
+
+
+def resolve_records(records: Iterable[Dict[str, Any]]) -> None:
+    """Replaces the refs in the records by the ids of the rows"""
+    refs = {
+        value
+        for record in records
+        for value in record.values()
+        if isinstance(value, Ref)
+    }
+    if not refs:
+        return
+    ids = resolve(refs)
+    for record in records:
+        for field, value in record.items():
+            if isinstance(value, Ref):
+                record[field] = ids[value]
+
+
+def get_ids_by_key(
+    current_model: Type[django.db.models.Model], fields: List[str], keys: Set[Tuple]
+) -> List[int]:
+    """Finds the ids of rows by their unique key, for databases that don't return
+    the ids of bulk inserted rows.
+
+    Only the rows matching the first key field are read, not the whole table"""
+    if not keys:
+        return []
+    first_values = {key[0] for key in keys}
+    condition = Q(**{fields[0] + "__in": first_values - {None}})
+    if None in first_values:
+        condition |= Q(**{fields[0] + "__isnull": True})
+    db_value_list = current_model.objects.filter(condition).values_list("id", *fields)
+    return [
+        db_entry[0]
+        for db_entry in db_value_list.iterator(chunk_size=2000)
+        if db_entry[1:] in keys
+    ]
+
+
+def batches(items: List, desc: str) -> Iterator[List]:
+    batch_size = settings.IMPORTER_JSON_UPDATE_BATCH_SIZE
+    for start in tqdm(
+        range(0, len(items), batch_size), disable=len(items) <= batch_size, desc=desc
+    ):
+        yield items[start : start + batch_size]
+
+
+def create_rows(model_plan: ModelPlan) -> List[int]:
+    """Bulk creates the planned rows in batches and returns their ids"""
+    current_model = model_plan.model
+    created_ids = []
+    for batch in batches(model_plan.create, f"Create {current_model.__name__}"):
+        resolve_records(batch)
+        instances = [current_model(**record) for record in batch]
+        with transaction.atomic():
+            if model_plan.history:
+                bulk_create_with_history(instances, current_model)
+            else:
+                current_model.objects.bulk_create(instances, batch_size=100)
+        if connection.features.can_return_rows_from_bulk_insert:
+            created_ids.extend(instance.pk for instance in instances)
+        else:
+            fields = model_plan.key_fields
+            keys = {tuple(record.get(i) for i in fields) for record in batch}
+            created_ids.extend(get_ids_by_key(current_model, fields, keys))
+    return created_ids
+
+
+def update_changed(
+    current_model: Type[django.db.models.Model],
+    to_be_updated: List[Tuple[Dict[str, Any], int]],
+) -> List[int]:
+    """Applies the changed records with one bulk update per batch, each batch in its
+    own short transaction, and returns the ids of the updated rows.
+
+    The rows of a batch are loaded first, so that the fields missing in the json and
+    the history records keep their current values."""
+    if issubclass(current_model, DefaultFields):
+        manager = current_model.objects_with_deleted
+    else:
+        manager = current_model.objects
+    updated_ids = []
+    for batch in batches(to_be_updated, f"Update {current_model.__name__}"):
+        resolve_records([json_object for json_object, _ in batch])
+        instances = manager.in_bulk([pk for _, pk in batch])
+        update_fields = set()
+        for json_object, pk in batch:
+            for field, value in json_object.items():
+                setattr(instances[pk], field, value)
+            update_fields.update(json_object.keys())
+
+        with transaction.atomic():
+            if issubclass(current_model, DefaultFields):
+                now = timezone.now()
+                for instance in instances.values():
+                    instance.modified = now
+                bulk_update_with_history(
+                    list(instances.values()),
+                    current_model,
+                    sorted(update_fields | {"modified"}),
+                    manager=manager,
+                )
+            else:
+                manager.bulk_update(list(instances.values()), sorted(update_fields))
+        updated_ids.extend(instances.keys())
+    return updated_ids
+
+
+def apply_model_plan(model_plan: ModelPlan) -> None:
+    current_model = model_plan.model
+    name = current_model.__name__
+    if issubclass(current_model, DefaultFields):
+        manager = current_model.objects_with_deleted
+    else:
+        manager = current_model.objects
+
+    if model_plan.renames:
+        with transaction.atomic():
+            for pk, fields in model_plan.renames:
+                manager.filter(pk=pk).update(**fields)
+
+    for batch in batches(model_plan.undelete, f"Undelete {name}"):
+        manager.filter(pk__in=batch).update(deleted=False)
+
+    # We need to delete first and then create to avoid conflicts e.g. when the start of a meeting with an oparl_id
+    # changed
+    for batch in batches(model_plan.delete, f"Delete {name}"):
+        if model_plan.soft_delete:
+            current_model.objects.filter(id__in=batch).update(
+                deleted=True, modified=timezone.now()
+            )
+        else:
+            current_model.objects.filter(id__in=batch).delete()
+    # TODO: Delete files
+
+    created_ids = create_rows(model_plan)
+    updated_ids = update_changed(current_model, model_plan.update)
+
+    # Bulk operations don't update the search index, so we do this manually
+    if settings.ELASTICSEARCH_ENABLED and current_model in registry.get_models():
+        changed_ids = set(created_ids + updated_ids + model_plan.undelete)
+        if changed_ids:
+            logger.info(f"Indexing {len(changed_ids)} {name}")
+            search_bulk_index(
+                current_model, current_model.objects.filter(pk__in=changed_ids)
+            )
+        if model_plan.soft_delete and model_plan.delete:
+            logger.info(f"Deleting {len(model_plan.delete)} {name} from elasticsearch")
+            search_bulk_index(
+                current_model,
+                current_model.objects_with_deleted.filter(pk__in=model_plan.delete),
+                action="delete",
+            )
+
+
+def encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"datetime": value.isoformat()}
+    if isinstance(value, date):
+        return {"date": value.isoformat()}
+    if isinstance(value, Ref):
+        return {"ref": value.model, "key": [list(i) for i in value.key]}
+    raise TypeError(f"Can't encode {value!r}")
+
+
+def decode_value(value: Dict[str, Any]) -> Any:
+    if value.keys() == {"datetime"}:
+        return datetime.fromisoformat(value["datetime"])
+    if value.keys() == {"date"}:
+        return date.fromisoformat(value["date"])
+    if value.keys() == {"ref", "key"}:
+        return Ref(value["ref"], tuple(tuple(i) for i in value["key"]))
+    return value
+
+
+def write_model_plan(fp: TextIO, model_plan: ModelPlan) -> None:
+    """Writes one line per change, so that the plan can be read back one model at a
+    time"""
+
+    def write(line: Any):
+        fp.write(json.dumps(line, default=encode_value) + "\n")
+
+    write(
+        {
+            "model": model_plan.model._meta.label,
+            "key_fields": model_plan.key_fields,
+            "soft_delete": model_plan.soft_delete,
+            "history": model_plan.history,
+        }
+    )
+    for pk, fields in model_plan.renames:
+        write(["rename", pk, fields])
+    if model_plan.undelete:
+        write(["undelete", model_plan.undelete])
+    if model_plan.delete:
+        write(["delete", model_plan.delete])
+    for record in model_plan.create:
+        write(["create", record])
+    for record, pk in model_plan.update:
+        write(["update", pk, record])
+
+
+def read_plan(path: Path) -> Tuple[Dict[str, Any], Iterator[ModelPlan]]:
+    """Returns the header and the plans of the models"""
+    fp = path.open()
+    header = json.loads(fp.readline())
+    if header.get("format_version") != plan_format_version:
+        fp.close()
+        raise ValueError(
+            f"Plan format version {header.get('format_version')} is not supported,"
+            f" expected {plan_format_version}"
+        )
+
+    def model_plans() -> Iterator[ModelPlan]:
+        with fp:
+            model_plan = None
+            for line in fp:
+                entry = json.loads(line, object_hook=decode_value)
+                if isinstance(entry, dict):
+                    if model_plan:
+                        yield model_plan
+                    model_plan = ModelPlan(
+                        apps.get_model(entry["model"]),
+                        entry["key_fields"],
+                        entry["soft_delete"],
+                        entry["history"],
+                    )
+                elif entry[0] == "rename":
+                    model_plan.renames.append((entry[1], entry[2]))
+                elif entry[0] == "undelete":
+                    model_plan.undelete.extend(entry[1])
+                elif entry[0] == "delete":
+                    model_plan.delete.extend(entry[1])
+                elif entry[0] == "create":
+                    model_plan.create.append(entry[1])
+                elif entry[0] == "update":
+                    model_plan.update.append((entry[2], entry[1]))
+            if model_plan:
+                yield model_plan
+
+    return header, model_plans()
+
+
+def apply_plan(path: Path) -> Dict[str, Any]:
+    """Applies a plan file model by model and returns its header"""
+    header, model_plans = read_plan(path)
+    for model_plan in model_plans:
+        logger.info(
+            f"{model_plan.model.__name__}: "
+            f"Deleting {len(model_plan.delete)}, "
+            f"Creating {len(model_plan.create)} and "
+            f"Updating {len(model_plan.update)}"
+        )
+        apply_model_plan(model_plan)
+    return header
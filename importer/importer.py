@@ -1,30 +1,43 @@
 import logging
 import sys
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import threading
+import time
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    Future,
+    wait,
+    FIRST_COMPLETED,
+)
+from contextlib import nullcontext
 from tempfile import NamedTemporaryFile
-from typing import Optional, List, Type, Tuple
-from typing import TypeVar, Any
-from urllib.parse import parse_qs, urlparse
+from typing import Optional, List, Type, Tuple, Set, Iterable, Dict
+from typing import TypeVar, Any, IO
 
 from django import db
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
-from django.db import IntegrityError, transaction, DatabaseError
+from django.db import IntegrityError, DatabaseError, transaction
+from django.db.models import F, Q, Sum
 from django.template.defaultfilters import filesizeformat
 from django.utils import timezone
 from django.utils.translation import gettext as _
+from django_elasticsearch_dsl.registries import registry
 from elasticsearch import ElasticsearchException
 from requests import RequestException
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
 from tqdm import tqdm
 
-from importer import JSON
-from importer.functions import externalize
+from importer import JSON, instrumentation
+from importer.functions import externalize, hash_json
 from importer.json_to_db import JsonToDb
-from importer.loader import BaseLoader
-from importer.models import CachedObject, ExternalList
+from importer.list_walker import ListWalker
+from importer.loader import BaseLoader, FileDownload, FileTooLarge
+from importer.models import CachedObject, ExternalList, ImportRun, ImportProgress
 from mainapp.functions.document_parsing import (
     extract_from_file,
+    is_extractable,
     extract_locations,
     extract_persons,
     AddressPipeline,
@@ -32,6 +45,7 @@ from mainapp.functions.document_parsing import (
     limit_memory,
 )
 from mainapp.functions.minio import minio_client, minio_file_bucket
+from mainapp.functions.search import search_bulk_index
 from mainapp.models import (
     LegislativeTerm,
     Location,
@@ -49,9 +63,44 @@ from mainapp.models import (
 
 logger = logging.getLogger(__name__)
 
+# Guards the files claimed by the concurrent updates of multiple bodies
+claimed_files_lock = threading.Lock()
+# The list of bodies and the organization types are shared by all bodies, so
+# only one body at a time may write them
+shared_objects_lock = threading.Lock()
+
 
 class Importer:
     lists = ["paper", "person", "meeting", "organization"]
+    # The order of the import after the bodies, legislative terms and locations
+    import_plan = [
+        File,
+        Person,
+        Organization,
+        Membership,
+        Meeting,
+        Paper,
+        Consultation,
+        AgendaItem,
+    ]
+    # The types that the objects of a type reference (besides bodies and locations),
+    # which need to be imported first
+    import_dependencies = {
+        File: [],
+        Person: [],
+        Organization: [],
+        Membership: [Person, Organization],
+        Meeting: [File, Person, Organization],
+        Paper: [File, Person, Organization],
+        Consultation: [Meeting, Paper],
+        AgendaItem: [File, Meeting, Consultation],
+    }
+    # Types whose objects reference objects of the same type (Paper.change_request_of).
+    # Their chunks are imported one after another, so that a chunk never waits
+    # for the rows of another chunk that isn't committed yet
+    serial_types = {Paper}
+    # How many cached objects are written at once while fetching a list
+    cached_object_batch_size = 1000
 
     def __init__(
         self,
@@ -62,6 +111,16 @@ class Importer:
         force_singlethread: bool = False,
     ):
         self.force_singlethread = force_singlethread
+        # How many objects are read and imported at once
+        self.import_chunk_size = settings.IMPORTER_CHUNK_SIZE
+        # The peak memory usage of the process in bytes while each type was imported
+        self.memory_peak: Dict[str, int] = dict()
+        # Whether the peak is reset for each type, otherwise it is the peak so far
+        self.memory_peak_resettable = True
+        # The checkpointed import run of import_objects
+        self.import_run: Optional[ImportRun] = None
+        # If set, only the cached objects from the lists of this body are imported
+        self.import_body: Optional[str] = None
         self.ignore_modified = ignore_modified
         self.download_files = download_files
 
@@ -83,60 +142,212 @@ class Importer:
 
     def fetch_lists_initial(self, bodies: List[JSON]) -> None:
         all_lists = []
+        list_bodies = []
         for body_entry in bodies:
             for list_type in self.lists:
                 all_lists.append(body_entry[list_type])
-
-        if not self.force_singlethread:
-            # These lists are implemented so extremely slow that this brings a leap in performance
-            with ThreadPoolExecutor() as executor:
-                list(executor.map(self.fetch_list_initial, all_lists))
-        else:
-            for external_list in all_lists:
-                self.fetch_list_initial(external_list)
+                list_bodies.append(body_entry["id"])
+
+        with instrumentation.timer("fetch_lists"):
+            if not self.force_singlethread:
+                # These lists are implemented so extremely slow that this brings a leap in performance
+                workers = settings.IMPORTER_MAX_REQUESTS_PER_HOST
+                with ThreadPoolExecutor(workers) as executor:
+                    list(executor.map(self.fetch_list_initial, all_lists, list_bodies))
+            else:
+                for external_list, body in zip(all_lists, list_bodies):
+                    self.fetch_list_initial(external_list, body)
         logger.info(f"Loading {all_lists} lists was successful")
 
     T = TypeVar("T", bound=DefaultFields)
 
     def import_type(
-        self, type_class: Type[T], update: bool = False
+        self, type_class: Type[T], update: bool = False, keep_instances: bool = False
     ) -> List[T]:  # noqa F821
-        """Import all object of a given type"""
+        """Import all object of a given type.
 
-        type_name = type_class.__name__
-        import_function = self.converter.type_to_function(type_class)
-        related_function = self.converter.type_to_related_function(type_class)
+        The cached objects are read in chunks of `IMPORTER_CHUNK_SIZE`. The
+        imported instances are only returned with `keep_instances`, so that
+        large types don't have to fit into memory at once."""
+        self.reset_memory_peak()
+        chunks = self._get_import_chunks(type_class, update)
 
-        # So couldn't we make this like much faster by using bulk_create and deferring the related_function
-        # after that? Well we could if we were using postgres, because with mysql django doesn't set the
-        # id after saving with bulk save, which means we can't use related_function unless doing
-        # really ugly hacks
+        pbar = None
+        if sys.stdout.isatty() and not settings.TESTING:
+            pbar = tqdm(total=sum(len(chunk) for chunk in chunks))
 
-        all_to_import = CachedObject.objects.filter(
-            to_import=True, oparl_type=type_name
-        ).all()
+        all_instances = []
+        for chunk in chunks:
+            instances = self._import_chunk(type_class, chunk, update, pbar)
+            if keep_instances:
+                all_instances += instances
 
+        if pbar:
+            pbar.close()
+        self.import_missing(type_class)
+        self.log_memory_peak(type_class)
+
+        return all_instances
+
+    def reset_memory_peak(self) -> None:
+        """Starts measuring the peak memory usage of a type"""
+        self.memory_peak_resettable = instrumentation.reset_memory_peak()
+
+    def log_memory_peak(self, type_class: Type[DefaultFields]) -> None:
+        """Records the peak memory usage of the process since the type started.
+        When types are imported concurrently, the measurement also restarts
+        whenever another type starts"""
+        peak = instrumentation.get_memory_peak()
+        self.memory_peak[type_class.__name__] = peak
+        instrumentation.set_value("memory_peak", dict(self.memory_peak))
+        since = "" if self.memory_peak_resettable else " so far"
+        logger.info(
+            f"Imported all {type_class.__name__},"
+            f" peak memory usage{since}: {filesizeformat(peak)}"
+        )
+
+    def _get_import_chunks(
+        self, type_class: Type[DefaultFields], update: bool
+    ) -> List[List[int]]:
+        """Splits the ids of the cached objects to import into chunks"""
+        to_import = CachedObject.objects.filter(
+            to_import=True, oparl_type=type_class.__name__
+        )
+        if self.import_body:
+            # Objects cached before they were tagged with their body are imported by any body
+            to_import = to_import.filter(
+                Q(body=self.import_body) | Q(body__isnull=True)
+            )
+        ids = list(to_import.values_list("id", flat=True))
         logger.info(
             "Importing all {} {} (update={})".format(
-                all_to_import.count(), type_name, update
+                len(ids), type_class.__name__, update
             )
         )
+        if self.import_run:
+            progress, _created = ImportProgress.objects.get_or_create(
+                run=self.import_run, oparl_type=type_class.__name__
+            )
+            progress.total = progress.done + len(ids)
+            progress.save(update_fields=["total"])
+        size = self.import_chunk_size
+        return [ids[i : i + size] for i in range(0, len(ids), size)]
 
-        pbar = None
-        if sys.stdout.isatty() and not settings.TESTING:
-            pbar = tqdm(total=all_to_import.count())
+    def _import_chunk(
+        self,
+        type_class: Type[T],
+        ids: List[int],
+        update: bool,
+        pbar: Optional[tqdm] = None,
+    ) -> List[T]:  # noqa F821
+        """Imports a chunk of cached objects in one transaction, so that
+        `to_import` is cleared for exactly the objects that were saved. The
+        saved objects are only added to the identity map after the commit"""
+        with instrumentation.timer(
+            "import." + type_class.__name__
+        ), self.converter.deferring_missing(type_class):
+            if self.use_bulk_import():
+                try:
+                    return self._import_chunk_bulk(type_class, ids, update, pbar)
+                except IntegrityError as e:
+                    # Another thread imported one of the objects in the meantime
+                    logger.warning(
+                        f"Bulk import of {type_class.__name__} failed, importing"
+                        f" the chunk object by object: {e}"
+                    )
+            with transaction.atomic():
+                return self._import_chunk_single(type_class, ids, update, pbar)
+
+    def import_missing(self, type_class: Type[DefaultFields]) -> None:
+        """Imports the objects that were referenced by `type_class`, but were
+        not part of the external lists, and fixes the references to them"""
+        missing, referrers = self.converter.missing.pop(type_class)
+        if not missing:
+            return
+
+        logger.info(
+            f"Importing {len(missing)} objects missing from the lists,"
+            f" referenced by {type_class.__name__}"
+        )
+        with instrumentation.timer("import_missing." + type_class.__name__):
+            workers = (
+                1
+                if self.force_singlethread
+                else settings.IMPORTER_MAX_REQUESTS_PER_HOST
+            )
+            self.converter.import_missing(missing, self.import_chunk_size, workers)
+            if referrers:
+                self._patch_references(type_class, referrers)
+
+    def _patch_references(
+        self, type_class: Type[DefaultFields], oparl_ids: Set[str]
+    ) -> None:
+        """Sets the foreign keys and many-to-many relations that were left empty
+        because the referenced object was missing, with one bulk update"""
+        import_function = self.converter.type_to_function(type_class)
+        chunk_to_import = list(CachedObject.objects.filter(url__in=oparl_ids))
+        existing = type_class.objects_with_deleted.in_bulk(
+            [to_import.url for to_import in chunk_to_import], field_name="oparl_id"
+        )
+        # Objects that e.g. failed to import have nothing to patch
+        chunk_to_import = [
+            to_import
+            for to_import in chunk_to_import
+            if to_import.url in existing and not existing[to_import.url].deleted
+        ]
+        instances = [existing[to_import.url] for to_import in chunk_to_import]
+        for to_import, instance in zip(chunk_to_import, instances):
+            import_function(to_import.data, instance)
+        foreign_keys = [
+            field.name
+            for field in type_class._meta.concrete_fields
+            if field.is_relation
+        ]
+
+        with transaction.atomic():
+            bulk_update_with_history(
+                instances,
+                type_class,
+                foreign_keys,
+                manager=type_class.objects_with_deleted,
+            )
+            self._set_related_bulk(type_class, chunk_to_import, instances)
+        instrumentation.count(
+            "references_patched." + type_class.__name__, len(instances)
+        )
+
+        if settings.ELASTICSEARCH_ENABLED and type_class in registry.get_models():
+            pks = [instance.pk for instance in instances]
+            search_bulk_index(type_class, type_class.objects.filter(pk__in=pks))
+
+    def _checkpoint(self, type_class: Type[DefaultFields], count: int) -> None:
+        """Records the progress in the same transaction as the chunk"""
+        if self.import_run:
+            ImportProgress.objects.filter(
+                run=self.import_run, oparl_type=type_class.__name__
+            ).update(done=F("done") + count)
+
+    def _import_chunk_single(
+        self,
+        type_class: Type[T],
+        ids: List[int],
+        update: bool,
+        pbar: Optional[tqdm] = None,
+    ) -> List[T]:  # noqa F821
+        type_name = type_class.__name__
+        import_function = self.converter.type_to_function(type_class)
+        related_function = self.converter.type_to_related_function(type_class)
+
+        chunk_to_import = CachedObject.objects.filter(id__in=ids)
+        existing = dict()
+        if update:
+            existing = type_class.objects_with_deleted.in_bulk(
+                chunk_to_import.values_list("url", flat=True), field_name="oparl_id"
+            )
 
         all_instances = []
-        for to_import in all_to_import:
-            if update:
-                instance = (
-                    type_class.objects_with_deleted.filter(
-                        oparl_id=to_import.url
-                    ).first()
-                    or type_class()
-                )
-            else:
-                instance = type_class()
+        for to_import in chunk_to_import:
+            instance = existing.get(to_import.url) or type_class()
             self.converter.init_base(
                 to_import.data, instance, name_fixup=_("[Unknown]")
             )
@@ -146,16 +357,27 @@ class Importer:
                     "sanitize_" + type_name.lower(), instance
                 )
 
+            created = instance.pk is None
             try:
-                instance.save()
+                with transaction.atomic():
+                    instance.save()
+                instrumentation.count(
+                    ("objects_created." if created else "objects_updated.") + type_name
+                )
             except IntegrityError as e:
-                if not e.args[1].startswith("Duplicate entry "):
+                # The object was imported in the meantime, e.g. as dependency of another object
+                imported = type_class.objects_with_deleted.filter(
+                    oparl_id=to_import.url
+                ).first()
+                if not imported:
                     raise
-                else:
-                    logger.warning(
-                        f"Cyclic import with {type_name} {to_import.url} {e.args[0]},"
-                        " ignoring"
-                    )
+                logger.warning(
+                    f"Cyclic import with {type_name} {to_import.url} {e.args[0]},"
+                    " ignoring"
+                )
+                instrumentation.count("objects_skipped." + type_name)
+                instance = imported
+            self.converter.remember(instance)
             if related_function and not instance.deleted:
                 related_function(to_import.data, instance)
             all_instances.append(instance)
@@ -163,34 +385,270 @@ class Importer:
             if pbar:
                 pbar.update()
 
+        chunk_to_import.update(to_import=False)
+        self._checkpoint(type_class, len(all_instances))
+
+        return all_instances
+
+    def use_bulk_import(self) -> bool:
+        """With mysql, django doesn't set the id after bulk_create, which means
+        we can't set the many-to-many relations unless doing really ugly hacks"""
+        return (
+            settings.IMPORTER_BULK_IMPORT
+            and db.connection.features.can_return_rows_from_bulk_insert
+        )
+
+    def _import_chunk_bulk(
+        self,
+        type_class: Type[T],
+        ids: List[int],
+        update: bool,
+        pbar: Optional[tqdm] = None,
+    ) -> List[T]:  # noqa F821
+        """Like `_import_chunk`, but with one bulk_create and one bulk_update per
+        chunk (including the history) and the many-to-many relations written
+        directly to the through tables"""
+        type_name = type_class.__name__
+        import_function = self.converter.type_to_function(type_class)
+
+        chunk_to_import = list(CachedObject.objects.filter(id__in=ids))
+        # Without update, the objects might still exist through cyclic imports
+        existing = type_class.objects_with_deleted.in_bulk(
+            [to_import.url for to_import in chunk_to_import], field_name="oparl_id"
+        )
+
+        instances = []
+        for to_import in chunk_to_import:
+            instance = existing.get(to_import.url) or type_class()
+            self.converter.init_base(
+                to_import.data, instance, name_fixup=_("[Unknown]")
+            )
+            if not instance.deleted:
+                import_function(to_import.data, instance)
+                self.converter.utils.call_custom_hook(
+                    "sanitize_" + type_name.lower(), instance
+                )
+            instances.append(instance)
+
+        # The import functions might have imported some of the objects through retrieve
+        imported_meanwhile = type_class.objects_with_deleted.in_bulk(
+            [instance.oparl_id for instance in instances if not instance.pk],
+            field_name="oparl_id",
+        )
+        for instance in instances:
+            if not instance.pk and instance.oparl_id in imported_meanwhile:
+                logger.warning(
+                    f"Cyclic import with {type_name} {instance.oparl_id}, ignoring"
+                )
+                instance.pk = imported_meanwhile[instance.oparl_id].pk
+                instance.created = imported_meanwhile[instance.oparl_id].created
+
+        to_create = [instance for instance in instances if not instance.pk]
+        to_update = [instance for instance in instances if instance.pk]
+        now = timezone.now()
+        for instance in to_update:
+            instance.modified = now
+        update_fields = [
+            field.name
+            for field in type_class._meta.concrete_fields
+            if not field.primary_key and field.name != "created"
+        ]
+
+        with transaction.atomic():
+            bulk_create_with_history(to_create, type_class)
+            if to_update:
+                bulk_update_with_history(
+                    to_update,
+                    type_class,
+                    update_fields,
+                    manager=type_class.objects_with_deleted,
+                )
+            self._set_related_bulk(type_class, chunk_to_import, instances)
+            CachedObject.objects.filter(id__in=ids).update(to_import=False)
+            self._checkpoint(type_class, len(instances))
+        # Only after the transaction succeeded
+        for instance in instances:
+            self.converter.remember(instance)
+        instrumentation.count("objects_created." + type_name, len(to_create))
+        instrumentation.count("objects_updated." + type_name, len(to_update))
+
+        # Bulk operations don't send the signals that update the search index
+        if settings.ELASTICSEARCH_ENABLED and type_class in registry.get_models():
+            pks = [instance.pk for instance in instances]
+            search_bulk_index(type_class, type_class.objects.filter(pk__in=pks))
+            deleted = type_class.objects_with_deleted.filter(pk__in=pks, deleted=True)
+            if deleted.exists():
+                # These might have never been indexed
+                search_bulk_index(
+                    type_class, deleted, action="delete", raise_on_error=False
+                )
+
         if pbar:
-            pbar.close()
+            pbar.update(len(instances))
 
-        all_to_import.update(to_import=False)
+        return instances
 
-        return all_instances
+    def _set_related_bulk(
+        self,
+        type_class: Type[DefaultFields],
+        chunk_to_import: List[CachedObject],
+        instances: List[DefaultFields],
+    ) -> None:
+        """Replaces the many-to-many relations of the instances"""
+        related_fields = self.converter.type_to_related_fields(type_class)
+        if not related_fields:
+            return
+
+        links: Dict[str, List[Tuple[int, int]]] = {
+            field: [] for field, _related_type, _oparl_key in related_fields
+        }
+        for to_import, instance in zip(chunk_to_import, instances):
+            if instance.deleted:
+                continue
+            related = self.converter.related_objects(to_import.data, type_class)
+            for field, objects in related.items():
+                # dict.fromkeys deduplicates while keeping the order
+                for related_pk in dict.fromkeys(i.pk for i in objects):
+                    links[field].append((instance.pk, related_pk))
+
+        for field, pairs in links.items():
+            m2m_field = type_class._meta.get_field(field)
+            through = m2m_field.remote_field.through
+            source = m2m_field.m2m_field_name() + "_id"
+            target = m2m_field.m2m_reverse_field_name() + "_id"
+            through.objects.filter(
+                **{
+                    source
+                    + "__in": [
+                        instance.pk for instance in instances if not instance.deleted
+                    ]
+                }
+            ).delete()
+            through.objects.bulk_create(
+                [through(**{source: pk, target: related}) for pk, related in pairs]
+            )
+
+    def _import_chunk_in_thread(
+        self, type_class: Type[DefaultFields], ids: List[int], update: bool
+    ) -> None:
+        try:
+            self._import_chunk(type_class, ids, update)
+        finally:
+            # Every thread has its own connection, which django doesn't close for us
+            db.connection.close()
 
     def import_bodies(self, update: bool = False) -> List[Body]:
         self.import_type(LegislativeTerm, update)
         self.import_type(Location, update)
-        return self.import_type(Body, update)
+        return self.import_type(Body, update, keep_instances=True)
 
     def import_objects(self, update: bool = False) -> None:
-        import_plan = [
-            File,
-            Person,
-            Organization,
-            Membership,
-            Meeting,
-            Paper,
-            Consultation,
-            AgendaItem,
-        ]
+        """Imports all types after the bodies.
+
+        A type is imported as soon as all types it references are imported,
+        so independent types are imported concurrently, each split into
+        chunks that are processed by a pool of `IMPORTER_IMPORT_WORKERS` threads.
+        The chunks of `serial_types` are imported one after another.
+
+        Every chunk is committed together with the progress of the import run,
+        so after a crash, the next call resumes with the remaining objects.
+        """
+        self.import_run = self.start_import_run(update)
+        with instrumentation.timer("import_objects"):
+            if self.force_singlethread:
+                for type_class in self.import_plan:
+                    self.import_type(type_class, update)
+            else:
+                self._import_objects_concurrently(update)
+        self.import_run.finished = timezone.now()
+        self.import_run.save(update_fields=["finished"])
+        self.import_run = None
 
-        for type_class in import_plan:
-            self.import_type(type_class, update)
         logger.info("Object import was successful")
 
+    def start_import_run(self, update: bool) -> ImportRun:
+        """Resumes the last unfinished import run of the body or starts a new one.
+
+        A run that was an update while this isn't one (or the other way round) can't be
+        resumed, so it is abandoned by marking it as finished."""
+        body = self.converter.default_body
+        body_oparl_id = body.oparl_id if body else None
+        import_run = (
+            ImportRun.objects.filter(body_oparl_id=body_oparl_id, finished=None)
+            .order_by("-started")
+            .first()
+        )
+        if import_run and import_run.update != update:
+            logger.warning(
+                f"Abandoning the import run started {import_run.started}"
+                f" (update: {import_run.update}) to start one with update: {update}"
+            )
+            import_run.finished = timezone.now()
+            import_run.save(update_fields=["finished"])
+            import_run = None
+        if not import_run:
+            return ImportRun.objects.create(body_oparl_id=body_oparl_id, update=update)
+
+        progress = ", ".join(str(i) for i in import_run.progress.order_by("id"))
+        logger.info(
+            f"Resuming the import run started {import_run.started}: {progress or '-'}"
+        )
+        return import_run
+
+    def _import_objects_concurrently(self, update: bool) -> None:
+        done: Set[Type[DefaultFields]] = set()
+        started: Set[Type[DefaultFields]] = set()
+        remaining_chunks: Dict[Type[DefaultFields], int] = dict()
+        # The chunks of the serial types that wait for the previous chunk
+        queued_chunks: Dict[Type[DefaultFields], List[List[int]]] = dict()
+        running: Dict[Future, Type[DefaultFields]] = dict()
+
+        with ThreadPoolExecutor(settings.IMPORTER_IMPORT_WORKERS) as executor:
+
+            def submit(type_class: Type[DefaultFields], chunk: List[int]) -> None:
+                future = executor.submit(
+                    self._import_chunk_in_thread, type_class, chunk, update
+                )
+                running[future] = type_class
+
+            try:
+                while len(done) < len(self.import_plan):
+                    for type_class in self.import_plan:
+                        if type_class in started:
+                            continue
+                        if not set(self.import_dependencies[type_class]) <= done:
+                            continue
+                        started.add(type_class)
+                        self.reset_memory_peak()
+                        chunks = self._get_import_chunks(type_class, update)
+                        remaining_chunks[type_class] = len(chunks)
+                        if type_class in self.serial_types:
+                            queued_chunks[type_class] = chunks[1:]
+                            chunks = chunks[:1]
+                        for chunk in chunks:
+                            submit(type_class, chunk)
+
+                    # Types without objects are done right away
+                    for type_class in started - done:
+                        if remaining_chunks[type_class] == 0:
+                            done.add(type_class)
+                            self.import_missing(type_class)
+                            self.log_memory_peak(type_class)
+                    if not running:
+                        continue
+
+                    finished = wait(running.keys(), return_when=FIRST_COMPLETED)
+                    for future in finished.done:
+                        type_class = running.pop(future)
+                        future.result()
+                        remaining_chunks[type_class] -= 1
+                        if queued_chunks.get(type_class):
+                            submit(type_class, queued_chunks[type_class].pop(0))
+            except BaseException:
+                for future in running:
+                    future.cancel()
+                raise
+
     def load_bodies(self, single_body_id: Optional[str] = None) -> List[CachedObject]:
         self.fetch_list_initial(self.loader.system["body"])
         if single_body_id:
@@ -204,63 +662,98 @@ class Importer:
             )
         return bodies
 
-    def fetch_list_initial(self, url: str) -> None:
-        """Saves a complete external list as flattened json to the database"""
+    def get_list_walker(self) -> ListWalker:
+        if self.force_singlethread:
+            return ListWalker(self.loader, prefetch=0)
+        else:
+            return ListWalker(self.loader)
+
+    def fetch_list_initial(self, url: str, body: Optional[str] = None) -> None:
+        """Saves a complete external list as flattened json to the database.
+
+        `body` is the oparl id of the body the list belongs to"""
         logger.info(f"Fetching List {url}")
 
         timestamp = timezone.now()
-        next_url = url
-        all_objects = set()
-        while next_url:
-            logger.info(f"Fetching {next_url}")
-            response = self.loader.load(next_url)
-
+        # Only the urls, so we don't keep the data of the whole list in memory
+        all_urls: Set[str] = set()
+        for response in self.get_list_walker().walk(url):
             objects = set()
 
             for element in response["data"]:
                 externalized = externalize(element)
                 for i in externalized:
-                    if not i.data.get("deleted") and i not in all_objects:
+                    if not i.data.get("deleted") and i.url not in all_urls:
                         objects.update(externalized)
 
-            next_url = response["links"].get("next")
-
-            # We can't have the that block outside the loop due to mysql's max_allowed_packet, manifesting
-            # "MySQL server has gone away" https://stackoverflow.com/a/36637118/3549270
-            # We'll be able to solve this a lot better after the django 2.2 update with ignore_conflicts
-            try:
-                # Also avoid "MySQL server has gone away" errors due to timeouts
-                # https://stackoverflow.com/a/32720475/3549270
-                db.close_old_connections()
-                # The test are run with sqlite, which failed here with a TransactionManagementError:
-                # "An error occurred in the current transaction.
-                # You can't execute queries until the end of the 'atomic' block."
-                # That's why we build our own atomic block
-                if settings.TESTING:
-                    with transaction.atomic():
-                        saved_objects = CachedObject.objects.bulk_create(objects)
-                else:
-                    saved_objects = CachedObject.objects.bulk_create(objects)
-            except IntegrityError:
-                saved_objects = set()
-                for i in objects:
-                    defaults = {
-                        "data": i.data,
-                        "to_import": True,
-                        "oparl_type": i.oparl_type,
-                    }
-                    saved_objects.add(
-                        CachedObject.objects.update_or_create(
-                            url=i.url, defaults=defaults
-                        )[0]
-                    )
+                # Streamed pages can be arbitrarily large
+                if len(objects) >= self.cached_object_batch_size:
+                    all_urls.update(self._save_cached_objects(objects, body=body))
+                    objects = set()
 
-            all_objects.update(saved_objects)
-        logger.info(f"Found {len(all_objects)} objects in {url}")
+            all_urls.update(self._save_cached_objects(objects, body=body))
+        logger.info(f"Found {len(all_urls)} objects in {url}")
         ExternalList(url=url, last_update=timestamp).save()
 
-    def fetch_list_update(self, url: str) -> List[str]:
-        """Saves a complete external list as flattened json to the database"""
+    def _get_content_hashes(self, urls: Iterable[str]) -> Dict[str, Optional[str]]:
+        """Fetches the hashes of the cached objects in one query, without transferring the data"""
+        return dict(
+            CachedObject.objects.filter(url__in=urls).values_list("url", "content_hash")
+        )
+
+    def _save_cached_objects(
+        self,
+        objects: Iterable[CachedObject],
+        existing: Optional[Dict[str, Optional[str]]] = None,
+        body: Optional[str] = None,
+    ) -> Set[str]:
+        """Bulk upserts the objects, marking only new and changed ones for import.
+
+        `existing` are the current hashes if the caller already fetched them.
+        `body` is the body whose list contained the objects.
+        Returns the urls of the saved objects"""
+        objects = {i.url: i for i in objects}
+        if not objects:
+            return set()
+
+        # Also avoid "MySQL server has gone away" errors due to timeouts
+        # https://stackoverflow.com/a/32720475/3549270
+        db.close_old_connections()
+
+        if existing is None:
+            existing = self._get_content_hashes(objects.keys())
+        changed = []
+        for url, instance in objects.items():
+            # Rows from before the hash was introduced count as changed
+            if url in existing and existing[url] == instance.content_hash:
+                continue
+            instance.to_import = True
+            instance.body = body
+            changed.append(instance)
+
+        # The batches are small enough for mysql's max_allowed_packet, see
+        # "MySQL server has gone away" https://stackoverflow.com/a/36637118/3549270
+        # mysql (ON DUPLICATE KEY) doesn't allow naming the unique field
+        if db.connection.features.supports_update_conflicts_with_target:
+            unique_fields = ["url"]
+        else:
+            unique_fields = None
+        CachedObject.objects.bulk_create(
+            changed,
+            update_conflicts=True,
+            update_fields=["data", "oparl_type", "content_hash", "to_import", "body"],
+            unique_fields=unique_fields,
+        )
+        logger.debug(f"{len(changed)} of {len(objects)} cached objects changed")
+        instrumentation.count("cached_objects_changed", len(changed))
+        instrumentation.count("cached_objects_unchanged", len(objects) - len(changed))
+
+        return set(objects.keys())
+
+    def fetch_list_update(self, url: str, body: Optional[str] = None) -> List[str]:
+        """Saves a complete external list as flattened json to the database.
+
+        `body` is the oparl id of the body the list belongs to"""
         fetch_later = []
 
         timestamp = timezone.now()
@@ -277,18 +770,17 @@ class Importer:
                 microsecond=0
             ).isoformat()
         }
-        next_url = url
-        while next_url:
-            # Handles both the case where modified_since is given with
-            # the next url and where it isn't
-            if "modified_since" in parse_qs(urlparse(next_url).query):
-                response = self.loader.load(next_url)
-            else:
-                response = self.loader.load(next_url, modified_since_query)
-            for element in response["data"]:
-                fetch_later += self._process_element(element)
-
-            next_url = response["links"].get("next")
+        with instrumentation.timer("fetch_list_update"):
+            walker = self.get_list_walker()
+            for response in walker.walk(url, modified_since_query):
+                elements = []
+                for element in response["data"]:
+                    elements.append(element)
+                    # Streamed pages can be arbitrarily large
+                    if len(elements) >= self.cached_object_batch_size:
+                        fetch_later += self._process_elements(elements, body)
+                        elements = []
+                fetch_later += self._process_elements(elements, body)
 
         external_list.last_update = timestamp
         external_list.save()
@@ -305,65 +797,125 @@ class Importer:
         except ValidationError:
             return False
 
-    def _process_element(self, element: JSON) -> List[str]:
-        keys_of_interest = set()  # type: Set[str]
-        new = list(externalize(element, keys_of_interest))
-        # Find the ids of removed embedded objects
-        # This way is not elegant, but it gets the job done.
-        old_element = CachedObject.objects.filter(url=element["id"]).first()
-        old_urls = set()
-        if old_element:
+    def _process_elements(
+        self, elements: List[JSON], body: Optional[str] = None
+    ) -> List[str]:
+        """Saves the changed objects of a batch of list elements and returns the
+        urls of removed embedded objects, which need to be fetched separately"""
+        if not elements:
+            return []
+
+        new = []
+        externalized_elements = []
+        for element in elements:
+            keys_of_interest = set()  # type: Set[str]
+            externalized = externalize(element, keys_of_interest)
+            new += externalized
+            externalized_elements.append((externalized, keys_of_interest))
+
+        existing = self._get_content_hashes([i.url for i in new])
+
+        # Only changed elements can have removed embedded objects, so we only
+        # need to load their old data. The element itself is externalized last
+        changed_urls = [
+            externalized[-1].url
+            for externalized, _ in externalized_elements
+            if externalized[-1].url in existing
+            and existing[externalized[-1].url] != externalized[-1].content_hash
+        ]
+        old_elements = dict(
+            CachedObject.objects.filter(url__in=changed_urls).values_list("url", "data")
+        )
+
+        removed = set()
+        for externalized, keys_of_interest in externalized_elements:
+            # Find the ids of removed embedded objects
+            # This way is not elegant, but it gets the job done.
+            old_data = old_elements.get(externalized[-1].url)
+            if not old_data:
+                continue
+            old_urls = set()
             for key in keys_of_interest:
-                if isinstance(old_element.data.get(key), list):
-                    old_urls.update(old_element.data[key])
-                elif isinstance(old_element.data.get(key), str):
-                    old_urls.add(old_element.data[key])
-
-        removed = old_urls - {i.url for i in new}
-        fetch_later = CachedObject.objects.filter(url__in=removed).values_list(
-            "url", flat=True
+                if isinstance(old_data.get(key), list):
+                    old_urls.update(old_data[key])
+                elif isinstance(old_data.get(key), str):
+                    old_urls.add(old_data[key])
+            removed.update(old_urls - {i.url for i in externalized})
+
+        fetch_later = list(
+            CachedObject.objects.filter(url__in=removed).values_list("url", flat=True)
         )
-        for instance in new:
-            existing = CachedObject.objects.filter(url=instance.url).first()
-            if existing:
-                if existing.data == instance.data:
-                    continue
-                else:
-                    existing.data = instance.data
-                    existing.to_import = True
-                    existing.save()
-            else:
-                instance.save()
+        self._save_cached_objects(new, existing, body)
         return fetch_later
 
     def update(self, body_id: str) -> None:
-        fetch_later = self.fetch_list_update(self.loader.system["body"])
+        """Updates the objects of one body. The updates of different bodies
+        can run concurrently, since each only imports the objects of its lists"""
+        self.import_body = body_id
+        with shared_objects_lock:
+            fetch_later = self.fetch_list_update(self.loader.system["body"])
 
-        # We only want to import a single body, so we mark the others as already imported
-        CachedObject.objects.filter(to_import=True, oparl_type="Body").exclude(
-            url=body_id
-        ).update(to_import=False)
+            # We only want to import a single body, so we mark the others as already imported
+            CachedObject.objects.filter(to_import=True, oparl_type="Body").exclude(
+                url=body_id
+            ).update(to_import=False)
 
-        self.import_bodies(update=True)
+            self.import_bodies(update=True)
 
         bodies = CachedObject.objects.filter(url=body_id).all()
         for body_entry in bodies:
             for list_type in self.lists:
-                fetch_later += self.fetch_list_update(body_entry.data[list_type])
+                fetch_later += self.fetch_list_update(
+                    body_entry.data[list_type], body_id
+                )
 
         logger.info(f"Importing {len(fetch_later)} removed embedded objects")
-        for later in fetch_later:
-            # We might actually have that object freshly from somewhere else
-            fresh = CachedObject.objects.filter(url=later, to_import=True).exists()
-
-            if not fresh:
-                data = self.loader.load(later)
-                CachedObject.objects.filter(url=later).update(
-                    data=data, oparl_type=data["type"].split("/")[-1], to_import=True
-                )
+        with instrumentation.timer("refetch_removed_embedded"):
+            self.refetch_removed_embedded(fetch_later)
+        instrumentation.count("removed_embedded_objects", len(fetch_later))
 
         self.import_objects(update=True)
 
+    def refetch_removed_embedded(self, urls: List[str]) -> None:
+        """Loads embedded objects that were removed from their parent again,
+        with up to `IMPORTER_MAX_REQUESTS_PER_HOST` concurrent requests, and
+        marks them for import"""
+        # We might actually have some objects freshly from somewhere else
+        fresh = set(
+            CachedObject.objects.filter(url__in=urls, to_import=True).values_list(
+                "url", flat=True
+            )
+        )
+        urls = [url for url in dict.fromkeys(urls) if url not in fresh]
+
+        batch_size = self.cached_object_batch_size
+        batches = [urls[i : i + batch_size] for i in range(0, len(urls), batch_size)]
+        if self.force_singlethread:
+            for batch in batches:
+                self._update_refetched(batch, map(self.loader.load, batch))
+            return
+
+        with ThreadPoolExecutor(settings.IMPORTER_MAX_REQUESTS_PER_HOST) as executor:
+            for batch in batches:
+                self._update_refetched(batch, executor.map(self.loader.load, batch))
+
+    def _update_refetched(self, urls: List[str], loaded: Iterable[JSON]) -> None:
+        cached_objects = CachedObject.objects.in_bulk(urls, field_name="url")
+        changed = []
+        for url, data in zip(urls, loaded):
+            # There is nothing to update for objects that were never cached
+            if url not in cached_objects:
+                continue
+            cached_object = cached_objects[url]
+            cached_object.data = data
+            cached_object.oparl_type = data["type"].split("/")[-1]
+            cached_object.content_hash = hash_json(data)
+            cached_object.to_import = True
+            changed.append(cached_object)
+        CachedObject.objects.bulk_update(
+            changed, ["data", "oparl_type", "content_hash", "to_import"]
+        )
+
     def download_and_analyze_file(
         self, file_id: int, address_pipeline: AddressPipeline, fallback_city: str
     ) -> bool:
@@ -375,58 +927,90 @@ class Importer:
         file = File.objects.get(id=file_id)
         url = file.get_oparl_url()
 
-        with NamedTemporaryFile() as tmp_file:
+        try:
+            chunks, content_type = self.loader.load_file_stream(url)
+        except RequestException as e:
+            self._log_download_error(file, url, e)
+            return False
+        if content_type and file.mime_type and content_type != file.mime_type:
+            logger.warning(
+                "Diverging mime types: Expected {}, got {}".format(
+                    file.mime_type, content_type
+                )
+            )
+        if content_type and content_type.split(";")[0] == "text/html":
+            logger.error(
+                f"File {file.id}: Content type was {content_type}, this seems"
+                " to be a silent error"
+            )
+            chunks.close()
+            return False
+        file.mime_type = content_type or file.mime_type
+
+        # If the api has text, keep that
+        parse = self.download_files and not file.parsed_text
+        if parse and not is_extractable(file.mime_type):
+            logger.warning(
+                f"File {file.id} has an unknown mime type: '{file.mime_type}'"
+            )
+            parse = False
+        # pdftotext needs a path, and the content is only uploaded once its hash shows
+        # that it isn't a duplicate
+        spool = parse or not settings.PROXY_ONLY_TEMPLATE
+        # Whether a previous version of the file is stored under its own id
+        stored = file.filesize is not None and not file.duplicate_of_id
+        with chunks, NamedTemporaryFile() if spool else nullcontext() as tmp_file:
+            download = FileDownload(
+                chunks,
+                settings.IMPORTER_MAX_FILE_SIZE,
+                tmp_file.file if tmp_file else None,
+            )
             try:
-                content, content_type = self.loader.load_file(url)
-                if content_type and file.mime_type and content_type != file.mime_type:
-                    logger.warning(
-                        "Diverging mime types: Expected {}, got {}".format(
-                            file.mime_type, content_type
-                        )
-                    )
-                if content_type and content_type.split(";")[0] == "text/html":
-                    logger.error(
-                        f"File {file.id}: Content type was {content_type}, this seems"
-                        " to be a silent error"
-                    )
-                    return False
-                file.mime_type = content_type or file.mime_type
-                tmp_file.write(content)
-                tmp_file.file.seek(0)
-                file.filesize = len(content)
+                download.consume()
             except RequestException as e:
-                # Normal server error
-                if e.response and 400 <= e.response.status_code < 600:
-                    logger.error(
-                        f"File {file.id}: Failed to download {url} with error"
-                        f" {e.response.status_code}"
-                    )
-                else:
-                    logger.exception(f"File {file.id}: Failed to download {url}")
+                self._log_download_error(file, url, e)
+                return False
+            except FileTooLarge:
+                logger.error(
+                    f"File {file.id}: {url} is larger than"
+                    f" {filesizeformat(settings.IMPORTER_MAX_FILE_SIZE)}, skipping"
+                )
                 return False
+            file.filesize = download.size
+            file.sha256 = download.sha256.hexdigest()
+            if tmp_file:
+                tmp_file.file.flush()
 
             logger.debug(
-                "File {}: Downloaded {} ({}, {})".format(
-                    file.id, url, file.mime_type, filesizeformat(file.filesize)
+                "File {}: Downloaded {} ({}, {}, sha256 {})".format(
+                    file.id,
+                    url,
+                    file.mime_type,
+                    filesizeformat(file.filesize),
+                    file.sha256,
                 )
             )
 
-            if not settings.PROXY_ONLY_TEMPLATE:
-                minio_client().put_object(
-                    minio_file_bucket,
-                    str(file.id),
-                    tmp_file.file,
-                    file.filesize,
-                    content_type=file.mime_type,
+            try:
+                original = self._store_content(
+                    file, tmp_file.file if tmp_file else None
                 )
-
-            # If the api has text, keep that
-            if self.download_files and not file.parsed_text:
+            except DatabaseError as e:
+                logger.exception(f"File {file.id}: Failed to store the content: {e}")
+                return False
+            analysis_reused = False
+            if original:
+                analysis_reused = self._reuse_original(file, original, stored)
+            else:
+                file.duplicate_of = None
+            self._update_duplicates(file)
+            if not original and parse:
+                tmp_file.file.seek(0)
                 file.parsed_text, file.page_count = extract_from_file(
                     tmp_file.file, tmp_file.name, file.mime_type, file.id
                 )
 
-        if file.parsed_text:
+        if file.parsed_text and not analysis_reused:
             locations = extract_locations(
                 file.parsed_text, pipeline=address_pipeline, fallback_city=fallback_city
             )
@@ -440,7 +1024,7 @@ class Importer:
                     file.id, len(locations), len(persons)
                 )
             )
-        else:
+        elif not file.parsed_text:
             logger.warning(f"File {file.id}: Couldn't get any text")
 
         try:
@@ -452,6 +1036,86 @@ class Importer:
 
         return True
 
+    def _store_content(
+        self, file: File, tmp_file: Optional[IO[bytes]]
+    ) -> Optional[File]:
+        """Returns the original with the same content as the file or uploads the
+        content of the file, which makes it the original for that content.
+
+        The original is looked up and claimed in one transaction with the original
+        locked, so that identical files that are downloaded concurrently don't both
+        become originals"""
+        with transaction.atomic():
+            # Originals that wait to be downloaded again still have their content
+            original = (
+                File.objects.select_for_update()
+                .filter(sha256=file.sha256, duplicate_of=None)
+                .exclude(id=file.id)
+                .order_by("id")
+                .first()
+            )
+            if original:
+                return original
+            File.objects.filter(id=file.id).update(
+                sha256=file.sha256, duplicate_of=None
+            )
+            if not settings.PROXY_ONLY_TEMPLATE:
+                tmp_file.seek(0)
+                minio_client().put_object(
+                    minio_file_bucket,
+                    str(file.id),
+                    tmp_file,
+                    file.filesize,
+                    content_type=file.mime_type,
+                )
+        return None
+
+    def _reuse_original(self, file: File, original: File, stored: bool) -> bool:
+        """Points a file to an identical file that was already downloaded, so
+        that the content is only stored once. `stored` is whether a previous
+        version of the file is stored under its own id.
+
+        Returns whether the locations and persons of the original were reused"""
+        logger.info(f"File {file.id}: Identical to file {original.id}")
+        instrumentation.count("files_deduplicated")
+        file.duplicate_of = original
+        if stored and not settings.PROXY_ONLY_TEMPLATE:
+            minio_client().remove_object(minio_file_bucket, str(file.id))
+        # If the api has text, keep that
+        if not file.parsed_text:
+            file.parsed_text = original.parsed_text
+            file.page_count = original.page_count
+        if file.parsed_text != original.parsed_text:
+            return False
+        file.locations.set(original.locations.all())
+        file.mentioned_persons.set(original.mentioned_persons.all())
+        return True
+
+    def _update_duplicates(self, file: File) -> None:
+        """The duplicates of a file share its content, which may have changed or
+        may now be stored as another file"""
+        duplicates = File.objects_with_deleted.filter(duplicate_of=file)
+        changed = duplicates.exclude(sha256=file.sha256).update(
+            duplicate_of=None, filesize=None, parsed_text=None, page_count=None
+        )
+        if changed:
+            logger.info(
+                f"File {file.id}: The content changed, {changed} duplicates will be"
+                " downloaded again"
+            )
+        if file.duplicate_of:
+            duplicates.update(duplicate_of=file.duplicate_of)
+
+    def _log_download_error(self, file: File, url: str, e: RequestException) -> None:
+        # Normal server error
+        if e.response and 400 <= e.response.status_code < 600:
+            logger.error(
+                f"File {file.id}: Failed to download {url} with error"
+                f" {e.response.status_code}"
+            )
+        else:
+            logger.exception(f"File {file.id}: Failed to download {url}")
+
     def load_files_multiprocessing(
         self,
         address_pipeline: AddressPipeline,
@@ -496,9 +1160,13 @@ class Importer:
         fallback_city: str,
         max_workers: Optional[int] = None,
         update: bool = False,
+        claimed_files: Optional[Set[int]] = None,
     ) -> Tuple[int, int]:
         """Downloads and analyses the actual file for the file entries in the database.
 
+        Files in `claimed_files` are skipped and the others are added to it, so
+        that concurrent updates of multiple bodies don't analyse a file twice.
+
         Returns the number of successful and failed files"""
         # This is partially bound by waiting on external resources, but mostly very cpu intensive,
         # so we can spawn a bunch of processes to make this a lot faster.
@@ -508,10 +1176,15 @@ class Importer:
             .order_by("-id")
             .values_list("id", flat=True)
         )
+        if claimed_files is not None:
+            with claimed_files_lock:
+                files = [file for file in files if file not in claimed_files]
+                claimed_files.update(files)
         if not files:
             logger.info("No files to import")
             return 0, 0
         logger.info(f"Downloading and analysing {len(files)} files")
+        start = time.perf_counter()
         address_pipeline = AddressPipeline(create_geoextract_data())
         pbar = None
         if sys.stdout.isatty() and not settings.TESTING:
@@ -546,6 +1219,18 @@ class Importer:
         if pbar:
             pbar.close()
 
+        instrumentation.add_time("load_files", time.perf_counter() - start)
+        instrumentation.count("files_successful", successful)
+        instrumentation.count("files_failed", failed)
+        if instrumentation.is_active():
+            # The files are downloaded by other processes
+            size = self.cached_object_batch_size
+            for batch in [files[i : i + size] for i in range(0, len(files), size)]:
+                downloaded = File.objects.filter(id__in=batch).aggregate(
+                    Sum("filesize")
+                )
+                instrumentation.count("file_bytes", downloaded["filesize__sum"] or 0)
+
         if failed > 0:
             logger.error(f"{failed} files failed to download")
             # not update because these might be files that failed before
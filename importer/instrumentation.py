@@ -0,0 +1,177 @@
+"""Timers and counters for the importer, which are written as a json report.
+
+The importer, the converter and the transport record to the active report
+through the module level functions, which do nothing if no report is active.
+All functions are thread safe, so timers of concurrent chunks add up.
+"""
+
+import cProfile
+import json
+import logging
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Dict, Any, Iterator, Callable
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class RunReport:
+    def __init__(self, command: str):
+        self.command = command
+        self.started = timezone.now()
+        self.lock = threading.Lock()
+        # Seconds per phase, summed over all threads
+        self.timers: Dict[str, float] = defaultdict(float)
+        self.counters: Dict[str, int] = defaultdict(int)
+        # Anything else that belongs into the report, e.g. the peak memory usage
+        self.values: Dict[str, Any] = dict()
+
+    def add_time(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.timers[name] += seconds
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += value
+
+    def set_value(self, name: str, value: Any) -> None:
+        with self.lock:
+            self.values[name] = value
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "command": self.command,
+                "started": self.started.isoformat(),
+                "seconds": (timezone.now() - self.started).total_seconds(),
+                "timers": dict(sorted(self.timers.items())),
+                "counters": dict(sorted(self.counters.items())),
+                **self.values,
+            }
+
+
+_current: Optional[RunReport] = None
+
+
+def is_active() -> bool:
+    return _current is not None
+
+
+def add_time(name: str, seconds: float) -> None:
+    if _current:
+        _current.add_time(name, seconds)
+
+
+def count(name: str, value: int = 1) -> None:
+    if _current:
+        _current.count(name, value)
+
+
+def set_value(name: str, value: Any) -> None:
+    if _current:
+        _current.set_value(name, value)
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+def reset_memory_peak() -> bool:
+    """Resets the peak memory usage of the process, which only works on linux.
+    Returns whether the peak was reset"""
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_memory_peak() -> int:
+    """The peak memory usage of the process in bytes since `reset_memory_peak`,
+    or since the process started if it can't be reset"""
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def count_query(execute: Callable, sql: str, params, many: bool, context):
+    count("db_queries")
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(connection, **kwargs) -> None:
+    """Every thread has its own connections, so we install the counter when they connect"""
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+def get_report_path(command: str) -> Optional[Path]:
+    if not settings.IMPORTER_REPORT_DIR:
+        return None
+    timestamp = timezone.now().strftime("%Y%m%d-%H%M%S")
+    return Path(settings.IMPORTER_REPORT_DIR).joinpath(f"{command}-{timestamp}.json")
+
+
+@contextmanager
+def run_report(
+    command: str, path: Optional[Path] = None, profile: Optional[Path] = None
+) -> Iterator[RunReport]:
+    """Makes a report the active one and writes it to `path` (or into
+    `IMPORTER_REPORT_DIR`) when the run is finished, even if it failed.
+
+    With `profile`, the current thread is profiled with cProfile and the
+    stats are dumped there."""
+    global _current
+    if _current:
+        # Nested runs record to the outer report
+        yield _current
+        return
+
+    report = RunReport(command)
+    path = path or get_report_path(command)
+    profiler = cProfile.Profile() if profile else None
+    _current = report
+    connection_created.connect(install_query_counter)
+    for connection in connections.all():
+        install_query_counter(connection)
+    if profiler:
+        profiler.enable()
+    try:
+        yield report
+    except BaseException as e:
+        report.set_value("error", repr(e))
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        connection_created.disconnect(install_query_counter)
+        for connection in connections.all():
+            if count_query in connection.execute_wrappers:
+                connection.execute_wrappers.remove(count_query)
+        _current = None
+        if path:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps(report.as_dict(), indent=2))
+            logger.info(f"Wrote the report of {command} to {path}")
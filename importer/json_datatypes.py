@@ -1,11 +1,15 @@
 from datetime import date, datetime
-from typing import List, Dict
+from functools import cached_property
+from pathlib import Path
+from typing import List, Dict, Iterator, Type, Generic, TypeVar
 from typing import Optional, Union
 
 import attr
 from cattr.converters import Converter
 from dateutil import tz
 
+from importer.json_stream import iter_members, read_chunks
+
 converter = Converter()
 converter.register_unstructure_hook(datetime, lambda dt: dt.isoformat())
 converter.register_structure_hook(datetime, lambda ts, _: datetime.fromisoformat(ts))
@@ -178,3 +182,88 @@ class RisData:
             "Membership": len(self.memberships),
             "Agenda Item": len(self.agenda_items),
         }
+
+
+T = TypeVar("T")
+
+
+class RisSection(Generic[T]):
+    """A list of a json dump that is read from the file and structured one record
+    at a time whenever it is iterated, so it can be iterated multiple times
+    without ever being in memory as a whole"""
+
+    def __init__(self, path: Path, key: str, cls: Type[T], length: int):
+        self.path = path
+        self.key = key
+        self.cls = cls
+        self.length = length
+
+    def __iter__(self) -> Iterator[T]:
+        with self.path.open("rb") as fp:
+            for _, value in iter_members(
+                read_chunks(fp), streamed={self.key}, wanted={self.key}
+            ):
+                yield converter.structure(value, self.cls)
+
+    def __len__(self) -> int:
+        return self.length
+
+
+class StreamedRisData:
+    """A `RisData` whose lists are streamed from the json dump.
+
+    Opening the dump reads the meta data and counts the records, skipping over
+    the lists without decoding them. The memory usage of the import is then
+    bounded by what a single phase keeps of a list instead of the whole dump.
+    """
+
+    sections: Dict[str, Type] = {
+        "persons": Person,
+        "organizations": Organization,
+        "papers": Paper,
+        "files": File,
+        "meetings": Meeting,
+        "memberships": Membership,
+        "agenda_items": AgendaItem,
+    }
+
+    persons: RisSection[Person]
+    organizations: RisSection[Organization]
+    papers: RisSection[Paper]
+    files: RisSection[File]
+    meetings: RisSection[Meeting]
+    memberships: RisSection[Membership]
+    agenda_items: RisSection[AgendaItem]
+    format_version: Optional[int]
+
+    def __init__(self, path: Path):
+        lengths = {key: 0 for key in self.sections}
+        values = dict()
+        with path.open("rb") as fp:
+            for key, value in iter_members(
+                read_chunks(fp),
+                streamed=self.sections.keys(),
+                wanted={"meta", "main_organization", "format_version"},
+            ):
+                if key in self.sections:
+                    lengths[key] += 1
+                else:
+                    values[key] = value
+
+        self.values = values
+        # This is checked by the caller before anything is structured
+        self.format_version = values.get("format_version")
+        for key, cls in self.sections.items():
+            setattr(self, key, RisSection(path, key, cls, lengths[key]))
+
+    @cached_property
+    def meta(self) -> RisMeta:
+        return converter.structure(self.values["meta"], RisMeta)
+
+    @cached_property
+    def main_organization(self) -> Optional[Organization]:
+        return converter.structure(
+            self.values.get("main_organization"), Optional[Organization]
+        )
+
+    get_counts = RisData.get_counts
@@ -0,0 +1,321 @@
+"""Incremental decoding of oparl list pages.
+
+A page is a json object whose `data` member is an array of possibly huge
+objects. Instead of materializing the whole page, we scan the downloaded
+chunks for the boundaries of the top level members and of the `data` elements
+and decode them one at a time with the standard json decoder.
+
+The same is used for the sections of the json dumps of the scrapers, which
+are read one section at a time.
+"""
+
+import codecs
+import json
+import logging
+import re
+from collections import deque
+from typing import (
+    Iterator,
+    Tuple,
+    Any,
+    Iterable,
+    Optional,
+    Callable,
+    Deque,
+    Set,
+    Container,
+    BinaryIO,
+)
+
+from importer import JSON
+
+logger = logging.getLogger(__name__)
+
+_outside_string = re.compile(r'["{}\[\]]')
+_inside_string = re.compile(r'["\\]')
+_scalar = re.compile(r"[^\s,\]}]+")
+_whitespace = re.compile(r"\s*")
+
+
+class _Scanner:
+    """Finds the end of the json value that starts at `start` in the buffer,
+    remembering how far it got so that scanning can be continued when more data
+    arrives. The position is kept relative to `start`, so the reader may drop
+    the consumed part of the buffer in between."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+
+    def find_end(self, buffer: str, eof: bool, start: int = 0) -> Optional[int]:
+        self.position += start
+        try:
+            return self._find_end(buffer, eof, start)
+        finally:
+            self.position -= start
+
+    def _find_end(self, buffer: str, eof: bool, start: int) -> Optional[int]:
+        if self.position == start and self.depth == 0 and not self.in_string:
+            if start >= len(buffer):
+                return None
+            if buffer[start] not in '"{[':
+                match = _scalar.match(buffer, start)
+                if match.end() == len(buffer) and not eof:
+                    return None
+                return match.end()
+
+        while True:
+            if self.in_string:
+                match = _inside_string.search(buffer, self.position)
+                if not match:
+                    self.position = len(buffer)
+                    return None
+                if match.group() == "\\":
+                    if match.end() >= len(buffer):
+                        self.position = match.start()
+                        return None
+                    self.position = match.end() + 1
+                    continue
+                self.in_string = False
+                self.position = match.end()
+                if self.depth == 0:
+                    return self.position
+            else:
+                match = _outside_string.search(buffer, self.position)
+                if not match:
+                    self.position = len(buffer)
+                    return None
+                self.position = match.end()
+                char = match.group()
+                if char == '"':
+                    self.in_string = True
+                elif char in "{[":
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        return self.position
+
+
+class _Reader:
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        # Everything before the offset has been consumed. We only drop that part
+        # when reading more, as slicing after every token would copy the whole
+        # remaining buffer each time
+        self.offset = 0
+        self.eof = False
+
+    def read_more(self) -> bool:
+        if self.eof:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            decoded = self.decoder.decode(b"", final=True)
+            self.eof = True
+        else:
+            decoded = self.decoder.decode(chunk)
+        self.buffer = self.buffer[self.offset :] + decoded
+        self.offset = 0
+        return True
+
+    def peek(self) -> str:
+        """Skips whitespace and returns the next character or "" at the end"""
+        while True:
+            self.offset = _whitespace.match(self.buffer, self.offset).end()
+            if self.offset < len(self.buffer) or not self.read_more():
+                return self.buffer[self.offset : self.offset + 1]
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(
+                f"Expected one of {chars!r},"
+                f" got {self.buffer[self.offset : self.offset + 20]!r}"
+            )
+        self.offset += 1
+        return char
+
+    def find_end(self, skip: bool) -> int:
+        self.peek()
+        scanner = _Scanner()
+        while True:
+            end = scanner.find_end(self.buffer, self.eof, self.offset)
+            if end is not None:
+                return end
+            if skip and (scanner.depth or scanner.in_string):
+                # Nobody needs the part that was scanned already
+                self.offset += scanner.position
+                scanner.position = 0
+            if not self.read_more():
+                raise ValueError("Unexpected end of json")
+
+    def read_value(self, strict: bool) -> Any:
+        end = self.find_end(skip=False)
+        value = json.loads(self.buffer[self.offset : end], strict=strict)
+        self.offset = end
+        return value
+
+    def skip_value(self) -> None:
+        """Moves past the next value without decoding or keeping it in memory"""
+        self.offset = self.find_end(skip=True)
+
+
+def iter_members(
+    chunks: Iterable[bytes],
+    streamed: Container[str] = ("data",),
+    wanted: Optional[Container[str]] = None,
+    strict: bool = True,
+) -> Iterator[Tuple[str, Any]]:
+    """Yields `(key, element)` for every element of the top level arrays in
+    `streamed` and `(key, value)` for all other top level members in the order
+    of the document.
+
+    Members that aren't `wanted` are skipped without being decoded; for the
+    elements of a streamed array that isn't wanted, `(key, None)` is yielded so
+    they can still be counted.
+
+    An empty top level array (which some servers return for empty lists) yields
+    nothing. Any other malformed input raises a `ValueError`.
+    """
+    reader = _Reader(chunks)
+    if reader.expect("{[") == "[":
+        reader.expect("]")
+        return
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.read_value(strict)
+        if not isinstance(key, str):
+            raise ValueError(f"Invalid key {key!r}")
+        reader.expect(":")
+        decode = wanted is None or key in wanted
+        if key in streamed and reader.peek() == "[":
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.expect("]")
+            else:
+                while True:
+                    if decode:
+                        yield key, reader.read_value(strict)
+                    else:
+                        reader.skip_value()
+                        yield key, None
+                    if reader.expect(",]") == "]":
+                        break
+        elif decode:
+            yield key, reader.read_value(strict)
+        else:
+            reader.skip_value()
+        if reader.expect(",}") == "}":
+            return
+
+
+def iter_page(
+    chunks: Iterable[bytes], strict: bool = True
+) -> Iterator[Tuple[str, Any]]:
+    """Yields `("data", element)` for every element of the data array and
+    `(key, value)` for all other top level members in the order of the document.
+    """
+    return iter_members(chunks, strict=strict)
+
+
+def read_chunks(fp: BinaryIO, size: int = 2**16) -> Iterator[bytes]:
+    return iter(lambda: fp.read(size), b"")
+
+
+class StreamedPage:
+    """A list page that decodes its `data` elements only when they are iterated.
+
+    `page["data"]` is an iterator that can be consumed once; each element is
+    passed through `visit`, which applies vendor fixups and may drop an element
+    by returning None. All other members (`links`, `pagination`, ...) are
+    available after the data has been consumed (or drain the rest of the
+    response when accessed earlier).
+
+    If the response turns out to be invalid json, the page is loaded again
+    with `fallback` and the elements that haven't been yielded yet are taken
+    from there.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        chunks: Iterable[bytes],
+        visit: Callable[[JSON], Optional[JSON]],
+        fallback: Callable[[], JSON],
+        strict: bool = True,
+    ):
+        self.url = url
+        self.members = iter_page(chunks, strict)
+        self.visit = visit
+        self.fallback = fallback
+        self.rest: JSON = dict()
+        self.pending: Deque[JSON] = deque()
+        self.seen: Set[str] = set()
+        self.done = False
+
+    def _next_element(self) -> Optional[JSON]:
+        """Returns the next visited data element, storing the other members on the way"""
+        while not self.done:
+            try:
+                key, value = next(self.members)
+            except StopIteration:
+                self.done = True
+                return None
+            except ValueError:
+                logger.error(
+                    "The server returned invalid json. This is a bug in the OParl"
+                    f" implementation: {self.url}"
+                )
+                self.done = True
+                page = self.fallback()
+                for element in page["data"]:
+                    if element.get("id") not in self.seen:
+                        self.pending.append(element)
+                self.rest.update({k: v for k, v in page.items() if k != "data"})
+                return None
+            if key != "data":
+                self.rest[key] = value
+                continue
+            element = self.visit(value)
+            if element is not None:
+                self.seen.add(element.get("id"))
+                return element
+        return None
+
+    def _elements(self) -> Iterator[JSON]:
+        while True:
+            if self.pending:
+                yield self.pending.popleft()
+                continue
+            element = self._next_element()
+            if element is None and not self.pending:
+                return
+            if element is not None:
+                yield element
+
+    def _drain(self) -> None:
+        while not self.done:
+            element = self._next_element()
+            if element is not None:
+                self.pending.append(element)
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "data":
+            return self._elements()
+        self._drain()
+        return self.rest[key]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key == "data":
+            return self._elements()
+        self._drain()
+        return self.rest.get(key, default)
@@ -2,15 +2,20 @@ import logging
 import mimetypes
 import re
 import textwrap
-from typing import List, TypeVar, Type, Optional, Callable
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, TypeVar, Type, Optional, Callable, Tuple, Dict, Set, Iterator
 
 from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.utils import timezone
 from django.utils.translation import gettext as _
 from requests import HTTPError
 from slugify.slugify import slugify
 
-from importer import JSON
+from importer import JSON, instrumentation
 from importer.functions import externalize, import_order
 from importer.loader import BaseLoader
 from importer.models import CachedObject
@@ -41,6 +46,43 @@ logger = logging.getLogger(__name__)
 T = TypeVar("T", bound=DefaultFields)
 
 
+class MissingReferences:
+    """The objects that were referenced during the import of a type, but were
+    neither cached nor in the database, so that they can be loaded in batches
+    after the type was imported instead of one request at a time"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # referencing type -> oparl id -> type of the missing object
+        self.missing: Dict[
+            Type[DefaultFields], Dict[str, Type[DefaultFields]]
+        ] = defaultdict(dict)
+        # referencing type -> oparl ids of the objects with a dangling reference
+        self.referrers: Dict[Type[DefaultFields], Set[str]] = defaultdict(set)
+
+    def add(
+        self,
+        referrer_type: Type[DefaultFields],
+        referrer_id: str,
+        object_type: Type[DefaultFields],
+        oparl_id: str,
+        dangling: bool,
+    ) -> None:
+        with self.lock:
+            self.missing[referrer_type][oparl_id] = object_type
+            if dangling:
+                self.referrers[referrer_type].add(referrer_id)
+
+    def pop(
+        self, referrer_type: Type[DefaultFields]
+    ) -> Tuple[Dict[str, Type[DefaultFields]], Set[str]]:
+        with self.lock:
+            return (
+                self.missing.pop(referrer_type, dict()),
+                self.referrers.pop(referrer_type, set()),
+            )
+
+
 class JsonToDb:
     """Converts oparl json to database objects"""
 
@@ -55,6 +97,13 @@ class JsonToDb:
         self.utils = utils or Utils()
         self.default_body = default_body
         self.warn_missing = True  # Some tests set this to False
+        # oparl_id -> pk per model, loaded once and kept up to date with `remember`,
+        # so that references can be resolved without a query
+        self.identity_map: Dict[Type[DefaultFields], Dict[str, int]] = dict()
+        self.identity_map_lock = threading.Lock()
+        self.missing = MissingReferences()
+        # Holds the type currently imported by the thread, see `deferring_missing`
+        self.deferring = threading.local()
 
         # Some tests skip that
         if ensure_organization_type:
@@ -95,6 +144,45 @@ class JsonToDb:
 
         return mapping.get(type_class)
 
+    def type_to_related_fields(
+        self, type_class: Type[DefaultFields]
+    ) -> List[Tuple[str, Type[DefaultFields], str]]:
+        """The many-to-many fields of a type, which can only be set after the
+        object was saved, as (field name, related type, oparl key)"""
+        mapping = {
+            Body: [("legislative_terms", LegislativeTerm, "legislativeTerm")],
+            Paper: [
+                ("files", File, "auxiliaryFile"),
+                ("organizations", Organization, "underDirectionOf"),
+                ("persons", Person, "originatorPerson"),
+            ],
+            Meeting: [
+                ("auxiliary_files", File, "auxiliaryFile"),
+                ("persons", Person, "participant"),
+                ("organizations", Organization, "organization"),
+            ],
+            AgendaItem: [("auxiliary_file", File, "auxiliaryFile")],
+        }
+
+        return mapping.get(type_class, [])
+
+    def related_objects(
+        self, lib_object: JSON, type_class: Type[DefaultFields]
+    ) -> Dict[str, List[DefaultFields]]:
+        """Retrieves the objects of all many-to-many fields by field name"""
+        return {
+            field: self.retrieve_many(
+                related_type, lib_object.get(oparl_key), lib_object["id"]
+            )
+            for field, related_type, oparl_key in self.type_to_related_fields(
+                type_class
+            )
+        }
+
+    def set_related(self, lib_object: JSON, instance: DefaultFields) -> None:
+        for field, objects in self.related_objects(lib_object, type(instance)).items():
+            getattr(instance, field).set(objects)
+
     def ensure_organization_type(self) -> None:
         # Ensure the existence of the three predefined organization types
         group = settings.PARLIAMENTARY_GROUPS_TYPE
@@ -126,14 +214,38 @@ class JsonToDb:
 
         # noinspection PyTypeChecker
         dummy: T = object_type.dummy(oparl_id)
-        dummy.save()
+        # So that the dummy is replaced once the object can be loaded
+        dummy.oparl_id = oparl_id
+        try:
+            # A savepoint, so that a conflict doesn't abort the chunk's transaction
+            with transaction.atomic():
+                dummy.save()
+        except IntegrityError:
+            # Another import thread created the dummy (or the object) first
+            existing = object_type.objects_with_deleted.filter(
+                oparl_id=oparl_id
+            ).first()
+            if not existing:
+                raise
+            logger.info(f"Avoided concurrent dummy creation for {oparl_id}")
+            dummy = existing
+        self.remember(dummy)
         return dummy
 
     def import_anything(
         self, oparl_id: str, object_type: Optional[Type[T]] = None
     ) -> DefaultFields:
         """Hacky metaprogramming to import any object based on its id"""
+        loaded = self.load_missing(oparl_id)
+        if loaded is None:
+            return self._make_dummy(oparl_id, object_type)
+        return self.import_loaded(oparl_id, loaded, object_type)
+
+    def load_missing(self, oparl_id: str) -> Optional[JSON]:
+        """Loads an object that is not part of the external lists, or returns
+        None if it can't be loaded"""
         logging.info(f"Importing single object {oparl_id}")
+        instrumentation.count("objects_loaded_on_demand")
 
         try:
             loaded = self.loader.load(oparl_id)
@@ -141,14 +253,21 @@ class JsonToDb:
             logger.error(
                 f"Failed to load {oparl_id}. Using a dummy instead. THIS IS BAD: {e}"
             )
-            return self._make_dummy(oparl_id, object_type)
+            return None
 
         if not isinstance(loaded, dict):
             logger.error(
                 f"JSON loaded from {oparl_id} is not a dict/object. Using a dummy"
                 " instead. THIS IS BAD"
             )
-            return self._make_dummy(oparl_id, object_type)
+            return None
+        return loaded
+
+    def import_loaded(
+        self, oparl_id: str, loaded: JSON, object_type: Optional[Type[T]] = None
+    ) -> DefaultFields:
+        """Imports an object loaded with `load_missing` including all objects
+        embedded in it"""
         if "type" not in loaded:
             if object_type:
                 loaded["type"] = "https://schema.oparl.org/1.0/" + object_type.__name__
@@ -184,6 +303,7 @@ class JsonToDb:
                 "url": entry.url,
                 "data": entry.data,
                 "oparl_type": entry.oparl_type,
+                "content_hash": entry.content_hash,
                 "to_import": False,
             }
             CachedObject.objects.update_or_create(url=entry.url, defaults=defaults)
@@ -194,6 +314,54 @@ class JsonToDb:
         assert to_return, f"Missing object for {oparl_id}"
         return to_return
 
+    @contextmanager
+    def deferring_missing(self, referrer_type: Type[DefaultFields]) -> Iterator[None]:
+        """Within this block, `retrieve` and `retrieve_many` don't load missing
+        objects, but add them to `missing`, to be imported with `import_missing`
+        after all objects of `referrer_type` were imported.
+
+        For types that allow dummies, the reference points to a dummy that is
+        replaced by the loaded object. Otherwise, the reference is left empty
+        and the referencing object needs to be imported again."""
+        self.deferring.referrer_type = referrer_type
+        try:
+            yield
+        finally:
+            self.deferring.referrer_type = None
+
+    def defer_missing(
+        self, object_type: Type[T], oparl_id: str, debug_id: str
+    ) -> Optional[T]:
+        """Queues a missing object, returning a dummy if the type allows dummies"""
+        referrer_type = self.deferring.referrer_type
+        if issubclass(object_type, DummyInterface):
+            self.missing.add(referrer_type, debug_id, object_type, oparl_id, False)
+            return self._make_dummy(oparl_id, object_type)
+        else:
+            self.missing.add(referrer_type, debug_id, object_type, oparl_id, True)
+            return None
+
+    def import_missing(
+        self, missing: Dict[str, Type[DefaultFields]], batch_size: int, workers: int
+    ) -> None:
+        """Loads the missing objects concurrently in batches and imports them
+        one after another. Objects that can't be loaded keep their dummy"""
+        oparl_ids = list(missing)
+        for start in range(0, len(oparl_ids), batch_size):
+            batch = oparl_ids[start : start + batch_size]
+            if workers > 1:
+                with ThreadPoolExecutor(workers) as executor:
+                    loaded = list(executor.map(self.load_missing, batch))
+            else:
+                loaded = [self.load_missing(oparl_id) for oparl_id in batch]
+
+            for oparl_id, data in zip(batch, loaded):
+                object_type = missing[oparl_id]
+                if data is not None:
+                    self.import_loaded(oparl_id, data, object_type)
+                elif oparl_id not in self.get_identity_map(object_type):
+                    self._make_dummy(oparl_id, object_type)
+
     def import_any_externalized(self, data: JSON) -> DefaultFields:
         type_split = data["type"].split("/")[-1]
         type_class = getattr(models, type_split)
@@ -211,11 +379,25 @@ class JsonToDb:
             if not instance.deleted:
                 self.type_to_function(type_class)(data, existing)
             existing.save()
+            self.remember(existing)
 
             logger.info("Avoided cyclic import for {}".format(data["id"]))
             return existing
 
-        instance.save()
+        try:
+            with transaction.atomic():
+                instance.save()
+        except IntegrityError:
+            # Another import thread was faster
+            existing = type_class.objects_with_deleted.filter(
+                oparl_id=data["id"]
+            ).first()
+            if not existing:
+                raise
+            self.remember(existing)
+            logger.info("Avoided concurrent import for {}".format(data["id"]))
+            return existing
+        self.remember(instance)
         logger.debug(
             "Saved {} individually as {} {}".format(
                 instance.oparl_id, type_class, instance.id
@@ -224,18 +406,69 @@ class JsonToDb:
 
         return instance
 
+    def get_identity_map(self, object_type: Type[DefaultFields]) -> Dict[str, int]:
+        identity_map = self.identity_map.get(object_type)
+        if identity_map is None:
+            with self.identity_map_lock:
+                if object_type not in self.identity_map:
+                    self.identity_map[object_type] = dict(
+                        object_type.objects_with_deleted.filter(
+                            oparl_id__isnull=False
+                        ).values_list("oparl_id", "id")
+                    )
+                identity_map = self.identity_map[object_type]
+        return identity_map
+
+    def clear_identity_map(self) -> None:
+        """Forgets all ids, e.g. because the database was reset"""
+        with self.identity_map_lock:
+            self.identity_map.clear()
+
+    def remember(self, instance: DefaultFields) -> None:
+        """Adds a saved instance to the identity map once the transaction that
+        saved it is committed, so that the other import threads never reference
+        rows they can't see yet or that are rolled back"""
+        if not instance.oparl_id or not instance.pk:
+            return
+        identity_map = self.get_identity_map(type(instance))
+        oparl_id, pk = instance.oparl_id, instance.pk
+
+        def publish():
+            identity_map[oparl_id] = pk
+
+        # Outside of a transaction, this runs right away
+        transaction.on_commit(publish)
+
+    def make_reference(self, object_type: Type[T], oparl_id: str, pk: int) -> T:
+        """An instance with only id and oparl_id loaded; accessing any other
+        field loads the object from the database"""
+        return object_type.from_db(
+            object_type.objects_with_deleted.db, ["id", "oparl_id"], [pk, oparl_id]
+        )
+
     def retrieve(
         self,
         object_type: Type[T],
         oparl_id: Optional[str],
         debug_id: str,
         warn: bool = True,
+        required: bool = False,
     ) -> Optional[T]:
+        """Returns the object with the oparl id, importing it if necessary.
+
+        Within `deferring_missing`, objects that must be loaded from the api
+        are queued instead, unless the reference is `required`."""
         if not oparl_id:
             return None
 
+        pk = self.get_identity_map(object_type).get(oparl_id)
+        if pk is not None:
+            return self.make_reference(object_type, oparl_id, pk)
+
+        # The object might have been imported by another process
         db_object = object_type.objects_with_deleted.filter(oparl_id=oparl_id).first()
         if db_object:
+            self.remember(db_object)
             return db_object
 
         entry = CachedObject.objects.filter(url=oparl_id).first()
@@ -250,6 +483,8 @@ class JsonToDb:
                     "This is a bug in the OParl implementation."
                 )
 
+            if getattr(self.deferring, "referrer_type", None) and not required:
+                return self.defer_missing(object_type, oparl_id, debug_id)
             return self.import_anything(oparl_id, object_type)
 
     def retrieve_many(
@@ -257,28 +492,45 @@ class JsonToDb:
         object_type: Type[DefaultFields],
         oparl_ids: Optional[List[str]],
         debug_id: str,
-    ) -> List[int]:
+    ) -> List[DefaultFields]:
         if not oparl_ids:
             return []
 
-        db_objects = list(
-            object_type.objects_with_deleted.filter(oparl_id__in=oparl_ids).all()
-        )
-
-        if len(db_objects) != len(oparl_ids):
+        identity_map = self.get_identity_map(object_type)
+        db_objects = []
+        not_in_map = []
+        for oparl_id in oparl_ids:
+            if oparl_id in identity_map:
+                db_objects.append(
+                    self.make_reference(object_type, oparl_id, identity_map[oparl_id])
+                )
+            else:
+                not_in_map.append(oparl_id)
+
+        if not_in_map:
+            # The objects might have been imported by another process
+            for db_object in object_type.objects_with_deleted.filter(
+                oparl_id__in=not_in_map
+            ):
+                self.remember(db_object)
+                db_objects.append(db_object)
             found_ids = [db_object.oparl_id for db_object in db_objects]
-            missing = sorted(set(oparl_ids) - set(found_ids))
-
-            if missing:
-                for oparl_id in missing:
-                    if self.warn_missing:
-                        logger.warning(
-                            f"The {object_type.__name__} {oparl_id} linked from"
-                            f" {debug_id} was supposed to be a part of the external"
-                            " lists, but was not. This is a bug in the OParl"
-                            " implementation."
-                        )
+            missing = sorted(set(not_in_map) - set(found_ids))
+
+            for oparl_id in missing:
+                if self.warn_missing:
+                    logger.warning(
+                        f"The {object_type.__name__} {oparl_id} linked from"
+                        f" {debug_id} was supposed to be a part of the external"
+                        " lists, but was not. This is a bug in the OParl"
+                        " implementation."
+                    )
 
+                if getattr(self.deferring, "referrer_type", None):
+                    dummy = self.defer_missing(object_type, oparl_id, debug_id)
+                    if dummy:
+                        db_objects.append(dummy)
+                else:
                     db_objects.append(self.import_anything(oparl_id, object_type))
 
         return db_objects
@@ -417,7 +669,9 @@ class JsonToDb:
         item.start = self.utils.parse_datetime(lib_object.get("start"))
         item.end = self.utils.parse_datetime(lib_object.get("end"))
         meeting_backref = lib_object.get("meeting") or lib_object.get("mst:backref")
-        item.meeting = self.retrieve(Meeting, meeting_backref, item.oparl_id)
+        item.meeting = self.retrieve(
+            Meeting, meeting_backref, item.oparl_id, required=True
+        )
         item.position = lib_object.get("mst:backrefPosition")
 
         item.consultation = self.retrieve(
@@ -430,9 +684,7 @@ class JsonToDb:
         return item
 
     def agenda_item_related(self, lib_object: JSON, item: AgendaItem) -> None:
-        item.auxiliary_file.set(
-            self.retrieve_many(File, lib_object.get("auxiliaryFile"), lib_object["id"])
-        )
+        self.set_related(lib_object, item)
 
     def membership(self, lib_object: JSON, membership: Membership) -> Membership:
         role = lib_object.get("role") or _("Unknown")
@@ -486,11 +738,7 @@ class JsonToDb:
         return body
 
     def body_related(self, lib_object: JSON, body: Body) -> None:
-        body.legislative_terms.set(
-            self.retrieve_many(
-                LegislativeTerm, lib_object.get("legislativeTerm"), lib_object["id"]
-            )
-        )
+        self.set_related(lib_object, body)
 
     def paper(self, lib_object: JSON, paper: Paper) -> Paper:
         if lib_object.get("paperType"):
@@ -520,19 +768,7 @@ class JsonToDb:
         return paper
 
     def paper_related(self, lib_object: JSON, paper: Paper) -> None:
-        paper.files.set(
-            self.retrieve_many(File, lib_object.get("auxiliaryFile"), lib_object["id"])
-        )
-        paper.organizations.set(
-            self.retrieve_many(
-                Organization, lib_object.get("underDirectionOf"), lib_object["id"]
-            )
-        )
-        paper.persons.set(
-            self.retrieve_many(
-                Person, lib_object.get("originatorPerson"), lib_object["id"]
-            )
-        )
+        self.set_related(lib_object, paper)
 
     def organization(
         self, lib_object: JSON, organization: Organization
@@ -593,17 +829,7 @@ class JsonToDb:
         return meeting
 
     def meeting_related(self, lib_object: JSON, meeting: Meeting) -> None:
-        meeting.auxiliary_files.set(
-            self.retrieve_many(File, lib_object.get("auxiliaryFile"), lib_object["id"])
-        )
-        meeting.persons.set(
-            self.retrieve_many(Person, lib_object.get("participant"), lib_object["id"])
-        )
-        meeting.organizations.set(
-            self.retrieve_many(
-                Organization, lib_object.get("organization"), lib_object["id"]
-            )
-        )
+        self.set_related(lib_object, meeting)
 
     def person(self, lib_object: JSON, person: Person) -> Person:
         name = lib_object.get("name")
@@ -0,0 +1,107 @@
+import logging
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, Dict, Iterator, List, Deque
+from urllib.parse import urlparse, parse_qs
+
+from django.conf import settings
+
+from importer import JSON
+from importer.loader import BaseLoader
+
+logger = logging.getLogger(__name__)
+
+# Some vendors use `page`, others (e.g. Leipzig) use `p`
+page_parameters = ["page", "p"]
+
+
+class ListWalker:
+    """Iterates over the pages of an external list with up to `prefetch` page
+    requests in flight.
+
+    If the first page tells us the total number of pages and the next link
+    contains a page number, we can compute all page urls upfront and load them
+    concurrently. Otherwise, we still load the next page while the caller
+    processes the current one. `prefetch = 0` or streamed lists load strictly
+    one page after the other without any threads.
+    """
+
+    def __init__(self, loader: BaseLoader, prefetch: Optional[int] = None):
+        self.loader = loader
+        if prefetch is None:
+            prefetch = settings.IMPORTER_LIST_PREFETCH
+        self.prefetch = prefetch
+
+    def load_page(self, url: str, query: Optional[Dict[str, str]] = None) -> JSON:
+        # Handles both the case where the query (e.g. modified_since) is
+        # given with the next url and where it isn't
+        if query and set(query) <= set(parse_qs(urlparse(url).query)):
+            query = None
+        logger.info(f"Fetching {url}")
+        return self.loader.load_list_page(url, query)
+
+    def predict_page_urls(self, first_page: JSON) -> List[str]:
+        """Returns the urls of all pages after the first one if the vendor uses
+        predictable page links, otherwise an empty list"""
+        next_url = first_page.get("links", {}).get("next")
+        pagination = first_page.get("pagination") or {}
+        total_pages = pagination.get("totalPages")
+        if not next_url or not isinstance(total_pages, int):
+            return []
+        current_page = pagination.get("currentPage") or 1
+        next_query = parse_qs(urlparse(next_url).query)
+        for parameter in page_parameters:
+            if next_query.get(parameter) == [str(current_page + 1)]:
+                # We replace in the string instead of rebuilding the query
+                # because some vendors (e.g. Somacos) don't like encoded urls
+                pattern = re.compile(r"([?&]" + re.escape(parameter) + r"=)\d+")
+                return [
+                    pattern.sub(r"\g<1>" + str(page), next_url)
+                    for page in range(current_page + 1, total_pages + 1)
+                ]
+        return []
+
+    def walk(self, url: str, query: Optional[Dict[str, str]] = None) -> Iterator[JSON]:
+        # The links of a streamed page are only known after its data was processed
+        if self.prefetch < 1 or self.loader.stream_lists:
+            next_url = url
+            while next_url:
+                page = self.load_page(next_url, query)
+                yield page
+                next_url = page.get("links", {}).get("next")
+            return
+
+        with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+            page = self.load_page(url, query)
+            page_urls = self.predict_page_urls(page)
+            if page_urls:
+                logger.info(f"Prefetching {len(page_urls)} pages of {url}")
+                yield page
+                in_flight: Deque[Future] = deque()
+                for page_url in page_urls:
+                    if len(in_flight) >= self.prefetch:
+                        page = in_flight.popleft().result()
+                        yield page
+                    in_flight.append(executor.submit(self.load_page, page_url, query))
+                while in_flight:
+                    page = in_flight.popleft().result()
+                    yield page
+                # The list might have grown since we've loaded the first page
+                next_url = page["links"].get("next")
+                if next_url in page_urls:
+                    return
+                if not next_url:
+                    return
+                page = self.load_page(next_url, query)
+
+            # Load the next page while the caller processes the current one
+            while True:
+                next_url = page["links"].get("next")
+                future = None
+                if next_url:
+                    future = executor.submit(self.load_page, next_url, query)
+                yield page
+                if not future:
+                    return
+                page = future.result()
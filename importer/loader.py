@@ -1,34 +1,113 @@
+import hashlib
 import json
 import logging
 import re
-import time
 from json import JSONDecodeError
 
-from typing import Optional, Tuple, Dict
+from typing import (
+    Optional,
+    Tuple,
+    Dict,
+    Type,
+    Iterator,
+    Iterable,
+    BinaryIO,
+    Callable,
+)
 
-from requests import HTTPError, Response
+from django.conf import settings
+from requests import HTTPError
 
 from importer import JSON
-from importer.functions import requests_get
+from importer.functions import hash_json
+from importer.http_cache import ResponseCache
+from importer.json_stream import StreamedPage
 from importer.models import CachedObject
+from importer.transport import Transport
 
 logger = logging.getLogger(__name__)
 
 
+class FileTooLarge(Exception):
+    pass
+
+
+class FileStream:
+    """The chunks of a streamed download. Closing it, e.g. by using it as context
+    manager, releases the connection even if it wasn't read to the end"""
+
+    def __init__(
+        self, chunks: Iterable[bytes], close: Optional[Callable[[], None]] = None
+    ):
+        self.chunks = chunks
+        self._close = close
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self.chunks)
+
+    def close(self) -> None:
+        if self._close:
+            self._close()
+
+    def __enter__(self) -> "FileStream":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class FileDownload:
+    """Reads the chunks of a streamed download, hashing and counting them and
+    aborting when they exceed `max_size`. With `copy_to`, the content is also
+    written to that file."""
+
+    def __init__(
+        self,
+        chunks: Iterable[bytes],
+        max_size: int,
+        copy_to: Optional[BinaryIO] = None,
+    ):
+        self.chunks = iter(chunks)
+        self.max_size = max_size
+        self.copy_to = copy_to
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def consume(self) -> None:
+        """Reads the whole content"""
+        for chunk in self.chunks:
+            self.size += len(chunk)
+            if self.size > self.max_size:
+                raise FileTooLarge(f"The file is larger than {self.max_size} bytes")
+            self.sha256.update(chunk)
+            if self.copy_to:
+                self.copy_to.write(chunk)
+
+
 class BaseLoader:
     """Provides a json and file download function.
 
     This class can be overwritten for vendor specific fixups
     """
 
+    vendor_name: str = "plain OParl"
+    max_retries: int = 3
+    error_sleep_seconds: float = 1
+    # Whether control characters in strings are rejected when streaming lists
+    strict_json: bool = True
+
     def __init__(self, system: JSON) -> None:
         self.system = system
+        self.transport = Transport(
+            self.vendor_name, self.max_retries, self.error_sleep_seconds
+        )
+        self.stream_lists = settings.IMPORTER_STREAM_LISTS
 
     def load(self, url: str, query: Optional[Dict[str, str]] = None) -> JSON:
         logger.debug(f"Loader is loading {url}")
         if query is None:
             query = dict()
-        response = requests_get(url, params=query)
+        response = self.transport.get(url, params=query)
         data = response.json()
         if data is None:  # json() can actually return None
             data = dict()
@@ -36,15 +115,48 @@ class BaseLoader:
             logger.warning(f"Mismatch between url and id. url: {url} id: {data['id']}")
         return data
 
+    def load_list_page(self, url: str, query: Optional[Dict[str, str]] = None) -> JSON:
+        """Loads a page of an external list.
+
+        With `IMPORTER_STREAM_LISTS`, this returns a `StreamedPage` whose data
+        elements are decoded and passed through `visit_list_element` one at a
+        time while the response is downloaded"""
+        if not self.stream_lists:
+            return self.load(url, query)
+
+        response = self.transport.get(url, params=query, stream=True)
+        return StreamedPage(
+            url,
+            response.iter_content(chunk_size=64 * 1024),
+            lambda element: self.visit_list_element(url, element),
+            lambda: self.load(url, query),
+            self.strict_json,
+        )
+
+    def visit_list_element(self, url: str, data: JSON) -> Optional[JSON]:
+        """Vendor specific fixups for a single element of a list.
+
+        Returning None drops the element."""
+        return data
+
     def load_file(self, url: str) -> Tuple[bytes, Optional[str]]:
         """Returns the content and the content type"""
-        response = requests_get(url)
-        content = response.content
-        content_type = response.headers.get("Content-Type")
-        return content, content_type
+        chunks, content_type = self.load_file_stream(url)
+        with chunks:
+            return b"".join(chunks), content_type
+
+    def load_file_stream(self, url: str) -> Tuple[FileStream, Optional[str]]:
+        """Returns the content in chunks as it is downloaded and the content type.
+
+        The caller has to close the stream."""
+        response = self.transport.get(url, stream=True)
+        chunks = FileStream(response.iter_content(chunk_size=64 * 1024), response.close)
+        return chunks, response.headers.get("Content-Type")
 
 
 class SternbergLoader(BaseLoader):
+    vendor_name = "Sternberg"
+
     empty_list_error = {
         "error": "Die angeforderte Ressource wurde nicht gefunden.",
         "code": 802,
@@ -71,6 +183,49 @@ class SternbergLoader(BaseLoader):
                 # noinspection PyTypeChecker
                 response["ags"] = "0" + ags
 
+    def is_empty_list_error(self, error: HTTPError, query: Dict[str, str]) -> bool:
+        """Sometimes, an error is returned when the list would have been empty"""
+        return (
+            error.response.status_code == 404
+            and "modified_since" in query
+            and error.response.json() == self.empty_list_error
+        )
+
+    def visit_list_element(self, url: str, data: JSON) -> Optional[JSON]:
+        if "/body" in url:
+            # Add missing "type"-attributes in body-lists
+            if "location" in data.keys() and isinstance(data["location"], dict):
+                data["location"]["type"] = "https://schema.oparl.org/1.0/Location"
+
+            # There are deleted entries in unfiltered external lists (which they shouldn't) and then
+            # they don't even have type attributes (which are mandatory)
+            if data.get("deleted") and "type" not in data:
+                return None
+
+            # Location in Person must be a url, not an object
+            if "/person" in url:
+                if "location" in data and isinstance(data["location"], dict):
+                    data["location"] = data["location"]["id"]
+
+            if "/organization" in url:
+                if "id" in data and "type" not in data:
+                    data["type"] = "https://schema.oparl.org/1.0/Organization"
+
+        self.visit_object(data)
+        return data
+
+    def load_list_page(self, url: str, query: Optional[Dict[str, str]] = None) -> JSON:
+        # The body list might actually be a single body
+        if not self.stream_lists or url.endswith("/body"):
+            return self.load(url, query)
+
+        try:
+            return super().load_list_page(url, query)
+        except HTTPError as error:
+            if self.is_empty_list_error(error, query or dict()):
+                return self.empty_page
+            raise
+
     def load(self, url: str, query: Optional[Dict[str, str]] = None) -> JSON:
         if query is None:
             query = dict()
@@ -78,12 +233,7 @@ class SternbergLoader(BaseLoader):
         try:
             response = super().load(url, query)  # type: Dict[str, Any]
         except HTTPError as error:
-            # Sometimes, an error is returned when the list would have been empty
-            if (
-                error.response.status_code == 404
-                and "modified_since" in query
-                and error.response.json() == self.empty_list_error
-            ):
+            if self.is_empty_list_error(error, query):
                 response = self.empty_page
             else:
                 raise error
@@ -102,36 +252,16 @@ class SternbergLoader(BaseLoader):
         if url.endswith("/body") and "id" in response:
             response = {"data": [response], "pagination": {}, "links": {}}
 
+        if "data" in response:
+            visited = [self.visit_list_element(url, data) for data in response["data"]]
+            response["data"] = [data for data in visited if data is not None]
+            return response
+
+        # Add missing "type"-attributes in single bodies
         if "/body" in url:
-            # Add missing "type"-attributes in body-lists
-            if "data" in response:
-                for data in response["data"]:
-                    if "location" in data.keys() and isinstance(data["location"], dict):
-                        data["location"][
-                            "type"
-                        ] = "https://schema.oparl.org/1.0/Location"
-
-                # There are deleted entries in unfiltered external lists (which they shouldn't) and then
-                # they don't even have type attributes (which are mandatory)
-                for entry in response["data"][:]:
-                    if entry.get("deleted") and "type" not in entry:
-                        response["data"].remove(entry)
-
-            # Add missing "type"-attributes in single bodies
             if "location" in response.keys() and isinstance(response["location"], dict):
                 response["location"]["type"] = "https://schema.oparl.org/1.0/Location"
 
-            # Location in Person must be a url, not an object
-            if "/person" in url and "data" in response:
-                for data in response["data"]:
-                    if "location" in data and isinstance(data["location"], dict):
-                        data["location"] = data["location"]["id"]
-
-            if "/organization" in url and "data" in response:
-                for data in response["data"]:
-                    if "id" in data and "type" not in data:
-                        data["type"] = "https://schema.oparl.org/1.0/Organization"
-
         if "/membership" in url:
             # If an array is returned instead of an object, we just skip all list entries except for the last one
             if isinstance(response, list):
@@ -145,17 +275,13 @@ class SternbergLoader(BaseLoader):
             if "location" in response and not isinstance(response["location"], str):
                 response["location"]["type"] = "https://schema.oparl.org/1.0/Location"
 
-        if "data" in response:
-            for data in response["data"]:
-                self.visit_object(data)
-        else:
-            self.visit_object(response)
+        self.visit_object(response)
 
         return response
 
-    def load_file(self, url: str) -> Tuple[bytes, Optional[str]]:
+    def load_file_stream(self, url: str) -> Tuple[FileStream, Optional[str]]:
         try:
-            content, content_type = super().load_file(url)
+            chunks, content_type = super().load_file_stream(url)
         except HTTPError as error:
             # Sometimes (if there's a dot in the filename(?)), the extension gets overriden
             # by repeating the part after the dot in the extension-less filename
@@ -166,15 +292,25 @@ class SternbergLoader(BaseLoader):
                 and splitted[-2] == splitted[-1]
             ):
                 new_url = ".".join(splitted[:-1]) + ".pdf"
-                content, content_type = super().load_file(new_url)
+                chunks, content_type = super().load_file_stream(new_url)
             else:
                 raise error
         if content_type == "application/octetstream; charset=UTF-8":
             content_type = None
-        return content, content_type
+        return chunks, content_type
 
 
 class CCEgovLoader(BaseLoader):
+    vendor_name = "CC e-gov"
+    # We used to retry exactly once
+    max_retries = 2
+    # The servers sometimes don't escape control characters
+    strict_json = False
+
+    def visit_list_element(self, url: str, data: JSON) -> Optional[JSON]:
+        self.visit(data)
+        return data
+
     def visit(self, data: JSON):
         """Removes quirks like `"streetAddress": " "` in Location"""
         # `"auxiliaryFile": { ... }` -> `"auxiliaryFile": [{ ... }]`
@@ -200,14 +336,7 @@ class CCEgovLoader(BaseLoader):
         if query is None:
             query = dict()
 
-        try:
-            response = requests_get(url, params=query)
-        except HTTPError as e:
-            if e.response.status_code == 500:
-                logger.error(f"Got an 500 for a CC e-gov request, retrying: {e}")
-                response = requests_get(url, params=query)
-            else:
-                raise
+        response = self.transport.get(url, params=query)
         text = response.text
         try:
             data = json.loads(text)
@@ -237,53 +366,24 @@ class CCEgovLoader(BaseLoader):
         self.visit(data)
         return data
 
-    def load_file(self, url: str) -> Tuple[bytes, Optional[str]]:
-        """Returns the content and the content type"""
-        response = requests_get(url)
-        content = response.content
-        content_type = response.headers.get("Content-Type")
-        return content, content_type
-
 
 class SomacosLoader(BaseLoader):
-    max_retries: int = 3
-    error_sleep_seconds: int = 5
-
-    def get_with_retry_on_500(self, url: str) -> Response:
-        """Custom retry logic with logging and backoff"""
-        current_try = 1
-        while True:
-            try:
-                return requests_get(url)
-            except HTTPError as e:
-                if e.response.status_code == 500:
-                    if current_try == self.max_retries:
-                        logger.error(
-                            f"Request failed {self.max_retries} times with an Error"
-                            f" 500, aborting: {e}"
-                        )
-                        raise
-                    else:
-                        logger.error(
-                            "Got an 500 for a Somacos request, "
-                            f"retrying after sleeping {self.error_sleep_seconds}s: {e}"
-                        )
-                        time.sleep(self.error_sleep_seconds)
-                        current_try += 1
-                        continue
-                else:
-                    raise
+    vendor_name = "Somacos"
+    error_sleep_seconds = 5
+
+    def unencoded_url(self, url: str, query: Optional[Dict[str, str]]) -> str:
+        """Somacos doesn't like encoded urls"""
+        if not query:
+            return url
+        return url + "?" + "&".join([key + "=" + value for key, value in query.items()])
+
+    def load_list_page(self, url: str, query: Optional[Dict[str, str]] = None) -> JSON:
+        return super().load_list_page(self.unencoded_url(url, query))
 
     def load(self, url: str, query: Optional[Dict[str, str]] = None) -> JSON:
-        if query:
-            # Somacos doesn't like encoded urls
-            url = (
-                url
-                + "?"
-                + "&".join([key + "=" + value for key, value in query.items()])
-            )
+        url = self.unencoded_url(url, query)
         logger.debug(f"Loader is loading {url}")
-        response = self.get_with_retry_on_500(url)
+        response = self.transport.get(url)
 
         data = response.json()
         if "id" in data and data["id"] != url:
@@ -291,31 +391,45 @@ class SomacosLoader(BaseLoader):
         return data
 
 
-def get_loader_from_system(entrypoint: str) -> BaseLoader:
-    response = requests_get(entrypoint)
+def get_loader_from_system(
+    entrypoint: str, cache: Optional[ResponseCache] = None
+) -> BaseLoader:
+    """Picks the loader by the vendor of the system.
+
+    A response cache passed here is used instead of the one from the settings."""
+    response = Transport(cache=cache).get(entrypoint)
     system = response.json()
+    loader = get_loader_class(system)(system)
+    if cache:
+        loader.transport.cache = cache
+    return loader
+
+
+def get_loader_class(system: JSON) -> Type[BaseLoader]:
     if system.get("contactName") == "STERNBERG Software GmbH & Co. KG":
         logger.info("Using Sternberg patches")
-        return SternbergLoader(system)
+        return SternbergLoader
     elif (
         system.get("vendor") == "http://cc-egov.de/"
         or system.get("vendor") == "https://www.cc-egov.de"
     ):
         logger.info("Using CC e-gov patches")
-        return CCEgovLoader(system)
+        return CCEgovLoader
     elif (
         system.get("vendor") == "http://www.somacos.de"
         or system.get("product")
         == "Sitzungsmanagementsystem Session  Copyright SOMACOS GmbH & Co. KG"
     ):
         logger.info("Using Somacos patches ")
-        return SomacosLoader(system)
+        return SomacosLoader
     else:
         logger.info("Using no vendor specific patches")
-        return BaseLoader(system)
+        return BaseLoader
 
 
-def get_loader_from_body(body_id: str) -> BaseLoader:
+def get_loader_from_body(
+    body_id: str, cache: Optional[ResponseCache] = None
+) -> BaseLoader:
     """
     Assumptions:
      * The body->system link hasn't changed
@@ -327,11 +441,15 @@ def get_loader_from_body(body_id: str) -> BaseLoader:
         system_id = cached_body.data["system"]
     else:
         logger.info(f"Fetching the body {body_id}")
-        response = requests_get(body_id)
+        response = Transport(cache=cache).get(body_id)
         data = response.json()
         CachedObject.objects.create(
-            url=data["id"], oparl_type=data["type"], data=data, to_import=False
+            url=data["id"],
+            oparl_type=data["type"],
+            data=data,
+            content_hash=hash_json(data),
+            to_import=False,
         )
         system_id = data["system"]
 
-    return get_loader_from_system(system_id)
+    return get_loader_from_system(system_id, cache)
@@ -1,5 +1,6 @@
 import logging
 from abc import ABC
+from pathlib import Path
 from typing import Tuple, Dict, Any
 
 from django.conf import settings
@@ -26,6 +27,14 @@ class ImportBaseCommand(BaseCommand, ABC):
             default=False,
             help="Do not download and parse the files",
         )
+        parser.add_argument(
+            "--report",
+            type=Path,
+            help="Write a json report with timers and counters of the run to this file",
+        )
+        parser.add_argument(
+            "--profile", type=Path, help="Dump cProfile stats of the run to this file"
+        )
 
     def get_importer(self, options: Dict[str, Any]) -> Tuple[Importer, Body]:
         if options.get("body"):
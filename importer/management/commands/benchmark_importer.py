@@ -1,10 +1,13 @@
 import logging
+import time
+from pathlib import Path
 
 from django.core.management import BaseCommand
 
+from importer.http_cache import ResponseCache
 from importer.importer import Importer
 from importer.loader import get_loader_from_body
-from importer.models import CachedObject
+from importer.models import CachedObject, ExternalList
 from mainapp.models import File, Paper, Consultation, AgendaItem, Body
 
 logger = logging.getLogger(__name__)
@@ -13,6 +16,9 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     """
     Usage: a) Import Kall b) Run this c) Look at the timestamps
+
+    Run it once with `--record <dir> --fetch` and then with `--replay <dir> --fetch`
+    to benchmark without depending on the oparl server
     """
 
     help = "For development only"
@@ -23,12 +29,31 @@ class Command(BaseCommand):
             "--prefix", default="https://sdnetrim.kdvz-frechen.de/rim4550"
         )
         parser.add_argument("--force-singlethread", action="store_true")
+        parser.add_argument(
+            "--fetch",
+            action="store_true",
+            help="Also fetch the external lists again before importing",
+        )
+        parser.add_argument(
+            "--record", type=Path, help="Store all responses in this directory"
+        )
+        parser.add_argument(
+            "--replay",
+            type=Path,
+            help="Use only the responses stored in this directory",
+        )
 
     def handle(self, *args, **options):
         prefix = options["prefix"]
 
+        cache = None
+        if options["replay"]:
+            cache = ResponseCache(options["replay"], replay=True)
+        elif options["record"]:
+            cache = ResponseCache(options["record"])
+
         body = Body.objects.get(oparl_id__startswith=prefix)
-        loader = get_loader_from_body(body.oparl_id)
+        loader = get_loader_from_body(body.oparl_id, cache)
         importer = Importer(loader, body)
         importer.force_singlethread = options["force_singlethread"]
 
@@ -36,12 +61,27 @@ class Command(BaseCommand):
 
         for class_object in import_plan:
             name = class_object.__name__
-            stats = class_object.objects.filter(oparl_id__startswith=prefix).delete()
+            objects = class_object.objects.filter(oparl_id__startswith=prefix)
+            if class_object == File:
+                File.release_duplicates(objects)
+            stats = objects.delete()
             logger.info(f"{name}: {stats}")
 
             CachedObject.objects.filter(
                 url__startswith=prefix, oparl_type=class_object.__name__
             ).update(to_import=True)
 
+        if options["fetch"]:
+            start = time.perf_counter()
+            body_data = CachedObject.objects.get(url=body.oparl_id)
+            ExternalList.objects.filter(url__startswith=prefix).delete()
+            importer.fetch_lists_initial([body_data.data])
+            logger.info(f"Fetching the lists took {time.perf_counter() - start:.1f}s")
+
         for type_class in import_plan:
+            start = time.perf_counter()
             importer.import_type(type_class)
+            logger.info(
+                f"Importing {type_class.__name__} took"
+                f" {time.perf_counter() - start:.1f}s"
+            )
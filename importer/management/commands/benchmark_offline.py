@@ -0,0 +1,133 @@
+import logging
+import os
+import subprocess
+from pathlib import Path
+from subprocess import CalledProcessError
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from importer.benchmark import SyntheticOparl, OparlServer, run_benchmark
+from importer.instrumentation import run_report
+
+logger = logging.getLogger(__name__)
+
+
+def get_commit() -> str:
+    if os.environ.get("DOCKER_GIT_SHA"):
+        return os.environ["DOCKER_GIT_SHA"]
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .strip()
+            .decode()
+        )
+    except (CalledProcessError, FileNotFoundError):
+        return "unknown"
+
+
+class Command(BaseCommand):
+    """
+    Usage: `./manage.py benchmark_offline --papers 1000 --report before.json`,
+    then the same after a change and compare the timers in the reports.
+
+    The import runs against a fresh test database, so this doesn't touch the
+    actual data.
+    """
+
+    help = "Benchmark the importer against a generated oparl system on localhost"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bodies", type=int, default=1)
+        parser.add_argument("--papers", type=int, default=200, help="Per body")
+        parser.add_argument("--files-per-paper", type=int, default=2)
+        parser.add_argument("--meetings", type=int, default=50, help="Per body")
+        parser.add_argument("--agenda-items-per-meeting", type=int, default=5)
+        parser.add_argument("--persons", type=int, default=50, help="Per body")
+        parser.add_argument("--page-size", type=int, default=50)
+        parser.add_argument(
+            "--vendor", choices=["plain", "sternberg", "cc-egov"], default="plain"
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--update-fraction",
+            type=float,
+            default=0.1,
+            help="The fraction of papers changed before the update",
+        )
+        parser.add_argument(
+            "--skip-files",
+            action="store_true",
+            help="Do not download and analyse the files, which requires pdftotext",
+        )
+        parser.add_argument(
+            "--store-files", action="store_true", help="Also upload the files to minio"
+        )
+        parser.add_argument("--force-singlethread", action="store_true")
+        parser.add_argument("--report", type=Path, help="Write the json report here")
+        parser.add_argument(
+            "--profile", type=Path, help="Dump cProfile stats of the run to this file"
+        )
+
+    def handle(self, *args, **options):
+        if settings.ELASTICSEARCH_ENABLED:
+            raise CommandError(
+                "The benchmark runs offline, please set ELASTICSEARCH_ENABLED=False"
+            )
+
+        parameters = {
+            key: options[key]
+            for key in [
+                "bodies",
+                "papers",
+                "files_per_paper",
+                "meetings",
+                "agenda_items_per_meeting",
+                "persons",
+                "page_size",
+                "vendor",
+                "seed",
+                "update_fraction",
+                "skip_files",
+                "force_singlethread",
+            ]
+        }
+
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with OparlServer() as server:
+                server.oparl = SyntheticOparl(
+                    server.url,
+                    bodies=options["bodies"],
+                    papers=options["papers"],
+                    files_per_paper=options["files_per_paper"],
+                    meetings=options["meetings"],
+                    agenda_items_per_meeting=options["agenda_items_per_meeting"],
+                    persons=options["persons"],
+                    page_size=options["page_size"],
+                    vendor=options["vendor"],
+                    seed=options["seed"],
+                )
+                with run_report(
+                    "benchmark_offline", options["report"], options["profile"]
+                ) as report:
+                    report.set_value("commit", get_commit())
+                    report.set_value("database", connection.vendor)
+                    report.set_value("parameters", parameters)
+                    run_benchmark(
+                        server.oparl,
+                        update_fraction=options["update_fraction"],
+                        load_files=not options["skip_files"],
+                        store_files=options["store_files"],
+                        force_singlethread=options["force_singlethread"],
+                    )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for name, seconds in report.timers.items():
+            if name.startswith("benchmark."):
+                self.stdout.write(f"{name[len('benchmark.'):]}: {seconds:.2f}s")
@@ -5,6 +5,7 @@ from django.core.management import BaseCommand
 from django.utils import translation
 
 from importer.functions import import_update
+from importer.instrumentation import run_report
 from mainapp.functions.notify_users import NotifyUsers
 
 logger = logging.getLogger(__name__)
@@ -18,7 +19,8 @@ class Command(BaseCommand):
     )
 
     def handle(self, *args, **options):
-        import_update()
+        with run_report("import_update"):
+            import_update()
 
         translation.activate(settings.LANGUAGE_CODE)
 
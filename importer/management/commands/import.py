@@ -1,6 +1,9 @@
+from pathlib import Path
+
 from django.core.management.base import BaseCommand
 
 from importer.cli import Cli
+from importer.instrumentation import run_report
 
 
 class Command(BaseCommand):
@@ -28,13 +31,22 @@ class Command(BaseCommand):
             help="Do not download the files",
         )
         parser.add_argument("--ags", help="The Amtliche Gemeindeschlüssel")
+        parser.add_argument(
+            "--report",
+            type=Path,
+            help="Write a json report with timers and counters of the run to this file",
+        )
+        parser.add_argument(
+            "--profile", type=Path, help="Dump cProfile stats of the run to this file"
+        )
 
     def handle(self, *args, **options):
         cli = Cli()
-        cli.from_userinput(
-            options["cityname"],
-            options["mirror"],
-            options["ags"],
-            skip_body_extra=options["skip_body_extra"],
-            skip_files=options["skip_files"],
-        )
+        with run_report("import", options["report"], options["profile"]):
+            cli.from_userinput(
+                options["cityname"],
+                options["mirror"],
+                options["ags"],
+                skip_body_extra=options["skip_body_extra"],
+                skip_files=options["skip_files"],
+            )
@@ -1,5 +1,6 @@
 import logging
 
+from importer.instrumentation import run_report
 from importer.management.commands._import_base_command import ImportBaseCommand
 from mainapp.functions.document_parsing import AddressPipeline, create_geoextract_data
 from meine_stadt_transparent import settings
@@ -20,6 +21,10 @@ class Command(ImportBaseCommand):
         )
 
     def handle(self, *args, **options):
+        with run_report("import_files", options["report"], options["profile"]):
+            self.import_files(options)
+
+    def import_files(self, options):
         importer, body = self.get_importer(options)
         fallback_city = settings.GEOEXTRACT_SEARCH_CITY or body.short_name
         logger.info(f"Using '{fallback_city}' as geotagging city")
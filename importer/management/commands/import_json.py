@@ -1,7 +1,7 @@
 import datetime
-import json
 import logging
 from pathlib import Path
+from typing import Optional
 
 from dateutil import tz
 from django.conf import settings
@@ -9,8 +9,9 @@ from django.core.management import BaseCommand, CommandParser, CommandError
 
 from importer.functions import fix_sort_date
 from importer.import_json import import_data
+from importer.import_plan import ChangePlan, apply_plan
 from importer.importer import Importer
-from importer.json_datatypes import RisData, converter, format_version
+from importer.json_datatypes import StreamedRisData, format_version
 from importer.loader import BaseLoader
 from mainapp import models
 from mainapp.functions.city_to_ags import city_to_ags
@@ -25,7 +26,7 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser: CommandParser):
         # noinspection PyTypeChecker
-        parser.add_argument("input", type=Path, help="Path to the json file")
+        parser.add_argument("input", type=Path, nargs="?", help="Path to the json file")
         parser.add_argument("--ags", help="The Amtliche Gemeindeschlüssel")
         parser.add_argument(
             "--skip-download",
@@ -58,22 +59,66 @@ class Command(BaseCommand):
                 " existing one"
             ),
         )
+        group = parser.add_mutually_exclusive_group()
+        # noinspection PyTypeChecker
+        group.add_argument(
+            "--plan",
+            type=Path,
+            help=(
+                "Only write the changes to this file without writing to the"
+                " database. The body must already exist."
+            ),
+        )
+        # noinspection PyTypeChecker
+        group.add_argument(
+            "--apply",
+            type=Path,
+            help="Apply the changes from a file written with `--plan`",
+        )
 
     def handle(self, *args, **options):
+        if options["apply"]:
+            logger.info(f"Applying the changes from {options['apply']}")
+            header = apply_plan(options["apply"])
+            body = models.Body.objects.get(id=header["body"])
+        else:
+            if not options["input"]:
+                raise CommandError("Please specify the json file to import")
+            body = self.import_input(options)
+            if not body:
+                return
+
+        fix_sort_date(datetime.datetime.now(tz=tz.tzlocal()))
+
+        if not options["skip_download"]:
+            Importer(BaseLoader(dict()), force_singlethread=True).load_files(
+                fallback_city=settings.GEOEXTRACT_SEARCH_CITY or body.short_name
+            )
+
+        if not options["no_notify_users"]:
+            logger.info("Sending notifications")
+            NotifyUsers().notify_all()
+
+    def import_input(self, options) -> Optional[models.Body]:
+        """Imports the json file, or only writes the changes with `--plan`, in which
+        case there's no body to continue with"""
         input_file: Path = options["input"]
 
         logger.info("Loading the data")
-        with input_file.open() as fp:
-            json_data = json.load(fp)
-            if json_data["format_version"] != format_version:
-                raise CommandError(
-                    f"This version of {settings.PRODUCT_NAME} can only import json"
-                    f" format version {format_version}, but the json file you provided"
-                    f" is version {json_data['format_version']}"
-                )
-            ris_data: RisData = converter.structure(json_data, RisData)
+        ris_data = StreamedRisData(input_file)
+        if ris_data.format_version != format_version:
+            raise CommandError(
+                f"This version of {settings.PRODUCT_NAME} can only import json"
+                f" format version {format_version}, but the json file you provided"
+                f" is version {ris_data.format_version}"
+            )
 
         body = models.Body.objects.filter(name=ris_data.meta.name).first()
+        if not body and options["plan"]:
+            raise CommandError(
+                f"There is no body {ris_data.meta.name} yet, please import the json"
+                " once without `--plan`"
+            )
         if not body:
             logger.info("Building the body")
 
@@ -101,15 +146,14 @@ class Command(BaseCommand):
         # TODO: Re-enable this after some more thorough testing
         # handle_counts(ris_data, options["allow_shrinkage"])
 
-        import_data(body, ris_data)
-
-        fix_sort_date(datetime.datetime.now(tz=tz.tzlocal()))
-
-        if not options["skip_download"]:
-            Importer(BaseLoader(dict()), force_singlethread=True).load_files(
-                fallback_city=settings.GEOEXTRACT_SEARCH_CITY or body.short_name
+        if options["plan"]:
+            with ChangePlan(options["plan"], body.id) as plan:
+                import_data(body, ris_data, plan)
+            logger.info(
+                f"Wrote the changes to {options['plan']}, apply them with"
+                f" `import_json --apply {options['plan']}`"
             )
+            return None
 
-        if not options["no_notify_users"]:
-            logger.info("Sending notifications")
-            NotifyUsers().notify_all()
+        import_data(body, ris_data)
+        return body
@@ -1,6 +1,7 @@
 import logging
 
 from importer.functions import import_update
+from importer.instrumentation import run_report
 from importer.management.commands._import_base_command import ImportBaseCommand
 
 logger = logging.getLogger(__name__)
@@ -13,8 +14,9 @@ class Command(ImportBaseCommand):
     """
 
     def handle(self, *args, **options):
-        import_update(
-            options["body"],
-            ignore_modified=options["ignore_modified"],
-            download_files=not options["skip_download"],
-        )
+        with run_report("import_update", options["report"], options["profile"]):
+            import_update(
+                options["body"],
+                ignore_modified=options["ignore_modified"],
+                download_files=not options["skip_download"],
+            )
@@ -0,0 +1,46 @@
+# Generated by Django 4.1.13 on 2026-10-18 03:37
+
+import hashlib
+import json
+
+from django.db import migrations, models
+
+
+def hash_existing(apps, schema_editor):
+    """Same as importer.functions.hash_json"""
+    CachedObject = apps.get_model("importer", "CachedObject")
+    batch = []
+    for cached_object in CachedObject.objects.only("id", "data").iterator():
+        canonical = json.dumps(
+            cached_object.data,
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+        cached_object.content_hash = hashlib.sha256(canonical.encode()).hexdigest()
+        batch.append(cached_object)
+        if len(batch) >= 1000:
+            CachedObject.objects.bulk_update(batch, ["content_hash"])
+            batch = []
+    CachedObject.objects.bulk_update(batch, ["content_hash"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("importer", "0002_auto_20190108_2242"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="cachedobject",
+            name="content_hash",
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="cachedobject",
+            index=models.Index(
+                fields=["url", "content_hash"], name="importer_ca_url_68b7d4_idx"
+            ),
+        ),
+        migrations.RunPython(hash_existing, migrations.RunPython.noop),
+    ]
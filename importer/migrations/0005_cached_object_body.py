@@ -0,0 +1,17 @@
+# Generated by Django 4.1.13 on 2026-10-18 04:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("importer", "0004_import_run"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="cachedobject",
+            name="body",
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
@@ -15,6 +15,15 @@ class CachedObject(models.Model):
     data = JSONField()
     oparl_type = models.CharField(max_length=100)
     to_import = models.BooleanField(default=True)
+    # sha256 of the canonical json of `data`, so changes can be detected without loading `data`
+    content_hash = models.CharField(max_length=64, null=True)
+    # The body whose lists contained the object, so that the updates of multiple
+    # bodies only import their own objects. None for the list of bodies
+    body = models.CharField(max_length=255, null=True, blank=True)
+
+    class Meta:
+        # Allows answering the change detection queries from the index alone
+        indexes = [models.Index(fields=["url", "content_hash"])]
 
     def __hash__(self):
         return hash(self.url)
@@ -24,3 +33,33 @@ class CachedObject(models.Model):
 
     def __str__(self):
         return f"{self.oparl_type}: {self.url} ({self.to_import})"
+
+
+class ImportRun(models.Model):
+    """An import or update of the objects of a body, with its progress
+    checkpointed after every chunk, so that an interrupted run can be resumed"""
+
+    body_oparl_id = models.CharField(max_length=255, null=True, blank=True)
+    update = models.BooleanField(default=False)
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return (
+            f"{self.body_oparl_id} started {self.started} (finished: {self.finished})"
+        )
+
+
+class ImportProgress(models.Model):
+    run = models.ForeignKey(
+        ImportRun, on_delete=models.CASCADE, related_name="progress"
+    )
+    oparl_type = models.CharField(max_length=100)
+    total = models.IntegerField(default=0)
+    done = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [("run", "oparl_type")]
+
+    def __str__(self):
+        return f"{self.oparl_type}: {self.done}/{self.total}"
@@ -0,0 +1,54 @@
+import pytest
+
+from importer.benchmark import SyntheticOparl, OparlServer, run_benchmark, make_pdf
+from importer.instrumentation import run_report
+from mainapp.models import Paper, File, Meeting, AgendaItem, Person, Consultation
+
+
+def test_synthetic_pagination():
+    oparl = SyntheticOparl("http://localhost", papers=5, page_size=2)
+    url = oparl.url("body/0/paper")
+    page = oparl.get_page(url, {"page": "3"})
+    assert [i["name"] for i in page["data"]] == ["Vorlage 4"]
+    assert page["links"] == {}
+    assert oparl.get_page(url, {})["links"]["next"] == url + "?page=2"
+
+    [changed] = oparl.modify(0.2)
+    page = oparl.get_page(url, {"modified_since": "2021-01-01T00:00:00+00:00"})
+    assert [i["id"] for i in page["data"]] == [changed]
+    assert make_pdf("Anlage").startswith(b"%PDF-1.4")
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize("vendor", ["plain", "sternberg", "cc-egov"])
+def test_run_benchmark(vendor: str, tmp_path, settings):
+    settings.IMPORTER_STREAM_LISTS = vendor == "cc-egov"
+    with OparlServer() as server:
+        server.oparl = SyntheticOparl(
+            server.url,
+            papers=10,
+            meetings=3,
+            agenda_items_per_meeting=2,
+            persons=5,
+            page_size=4,
+            vendor=vendor,
+        )
+        with run_report(
+            "benchmark_offline", tmp_path.joinpath("report.json")
+        ) as report:
+            run_benchmark(server.oparl, update_fraction=0.5, load_files=False)
+
+    assert Paper.objects.count() == 10
+    assert Paper.objects.filter(name__endswith="(geändert)").count() == 5
+    assert Meeting.objects.count() == 3
+    assert AgendaItem.objects.count() == 6
+    assert Consultation.objects.count() == 10
+    assert Person.objects.count() == 5
+    # Each paper has a main file and an auxiliary file, each meeting an invitation
+    assert File.objects.count() == 23
+    assert report.values["changed_papers"] == 5
+    assert set(report.timers) >= {
+        "benchmark.fetch_lists_initial",
+        "benchmark.import_objects",
+        "benchmark.update",
+    }
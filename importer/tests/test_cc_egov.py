@@ -75,10 +75,12 @@ meeting_with_auxiliary_file_object = {
 
 
 def test_spurious_500(caplog):
-    spurious_500(CCEgovLoader({}))
+    loader = CCEgovLoader({})
+    loader.transport.backoff_seconds = 0
+    spurious_500(loader)
     assert caplog.messages == [
-        "Got an 500 for a CC e-gov request, retrying: 500 Server Error: Internal Server"
-        " Error for url:"
+        "Got an 500 for a CC e-gov request, retrying after sleeping 0s: 500 Server"
+        " Error: Internal Server Error for url:"
         " https://ratsinfo.leipzig.de/bi/oparl/1.0/papers.asp?body=2387&p=2"
     ]
 
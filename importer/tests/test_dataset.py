@@ -3,7 +3,7 @@ import logging
 import os
 
 from dateutil.relativedelta import relativedelta
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils import timezone
 
 from importer.importer import Importer
@@ -194,3 +194,8 @@ class TestDataset(TestCase):
             self.assertEqual(
                 table.objects.count(), count - 1, f"{table} {table.objects.all()}"
             )
+
+
+@override_settings(IMPORTER_BULK_IMPORT=True)
+class TestDatasetBulk(TestDataset):
+    """The same with bulk queries, which sqlite supports just like postgres"""
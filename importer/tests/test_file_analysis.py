@@ -1,3 +1,4 @@
+import hashlib
 import os
 from typing import Optional, Dict, Any
 from unittest import mock
@@ -6,10 +7,11 @@ import pytest
 from django.test import TestCase, override_settings
 
 from importer.importer import Importer
-from importer.loader import BaseLoader
+from importer.loader import BaseLoader, FileStream
 from importer.tests.utils import MockLoader
 from mainapp.functions.document_parsing import AddressPipeline
-from mainapp.models import Body, File
+from mainapp.functions.minio import minio_file_bucket
+from mainapp.models import Body, File, Person
 from mainapp.tests.utils import MinioMock
 
 download_url = "https://oparl.example.org/download/0"
@@ -81,3 +83,224 @@ def test_load_file_oom(caplog):
         assert caplog.messages == [
             "File 1: Import failed du to excessive memory usage (Limit: 1048576)"
         ]
+
+
+@pytest.mark.django_db
+def test_streamed_download(monkeypatch, settings):
+    """Files that can't be parsed are uploaded from a temp file once they are hashed"""
+    minio = MinioMock()
+    monkeypatch.setattr("mainapp.functions.minio._minio_singleton", minio)
+    settings.PROXY_ONLY_TEMPLATE = None
+    file = File.objects.create(
+        name="Plan", filename="plan.png", oparl_access_url=download_url
+    )
+    loader = MockLoader()
+    loader.files[download_url] = (b"\x89PNG" + b"0" * 100, "image/png")
+
+    importer = Importer(loader, force_singlethread=True)
+    assert importer.download_and_analyze_file(file.id, AddressPipeline([]), "München")
+
+    file.refresh_from_db()
+    assert file.filesize == 104
+    assert file.mime_type == "image/png"
+    assert minio.storage[minio_file_bucket][str(file.id)] == b"\x89PNG" + b"0" * 100
+
+
+@pytest.mark.django_db
+def test_proxy_only_download(monkeypatch, settings):
+    """Without storage and parsing, a file is only hashed, without a temp file"""
+    minio = MinioMock()
+    monkeypatch.setattr("mainapp.functions.minio._minio_singleton", minio)
+    monkeypatch.setattr("importer.importer.NamedTemporaryFile", None)
+    settings.PROXY_ONLY_TEMPLATE = "https://proxy.example.org/{}"
+    file = File.objects.create(
+        name="Plan", filename="plan.png", oparl_access_url=download_url
+    )
+    content = b"\x89PNG" + b"0" * 100
+    loader = MockLoader()
+    loader.files[download_url] = (content, "image/png")
+
+    importer = Importer(loader, force_singlethread=True)
+    assert importer.download_and_analyze_file(file.id, AddressPipeline([]), "München")
+
+    file.refresh_from_db()
+    assert file.filesize == 104
+    assert file.sha256 == hashlib.sha256(content).hexdigest()
+    assert not minio.storage[minio_file_bucket]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("content_type", ["image/png", "text/html"])
+def test_download_closed(monkeypatch, settings, content_type):
+    """The connection is released, also when the download is rejected early"""
+    monkeypatch.setattr("mainapp.functions.minio._minio_singleton", MinioMock())
+    settings.PROXY_ONLY_TEMPLATE = None
+    file = File.objects.create(
+        name="Plan", filename="plan.png", oparl_access_url=download_url
+    )
+    closed = []
+    loader = MockLoader()
+    loader.load_file_stream = lambda url: (
+        FileStream([b"\x89PNG"], lambda: closed.append(url)),
+        content_type,
+    )
+
+    importer = Importer(loader, force_singlethread=True)
+    importer.download_and_analyze_file(file.id, AddressPipeline([]), "München")
+
+    assert closed == [download_url]
+
+
+@pytest.mark.django_db
+def test_file_too_large(monkeypatch, settings, caplog):
+    minio = MinioMock()
+    monkeypatch.setattr("mainapp.functions.minio._minio_singleton", minio)
+    settings.IMPORTER_MAX_FILE_SIZE = 100
+    file = File.objects.create(
+        name="Protocol", filename="protocol.pdf", oparl_access_url=download_url
+    )
+    loader = MockLoader()
+    loader.files[download_url] = (b"0" * 101, "application/pdf")
+
+    importer = Importer(loader, force_singlethread=True)
+    assert not importer.download_and_analyze_file(
+        file.id, AddressPipeline([]), "München"
+    )
+
+    file.refresh_from_db()
+    assert file.filesize is None
+    assert caplog.messages == [
+        f"File {file.id}: {download_url} is larger than 100\xa0bytes, skipping"
+    ]
+
+
+@pytest.mark.django_db
+def test_duplicate_file(monkeypatch, settings):
+    """An identical file is stored once and its analysis is reused"""
+    minio = MinioMock()
+    monkeypatch.setattr("mainapp.functions.minio._minio_singleton", minio)
+    monkeypatch.setattr("importer.importer.extract_from_file", None)
+    monkeypatch.setattr("importer.importer.extract_locations", None)
+    settings.PROXY_ONLY_TEMPLATE = None
+    content = b"%PDF-1.4 invitation"
+    person = Person.objects.create(name="Max Mustermann")
+    original = File.objects.create(
+        name="Invitation",
+        filename="invitation.pdf",
+        oparl_access_url=download_url,
+        filesize=len(content),
+        sha256=hashlib.sha256(content).hexdigest(),
+        parsed_text="Invitation",
+        page_count=1,
+    )
+    original.mentioned_persons.set([person])
+    minio.storage[minio_file_bucket][str(original.id)] = content
+    file = File.objects.create(
+        name="Invitation", filename="invitation.pdf", oparl_access_url=download_url
+    )
+    loader = MockLoader()
+    loader.files[download_url] = (content, "application/pdf")
+
+    uploaded = []
+    monkeypatch.setattr(
+        minio, "put_object", lambda *args, **kwargs: uploaded.append(args[1])
+    )
+
+    importer = Importer(loader, force_singlethread=True)
+    assert importer.download_and_analyze_file(file.id, AddressPipeline([]), "München")
+
+    file.refresh_from_db()
+    # The duplicate content is never uploaded
+    assert uploaded == []
+    assert file.duplicate_of == original
+    assert file.storage_name() == str(original.id)
+    assert file.filesize == len(content)
+    assert (file.parsed_text, file.page_count) == ("Invitation", 1)
+    assert file.person_ids() == [person.id]
+    assert list(minio.storage[minio_file_bucket]) == [str(original.id)]
+
+
+@pytest.mark.django_db
+def test_duplicate_file_changed(monkeypatch, settings):
+    """When the content of a file changes, it and its duplicates stop sharing the
+    content of the original"""
+    minio = MinioMock()
+    monkeypatch.setattr("mainapp.functions.minio._minio_singleton", minio)
+    settings.PROXY_ONLY_TEMPLATE = None
+    old_content = b"\x89PNG old"
+    new_content = b"\x89PNG new"
+    original = File.objects.create(
+        name="Plan",
+        filename="plan.png",
+        oparl_access_url=download_url,
+        filesize=len(old_content),
+        sha256=hashlib.sha256(old_content).hexdigest(),
+    )
+    minio.storage[minio_file_bucket][str(original.id)] = old_content
+    duplicate = File.objects.create(
+        name="Plan",
+        filename="plan.png",
+        filesize=len(old_content),
+        sha256=hashlib.sha256(old_content).hexdigest(),
+        duplicate_of=original,
+    )
+    loader = MockLoader()
+    loader.files[download_url] = (new_content, "image/png")
+
+    importer = Importer(loader, force_singlethread=True)
+    assert importer.download_and_analyze_file(
+        original.id, AddressPipeline([]), "München"
+    )
+
+    original.refresh_from_db()
+    duplicate.refresh_from_db()
+    assert original.sha256 == hashlib.sha256(new_content).hexdigest()
+    assert minio.storage[minio_file_bucket][str(original.id)] == new_content
+    # The duplicate is downloaded again
+    assert duplicate.duplicate_of is None
+    assert duplicate.filesize is None
+
+    # Once the duplicate has its own content, it stays separate
+    duplicate.oparl_access_url = "https://oparl.example.org/download/1"
+    duplicate.save()
+    loader.files[duplicate.oparl_access_url] = (old_content, "image/png")
+    assert importer.download_and_analyze_file(
+        duplicate.id, AddressPipeline([]), "München"
+    )
+    duplicate.refresh_from_db()
+    assert duplicate.duplicate_of is None
+    assert duplicate.filesize == len(old_content)
+    assert minio.storage[minio_file_bucket][str(duplicate.id)] == old_content
+
+
+@pytest.mark.django_db
+def test_duplicate_file_reset(monkeypatch, settings):
+    """A file that no longer matches its original isn't a duplicate anymore"""
+    minio = MinioMock()
+    monkeypatch.setattr("mainapp.functions.minio._minio_singleton", minio)
+    settings.PROXY_ONLY_TEMPLATE = None
+    old_content = b"\x89PNG old"
+    original = File.objects.create(
+        name="Plan",
+        filename="plan.png",
+        filesize=len(old_content),
+        sha256=hashlib.sha256(old_content).hexdigest(),
+    )
+    file = File.objects.create(
+        name="Plan",
+        filename="plan.png",
+        oparl_access_url=download_url,
+        filesize=len(old_content),
+        sha256=hashlib.sha256(old_content).hexdigest(),
+        duplicate_of=original,
+    )
+    loader = MockLoader()
+    loader.files[download_url] = (b"\x89PNG new", "image/png")
+
+    importer = Importer(loader, force_singlethread=True)
+    assert importer.download_and_analyze_file(file.id, AddressPipeline([]), "München")
+
+    file.refresh_from_db()
+    assert file.duplicate_of is None
+    assert file.storage_name() == str(file.id)
+    assert minio.storage[minio_file_bucket][str(file.id)] == b"\x89PNG new"
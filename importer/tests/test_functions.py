@@ -1,13 +1,26 @@
+import threading
+from copy import deepcopy
+from typing import List, Optional
+
 import pytest
+from django.db.models import ProtectedError
 from django.test import TestCase
 
-from importer import json_to_db
-from importer.functions import externalize
+from importer import JSON, json_to_db, functions
+from importer import loader as loader_module
+from importer.functions import externalize, hash_json
 from importer.importer import Importer
 from importer.json_to_db import JsonToDb
-from importer.tests.utils import MockLoader
+from importer.models import CachedObject
+from importer.tests.utils import (
+    MockLoader,
+    make_system,
+    make_body,
+    make_list,
+    old_date,
+)
 from importer.utils import Utils
-from mainapp.models import Membership, Person, Organization
+from mainapp.models import Membership, Person, Organization, Body, File
 
 test_data_dir = "testdata/oparl2"
 
@@ -185,6 +198,77 @@ def test_fetch_list_update():
     importer.fetch_list_update("https://oparl.wuppertal.de/oparl/bodies/0001/papers")
 
 
+@pytest.mark.django_db
+def test_fetch_list_update_changed_only(django_assert_max_num_queries):
+    """Only new and changed objects are marked for import and removed embedded objects are refetched"""
+    url = "https://oparl.example.org/body/1/paper"
+    files = [
+        {
+            "id": f"https://oparl.example.org/file/{i}",
+            "type": "https://schema.oparl.org/1.1/File",
+        }
+        for i in range(2)
+    ]
+
+    def make_paper(number: int, name: str):
+        return {
+            "id": f"https://oparl.example.org/paper/{number}",
+            "type": "https://schema.oparl.org/1.1/Paper",
+            "name": name,
+        }
+
+    papers = [make_paper(i, f"Paper {i}") for i in range(3)]
+    papers[0]["auxiliaryFile"] = deepcopy(files)
+    loader = MockLoader()
+    loader.api_data[url] = {"data": papers, "links": {}, "pagination": {}}
+    importer = Importer(loader, force_singlethread=True)
+    importer.fetch_list_initial(url)
+    assert CachedObject.objects.filter(to_import=True).count() == 5
+    CachedObject.objects.update(to_import=False)
+
+    changed = make_paper(1, "Changed")
+    page = [
+        changed,
+        make_paper(3, "New"),
+        make_paper(2, "Paper 2"),
+        make_paper(0, "Paper 0"),
+    ]
+    page[3]["auxiliaryFile"] = deepcopy(files[:1])
+    loader.api_data[url] = {"data": page, "links": {}, "pagination": {}}
+    # The number of queries doesn't depend on the number of objects
+    with django_assert_max_num_queries(8):
+        fetch_later = importer.fetch_list_update(url)
+
+    assert fetch_later == [files[1]["id"]]
+    to_import = CachedObject.objects.filter(to_import=True).order_by("url")
+    assert [i.url for i in to_import] == [
+        "https://oparl.example.org/paper/0",
+        "https://oparl.example.org/paper/1",
+        "https://oparl.example.org/paper/3",
+    ]
+    assert CachedObject.objects.get(url=changed["id"]).data["name"] == "Changed"
+
+
+def test_hash_json():
+    assert hash_json({"a": 1, "b": ["ü", {"c": None}]}) == hash_json(
+        {"b": ["ü", {"c": None}], "a": 1}
+    )
+    assert hash_json({"a": 1}) != hash_json({"a": "1"})
+
+
+@pytest.mark.django_db
+def test_cached_object_without_hash():
+    """Rows from before the content hash existed are treated as changed"""
+    url = "https://oparl.example.org/paper/1"
+    data = {"id": url, "type": "https://schema.oparl.org/1.1/Paper"}
+    CachedObject.objects.create(url=url, data=data, oparl_type="Paper", to_import=False)
+    importer = Importer(MockLoader())
+    importer._save_cached_objects(externalize(deepcopy(data)))
+    cached_object = CachedObject.objects.get(url=url)
+    assert cached_object.to_import
+    assert cached_object.content_hash == hash_json(data)
+
+
 def test_externalize_missing_id(caplog):
     """In http://buergerinfo.ulm.de/oparl/bodies/0001/meetings/11445, the embedded location does not have an id"""
     json_in = {
@@ -212,3 +296,144 @@ def test_externalize_missing_id(caplog):
         "http://buergerinfo.ulm.de/oparl/bodies/0001/meetings/11445 does not have an "
         "id, skipping: {'description': 'Ulm-Messe,'}"
     ]
+
+
+@pytest.mark.django_db
+def test_clear_import_duplicates():
+    """Deleting an original lets its duplicates download their own content"""
+    original = File.objects.create(
+        name="Plan", oparl_id="https://a.example.org/file/1", filesize=10
+    )
+    duplicate = File.objects.create(
+        name="Plan",
+        oparl_id="https://b.example.org/file/1",
+        filesize=10,
+        duplicate_of=original,
+    )
+    with pytest.raises(ProtectedError):
+        original.delete()
+
+    functions.clear_import("https://a.example.org/", include_cache=False)
+
+    duplicate.refresh_from_db()
+    assert not File.objects.filter(id=original.id).exists()
+    assert duplicate.duplicate_of is None
+    assert duplicate.filesize is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_update_multiple_bodies(monkeypatch):
+    """A failing body doesn't stop the others and the files are only loaded once"""
+    monkeypatch.setattr(functions.settings, "IMPORTER_BODY_WORKERS", 2)
+    monkeypatch.setattr(
+        loader_module, "get_loader_from_body", lambda body_id: MockLoader()
+    )
+    for i in range(3):
+        Body.objects.create(
+            oparl_id=f"https://oparl.example.org/body/{i}",
+            name=f"Body {i}",
+            short_name=f"Body {i}",
+        )
+    failing = "https://oparl.example.org/body/1"
+
+    def update(self, body_id: str):
+        if body_id == failing:
+            raise RuntimeError("Server error")
+
+    claimed = []
+
+    def load_files(self, fallback_city, update, claimed_files):
+        claimed.append(claimed_files)
+        return 1, 0
+
+    monkeypatch.setattr(Importer, "update", update)
+    monkeypatch.setattr(Importer, "load_files", load_files)
+    with pytest.raises(RuntimeError, match=r"Updating 1 of 3 bodies failed"):
+        functions.import_update()
+    assert len(claimed) == 2
+    assert claimed[0] is claimed[1]
+
+    monkeypatch.setattr(functions.settings, "IMPORTER_BODY_WORKERS", 1)
+    [result] = functions.import_update("https://oparl.example.org/body/0")
+    assert result["body"] == "https://oparl.example.org/body/0"
+    assert result["successful_files"] == 1
+    assert not result["error"]
+
+
+def make_bodies_loader(names: List[str]) -> MockLoader:
+    """Two bodies of one system with one organization each, which doesn't
+    reference its body, so it belongs to the body of the importer"""
+    system = make_system()
+    loader = MockLoader(system, {system["id"]: system})
+    bodies = []
+    for i, name in enumerate(names):
+        body = make_body()
+        body["id"] = f"https://oparl.example.org/body/{i}"
+        body["name"] = f"Body {i}"
+        for list_type in ["paper", "person", "organization", "meeting"]:
+            body[list_type] = f"{body['id']}/{list_type}"
+            loader.api_data[body[list_type]] = make_list([])
+        organization = {
+            "id": f"{body['id']}/organization/0",
+            "type": "https://schema.oparl.org/1.1/Organization",
+            "name": name,
+            "created": old_date,
+            "modified": old_date,
+        }
+        loader.api_data[body["organization"]] = make_list([organization])
+        loader.api_data[body["id"]] = body
+        bodies.append(body)
+    loader.api_data[system["body"]] = make_list(bodies)
+    return loader
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_update_concurrent_bodies(monkeypatch):
+    """The bodies are updated at the same time, and the objects of each body are
+    imported with the importer of that body"""
+    monkeypatch.setattr(functions.settings, "IMPORTER_BODY_WORKERS", 2)
+    loader = make_bodies_loader(["Council 0", "Council 1"])
+    Importer(loader, force_singlethread=True).run("https://oparl.example.org/body/0")
+    # The list of bodies was already fetched
+    importer = Importer(loader, force_singlethread=True)
+    body_data = loader.api_data["https://oparl.example.org/body/1"]
+    CachedObject.objects.filter(url=body_data["id"]).update(to_import=True)
+    [body] = importer.import_bodies()
+    importer.converter.default_body = body
+    importer.fetch_lists_initial([body_data])
+    importer.import_objects()
+
+    updated = make_bodies_loader(["Changed Council 0", "Changed Council 1"])
+    # Both bodies have to fetch their lists at the same time to get past this
+    both_fetching = threading.Barrier(2, timeout=10)
+    body_0_updated = threading.Event()
+    load = updated.load
+    update = Importer.update
+
+    def load_waiting(url: str, query: Optional[dict] = None) -> JSON:
+        if url.endswith("/paper"):
+            both_fetching.wait()
+            # The sqlite test database can't be written concurrently, so body 1
+            # stays in its request while body 0 is updated completely
+            if url.startswith("https://oparl.example.org/body/1/"):
+                assert body_0_updated.wait(timeout=10)
+        return load(url, query)
+
+    def update_body(self: Importer, body_id: str):
+        try:
+            update(self, body_id)
+        finally:
+            if body_id == "https://oparl.example.org/body/0":
+                body_0_updated.set()
+
+    monkeypatch.setattr(updated, "load", load_waiting)
+    monkeypatch.setattr(Importer, "update", update_body)
+    monkeypatch.setattr(loader_module, "get_loader_from_body", lambda body_id: updated)
+    functions.import_update(download_files=False)
+
+    for i in range(2):
+        organization = Organization.objects.get(
+            oparl_id=f"https://oparl.example.org/body/{i}/organization/0"
+        )
+        assert organization.name == f"Changed Council {i}"
+        assert organization.body.oparl_id == f"https://oparl.example.org/body/{i}"
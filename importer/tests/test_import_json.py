@@ -10,17 +10,22 @@ import pytest
 import responses
 from django.contrib.auth.models import User
 from django.core import serializers
+from django.db import connection
 from django.test import modify_settings, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django_elasticsearch_dsl.registries import registry
 from minio.error import MinioException
 
 from importer.import_json import (
+    convert_meeting,
     import_data,
+    import_meeting_organization,
     make_id_map,
     convert_agenda_item,
     incremental_import,
 )
+from importer.import_plan import ChangePlan, apply_plan, get_ids_by_key
 from importer.importer import Importer
 from importer.json_datatypes import (
     RisData,
@@ -32,6 +37,8 @@ from importer.json_datatypes import (
     AgendaItem,
     Person,
     File,
+    Membership,
+    StreamedRisData,
 )
 from importer.loader import BaseLoader
 from mainapp import models
@@ -155,6 +162,51 @@ def test_import_json(send_mail_function):
     # TODO: Check that the deleted file was correctly deleted
 
 
+@pytest.mark.django_db
+def test_streamed_ris_data():
+    path = Path("importer/test-data/amtzell_new.json")
+    ris_data = load_ris_data(str(path))
+    streamed = StreamedRisData(path)
+    assert streamed.format_version == ris_data.format_version
+    assert streamed.meta == ris_data.meta
+    assert streamed.main_organization == ris_data.main_organization
+    assert streamed.get_counts() == ris_data.get_counts()
+    for key in StreamedRisData.sections:
+        assert list(getattr(streamed, key)) == getattr(ris_data, key)
+
+    body = Body(name=streamed.meta.name, short_name=streamed.meta.name)
+    body.save()
+    import_data(body, StreamedRisData(Path("importer/test-data/amtzell_old.json")))
+    import_data(body, streamed)
+    actual = make_db_snapshot()
+    expected = json.loads(Path("importer/test-data/amtzell_new_db.json").read_text())
+    assert expected == actual
+
+
+@pytest.mark.django_db
+def test_plan_and_apply(tmp_path):
+    """Planning doesn't write and applying the plan gives the same result as an import"""
+    old = load_ris_data("importer/test-data/amtzell_old.json")
+    new = load_ris_data("importer/test-data/amtzell_new.json")
+    body = Body(name=old.meta.name, short_name=old.meta.name, ags=old.meta.ags)
+    body.save()
+
+    for ris_data, expected_path in [
+        (old, "importer/test-data/amtzell_old_db.json"),
+        (new, "importer/test-data/amtzell_new_db.json"),
+    ]:
+        plan_path = tmp_path.joinpath("plan.jsonl")
+        with CaptureQueriesContext(connection) as context:
+            with ChangePlan(plan_path, body.id) as plan:
+                import_data(body, ris_data, plan)
+        for query in context.captured_queries:
+            assert query["sql"].startswith("SELECT"), query["sql"]
+
+        assert apply_plan(plan_path)["body"] == body.id
+        expected = json.loads(Path(expected_path).read_text())
+        assert expected == make_db_snapshot()
+
+
 @pytest.mark.django_db
 def test_incremental_agenda_items():
     old = load_ris_data("importer/test-data/amtzell_old.json")
@@ -262,6 +314,184 @@ def test_meeting_start_change():
     assert models.Meeting.objects_with_deleted.count() == 3
 
 
+@pytest.mark.django_db
+def test_plan_lookup_after_rename(tmp_path):
+    """The lookups of a plan see the planned new name and start of a meeting, so a
+    row depending on it in the same plan references the meeting instead of failing"""
+    body = Body.objects.create(name="Body", short_name="Body")
+    organization_type = models.OrganizationType.objects.create(name="Committee")
+    organization = models.Organization.objects.create(
+        name="City Council", body=body, organization_type=organization_type
+    )
+    old_start = datetime.fromisoformat("2020-02-01T09:00:00+01:00")
+    new_start = datetime.fromisoformat("2020-02-01T09:00:05+01:00")
+    meeting = models.Meeting.objects.create(
+        oparl_id="2", name="City Council Meeting", start=old_start, public=0
+    )
+    ris_meeting = Meeting(
+        "City Council", "Renamed Meeting", None, None, None, start=new_start
+    )
+    ris_data = RisData(sample_city, None, [], [], [], [], [ris_meeting], [], [], 2)
+
+    with ChangePlan(tmp_path.joinpath("plan.jsonl"), body.id) as plan:
+        renamed = {"name": "Renamed Meeting", "start": new_start}
+        incremental_import(
+            models.Meeting,
+            [{**convert_meeting(ris_meeting, {}), "oparl_id": "2"}],
+            plan=plan,
+            renames={meeting.id: renamed},
+        )
+        by_name_start = {
+            (name, start): pk
+            for name, start, pk in plan.values_list(
+                models.Meeting.objects, "name", "start"
+            )
+        }
+        assert by_name_start == {("Renamed Meeting", new_start): meeting.id}
+        import_meeting_organization(
+            {}, {"City Council": organization.id}, ris_data, plan
+        )
+
+    apply_plan(tmp_path.joinpath("plan.jsonl"))
+    meeting.refresh_from_db()
+    assert (meeting.name, meeting.start) == ("Renamed Meeting", new_start)
+    assert list(meeting.organizations.all()) == [organization]
+
+
+@pytest.mark.django_db
+def test_unchanged_rows_are_not_updated(caplog):
+    """The digests of the rows must match although the database returns utc datetimes"""
+    organizations = [Organization("City Council", 1, True)]
+    meetings = [
+        Meeting(
+            "City Council",
+            "City Council Meeting 1",
+            None,
+            None,
+            1,
+            start=datetime.fromisoformat("2020-01-01T09:00:00+01:00"),
+        )
+    ]
+    data = RisData(sample_city, None, [], organizations, [], [], meetings, [], [], 2)
+    body = Body(name=data.meta.name, short_name=data.meta.name, ags=data.meta.ags)
+    body.save()
+
+    import_data(body, data)
+    caplog.clear()
+    caplog.set_level(logging.INFO)
+    import_data(body, data)
+    assert "Meeting: Deleting 0, Creating 0 and Updating 0" in caplog.messages
+    assert "Organization: Deleting 0, Creating 0 and Updating 0" in caplog.messages
+
+
+@pytest.mark.django_db
+def test_batched_update(settings):
+    settings.IMPORTER_JSON_UPDATE_BATCH_SIZE = 2
+    old = [
+        {"name": f"Person {i}", "given_name": "", "family_name": ""} for i in range(5)
+    ]
+    new = [dict(person, given_name="Changed") for person in old]
+    incremental_import(models.Person, old)
+    with CaptureQueriesContext(connection) as context:
+        incremental_import(models.Person, new)
+    updates = [
+        query
+        for query in context.captured_queries
+        if query["sql"].startswith('UPDATE "mainapp_person"')
+    ]
+    assert len(updates) == 3
+    assert set(models.Person.objects.values_list("given_name", flat=True)) == {
+        "Changed"
+    }
+    assert models.Person.history.filter(given_name="Changed").count() == 5
+
+
+@pytest.mark.parametrize("returning", [True, False])
+@pytest.mark.django_db
+def test_exact_reindexing(settings, monkeypatch, returning: bool):
+    settings.ELASTICSEARCH_ENABLED = True
+    monkeypatch.setattr(
+        type(connection.features), "can_return_rows_from_bulk_insert", returning
+    )
+    calls = []
+
+    def search_bulk_index(model, qs, action="index"):
+        calls.append((action, sorted(qs.values_list("name", flat=True))))
+
+    monkeypatch.setattr("importer.import_plan.search_bulk_index", search_bulk_index)
+    old = [{"name": name, "given_name": "", "family_name": ""} for name in "ABC"]
+    incremental_import(models.Person, old)
+    assert calls == [("index", ["A", "B", "C"])]
+    # Unchanged rows don't get indexed again
+    models.Person.objects.create(name="X", given_name="", family_name="")
+    calls.clear()
+
+    new = [
+        {"name": "A", "given_name": "", "family_name": ""},
+        {"name": "B", "given_name": "Changed", "family_name": ""},
+        {"name": "D", "given_name": "", "family_name": ""},
+        {"name": "X", "given_name": "", "family_name": ""},
+    ]
+    incremental_import(models.Person, new)
+    assert calls == [("index", ["B", "D"]), ("delete", ["C"])]
+
+
+def make_city(size: int) -> RisData:
+    """Every paper has its own paper type, every meeting its own location and every
+    membership a person that's not in the persons list"""
+    organizations = [Organization("City Council", 1, True)]
+    papers = [
+        Paper(
+            f"P{i}", f"Paper {i}", f"{i}/2020", f"Type {i}", sample_paper.sort_date, i
+        )
+        for i in range(size)
+    ]
+    meetings = [
+        Meeting(
+            "City Council",
+            f"Meeting {i}",
+            f"Room {i}",
+            None,
+            None,
+            start=datetime.fromisoformat(f"2020-01-{i + 1:02}T09:00:00+01:00"),
+        )
+        for i in range(size)
+    ]
+    memberships = [
+        Membership(1, None, f"Jane Doe{i}", "Member", None, None, None)
+        for i in range(size)
+    ]
+    return RisData(
+        sample_city, None, [], organizations, papers, [], meetings, memberships, [], 2
+    )
+
+
+@pytest.mark.django_db
+def test_queries_per_phase():
+    """The number of queries doesn't depend on the number of records"""
+    query_counts = []
+    for size in [2, 10]:
+        body = Body.objects.create(name=f"City {size}", short_name=f"City {size}")
+        with CaptureQueriesContext(connection) as context:
+            import_data(body, make_city(size))
+        query_counts.append(len(context.captured_queries))
+        assert models.Location.objects.count() == size
+        assert models.PaperType.objects.count() == size
+        assert models.Person.objects.count() == size
+        assert models.Meeting.organizations.through.objects.count() == size
+        for model in [
+            models.Paper,
+            models.Meeting,
+            models.Location,
+            models.Person,
+            models.Organization,
+        ]:
+            model.objects_with_deleted.all().delete()
+        models.PaperType.objects.all().delete()
+        models.OrganizationType.objects.all().delete()
+    assert query_counts[0] == query_counts[1]
+
+
 @pytest.mark.django_db
 def test_undelete():
     """A paper gets created, (spuriously?) deleted, and then undeleted"""
@@ -502,3 +732,20 @@ def test_file_404(pytestconfig, caplog):
         f"File 1: Failed to download {url}",
         "1 files failed to download",
     ]
+
+
+@pytest.mark.django_db
+def test_get_ids_by_key():
+    """The fallback for databases without returning doesn't scan the whole table"""
+    paper_types = [
+        models.PaperType.objects.create(paper_type=name) for name in ["A", "B", "C"]
+    ]
+    with CaptureQueriesContext(connection) as queries:
+        assert get_ids_by_key(models.PaperType, ["paper_type"], set()) == []
+    assert len(queries) == 0
+
+    with CaptureQueriesContext(connection) as queries:
+        ids = get_ids_by_key(models.PaperType, ["paper_type"], {("A",), ("C",)})
+    assert sorted(ids) == [paper_types[0].id, paper_types[2].id]
+    [query] = queries
+    assert "WHERE" in query["sql"]
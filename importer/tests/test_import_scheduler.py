@@ -0,0 +1,163 @@
+import threading
+import time
+from typing import List, Type, Tuple
+
+import pytest
+
+from importer.importer import Importer
+from importer.models import CachedObject, ImportRun
+from importer.tests.test_update import build_mock_loader
+from importer.tests.utils import MockLoader, make_body, make_paper
+from mainapp.models import DefaultFields, File, Paper
+
+
+@pytest.mark.django_db
+def test_import_objects_respects_dependencies(settings, monkeypatch):
+    settings.IMPORTER_IMPORT_WORKERS = 4
+    importer = Importer(MockLoader())
+    events: List[Tuple[str, Type[DefaultFields]]] = []
+    lock = threading.Lock()
+
+    def get_import_chunks(type_class: Type[DefaultFields], update: bool):
+        return [[1], [2], [3]]
+
+    def import_chunk(type_class: Type[DefaultFields], ids: List[int], update: bool):
+        with lock:
+            events.append(("start", type_class))
+        time.sleep(0.01)
+        with lock:
+            events.append(("end", type_class))
+
+    monkeypatch.setattr(importer, "_get_import_chunks", get_import_chunks)
+    monkeypatch.setattr(importer, "_import_chunk_in_thread", import_chunk)
+    importer.import_objects()
+
+    assert len(events) == 2 * 3 * len(importer.import_plan)
+    for type_class, dependencies in importer.import_dependencies.items():
+        first_start = events.index(("start", type_class))
+        for dependency in dependencies:
+            last_end = len(events) - 1 - events[::-1].index(("end", dependency))
+            assert last_end < first_start, (type_class, dependency)
+
+
+@pytest.mark.django_db
+def test_import_objects_serial_types(settings, monkeypatch):
+    """The chunks of self-referencing types are imported one after another"""
+    settings.IMPORTER_IMPORT_WORKERS = 4
+    importer = Importer(MockLoader())
+    running: List[Type[DefaultFields]] = []
+    overlapping: List[Type[DefaultFields]] = []
+    imported: List[Tuple[Type[DefaultFields], List[int]]] = []
+    lock = threading.Lock()
+
+    def import_chunk(type_class: Type[DefaultFields], ids: List[int], update: bool):
+        with lock:
+            if type_class in running:
+                overlapping.append(type_class)
+            running.append(type_class)
+            imported.append((type_class, ids))
+        time.sleep(0.01)
+        with lock:
+            running.remove(type_class)
+
+    monkeypatch.setattr(importer, "_get_import_chunks", lambda *args: [[1], [2], [3]])
+    monkeypatch.setattr(importer, "_import_chunk_in_thread", import_chunk)
+    importer.import_objects()
+
+    assert [ids for type_class, ids in imported if type_class == Paper] == [
+        [1],
+        [2],
+        [3],
+    ]
+    assert Paper not in overlapping
+    # The other types still import their chunks concurrently
+    assert File in overlapping
+
+
+@pytest.mark.django_db
+def test_import_objects_error(monkeypatch):
+    importer = Importer(MockLoader())
+
+    def import_chunk(type_class: Type[DefaultFields], ids: List[int], update: bool):
+        raise RuntimeError(type_class.__name__)
+
+    monkeypatch.setattr(importer, "_get_import_chunks", lambda *args: [[1]])
+    monkeypatch.setattr(importer, "_import_chunk_in_thread", import_chunk)
+    with pytest.raises(RuntimeError):
+        importer.import_objects()
+
+
+@pytest.mark.django_db
+def test_import_type_in_chunks():
+    loader = build_mock_loader()
+    importer = Importer(loader, force_singlethread=True)
+    importer.import_chunk_size = 1
+    [body_data] = importer.load_bodies(make_body()["id"])
+    importer.fetch_lists_initial([body_data.data])
+    [body] = importer.import_bodies()
+    importer.converter.default_body = body
+
+    assert importer.import_type(File) == []
+    assert File.objects.count() == 2
+    assert [i.oparl_id for i in importer.import_type(Paper, keep_instances=True)] == [
+        make_paper([])["id"]
+    ]
+    assert not CachedObject.objects.filter(to_import=True, oparl_type="File").exists()
+    assert importer.memory_peak["File"] > 0
+
+
+@pytest.mark.django_db
+def test_resume_import_run(monkeypatch):
+    """A failing chunk is rolled back, the committed chunks stay imported"""
+    loader = build_mock_loader()
+    importer = Importer(loader, force_singlethread=True)
+    importer.import_chunk_size = 1
+    [body_data] = importer.load_bodies(make_body()["id"])
+    importer.fetch_lists_initial([body_data.data])
+    [body] = importer.import_bodies()
+    importer.converter.default_body = body
+
+    file_function = importer.converter.file
+    calls = []
+
+    def failing_file(data, file: File):
+        calls.append(data["id"])
+        file_function(data, file)
+        if len(calls) == 2:
+            raise RuntimeError("Interrupted")
+
+    monkeypatch.setattr(importer.converter, "file", failing_file)
+    with pytest.raises(RuntimeError):
+        importer.import_objects()
+
+    assert File.objects.count() == 1
+    assert CachedObject.objects.filter(to_import=True, oparl_type="File").count() == 1
+    [import_run] = ImportRun.objects.all()
+    assert not import_run.finished
+    assert import_run.progress.get(oparl_type="File").done == 1
+    assert import_run.progress.get(oparl_type="File").total == 2
+
+    monkeypatch.setattr(importer.converter, "file", file_function)
+    importer.import_objects()
+
+    assert File.objects.count() == 2
+    assert Paper.objects.count() == 1
+    assert ImportRun.objects.get().finished
+    assert import_run.progress.get(oparl_type="File").done == 2
+    assert import_run.progress.get(oparl_type="Paper").done == 1
+
+
+@pytest.mark.django_db
+def test_import_run_other_mode_is_abandoned():
+    """An unfinished initial import isn't resumed by an update and vice versa"""
+    importer = Importer(MockLoader())
+    initial = importer.start_import_run(update=False)
+    assert importer.start_import_run(update=False) == initial
+
+    update = importer.start_import_run(update=True)
+    assert update != initial
+    assert update.update
+    assert not update.finished
+    initial.refresh_from_db()
+    assert initial.finished
+    assert importer.start_import_run(update=True) == update
@@ -0,0 +1,66 @@
+import json
+
+import pytest
+import responses
+
+from importer import instrumentation
+from importer.importer import Importer
+from importer.instrumentation import run_report
+from importer.tests.test_update import build_mock_loader
+from importer.tests.utils import make_body
+from importer.transport import Transport
+
+
+@pytest.mark.django_db
+def test_run_report(tmp_path):
+    report_path = tmp_path.joinpath("report.json")
+    with run_report("import", report_path):
+        Importer(build_mock_loader(), force_singlethread=True).run(make_body()["id"])
+    assert not instrumentation.is_active()
+
+    report = json.loads(report_path.read_text())
+    assert report["command"] == "import"
+    assert report["counters"]["objects_created.Paper"] == 1
+    assert report["counters"]["objects_created.File"] == 2
+    assert report["counters"]["cached_objects_changed"] > 0
+    assert report["counters"]["db_queries"] > 0
+    assert set(report["timers"]) >= {"fetch_lists", "import_objects", "import.File"}
+    assert report["memory_peak"]["Paper"] > 0
+
+
+@pytest.mark.skipif(
+    not instrumentation.reset_memory_peak(), reason="Only linux can reset the peak"
+)
+def test_memory_peak():
+    """The peak is measured per type instead of since the process started"""
+    instrumentation.reset_memory_peak()
+    data = b"x" * (100 * 1024 * 1024)
+    peak = instrumentation.get_memory_peak()
+    assert peak > len(data)
+    del data
+    instrumentation.reset_memory_peak()
+    assert instrumentation.get_memory_peak() < peak - 50 * 1024 * 1024
+
+
+def test_run_report_error(tmp_path):
+    report_path = tmp_path.joinpath("report.json")
+    with pytest.raises(RuntimeError):
+        with run_report("import_update", report_path):
+            raise RuntimeError("Server error")
+    assert (
+        json.loads(report_path.read_text())["error"] == "RuntimeError('Server error')"
+    )
+
+
+def test_transport_counters(tmp_path):
+    url = "https://oparl.example.org/body/1"
+    with responses.RequestsMock() as requests_mock:
+        requests_mock.add(
+            responses.GET, url, body="12345", headers={"Content-Length": "5"}
+        )
+        with run_report("import", tmp_path.joinpath("report.json")) as report:
+            Transport().get(url)
+            Transport().get(url, stream=True).content
+    assert report.counters["http_requests"] == 2
+    assert report.counters["http_bytes"] == 10
+    assert report.timers["http"] > 0
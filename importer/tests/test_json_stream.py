@@ -0,0 +1,117 @@
+import json
+
+import pytest
+import responses
+
+from importer.json_stream import iter_page, iter_members, StreamedPage
+from importer.loader import SternbergLoader, CCEgovLoader
+from importer.tests.utils import make_file
+
+list_url = "https://oparl.example.org/body/1/file"
+
+page = {
+    "data": [make_file(1), make_file(2), {"id": 'ü\\"[{', "nested": [[{}], "}"]}],
+    "pagination": {"totalElements": 3},
+    "links": {"next": list_url + "?page=2"},
+}
+
+
+def chunked(text: str, size: int):
+    encoded = text.encode()
+    return [encoded[i : i + size] for i in range(0, len(encoded), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 100000])
+def test_iter_page(size: int):
+    members = list(iter_page(chunked(json.dumps(page, ensure_ascii=False), size)))
+    assert members == [("data", element) for element in page["data"]] + [
+        ("pagination", page["pagination"]),
+        ("links", page["links"]),
+    ]
+
+
+@pytest.mark.parametrize("size", [1, 7, 100000])
+def test_skip_members(size: int):
+    dump = {"meta": {"name": "x"}, "papers": page["data"], "skipped": 'ü\\"[{'}
+    text = json.dumps(dump, ensure_ascii=False)
+    members = iter_members(
+        chunked(text, size), streamed={"papers"}, wanted={"meta", "skipped"}
+    )
+    assert list(members) == [("meta", dump["meta"])] + [("papers", None)] * 3 + [
+        ("skipped", dump["skipped"])
+    ]
+    members = iter_members(chunked(text, size), streamed={"papers"}, wanted=set())
+    assert list(members) == [("papers", None)] * 3
+
+
+@pytest.mark.parametrize("text", ["[]", " [ ] ", "{}", '{"data": []}'])
+def test_iter_empty_page(text: str):
+    assert list(iter_page(chunked(text, 1))) == []
+
+
+@pytest.mark.parametrize("text", ['{"data": [{"a": 1}', '{"data": [1 2]}', "null"])
+def test_iter_invalid(text: str):
+    with pytest.raises(ValueError):
+        list(iter_page(chunked(text, 3)))
+
+
+def test_control_characters():
+    text = '{"data": [{"name": "a\tb"}]}'
+    with pytest.raises(ValueError):
+        list(iter_page([text.encode()]))
+    assert list(iter_page([text.encode()], strict=False)) == [
+        ("data", {"name": "a\tb"})
+    ]
+
+
+def test_fallback(caplog):
+    """The broken json is loaded again and the remaining elements are taken from there"""
+    text = json.dumps(page)[:-50]
+    streamed = StreamedPage(list_url, chunked(text, 10), lambda x: x, lambda: page)
+    assert list(streamed["data"]) == page["data"]
+    assert streamed["links"] == page["links"]
+    assert "The server returned invalid json" in caplog.text
+
+
+def test_links_before_data():
+    streamed = StreamedPage(
+        list_url, chunked(json.dumps(page), 10), lambda x: x, lambda: {}
+    )
+    assert streamed.get("links") == page["links"]
+    assert list(streamed["data"]) == page["data"]
+
+
+def test_sternberg_list_fixups(settings):
+    settings.IMPORTER_STREAM_LISTS = True
+    url = "https://ris.krefeld.de/webservice/oparl/v1.0/body/1/person"
+    body = {
+        "data": [
+            {"id": url + "/1", "deleted": True},
+            {
+                "id": url + "/2",
+                "type": "https://schema.oparl.org/1.0/Person",
+                "location": {"id": "https://ris.krefeld.de/location/1"},
+            },
+        ],
+        "links": {},
+    }
+    with responses.RequestsMock() as requests_mock:
+        requests_mock.add(responses.GET, url, json=body)
+        loader = SternbergLoader({})
+        streamed = loader.load_list_page(url)
+        assert isinstance(streamed, StreamedPage)
+        data = list(streamed["data"])
+    assert [element["id"] for element in data] == [url + "/2"]
+    assert data[0]["location"] == "https://ris.krefeld.de/location/1"
+
+
+def test_cc_egov_streamed(settings):
+    settings.IMPORTER_STREAM_LISTS = True
+    with responses.RequestsMock() as requests_mock:
+        requests_mock.add(
+            responses.GET,
+            list_url,
+            body='{"data": [{"id": "1", "name": "a\tb", "text": "N/A"}], "links": {}}',
+        )
+        streamed = CCEgovLoader({}).load_list_page(list_url)
+        assert list(streamed["data"]) == [{"id": "1", "name": "a\tb"}]
@@ -5,6 +5,7 @@ from datetime import date
 from unittest import mock
 
 import pytest
+from django.db import transaction
 from django.test import TestCase
 
 from importer.functions import externalize
@@ -55,6 +56,10 @@ class TestImporter(TestCase):
         cls.converter.warn_missing = False
         cls.utils = Utils()
 
+    def setUp(self):
+        # The database is reset after every test
+        self.converter.clear_identity_map()
+
     def test_init_base(self):
         data = {
             "id": "https://oparl.example.org/paper/0",
@@ -333,3 +338,58 @@ def test_json_to_db_empty_object(caplog):
         ),
         f"Object loaded from {url} has no id field, setting id to url",
     ]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_retrieve_from_identity_map(django_assert_num_queries):
+    location = Location.objects.create(
+        oparl_id="https://oparl.example.org/location/0",
+        description="Rathaus",
+        is_official=False,
+    )
+    person = Person.objects.create(
+        oparl_id="https://oparl.example.org/person/0", name="Max Mustermann"
+    )
+    converter = JsonToDb(MockLoader(), ensure_organization_type=False)
+    with django_assert_num_queries(1):
+        assert converter.retrieve(Person, person.oparl_id, "test") == person
+    with django_assert_num_queries(0):
+        assert converter.retrieve(Person, person.oparl_id, "test").pk == person.pk
+        assert converter.retrieve_many(Person, [person.oparl_id], "test") == [person]
+
+    # New objects are added to the map when they are saved
+    with django_assert_num_queries(1):
+        reference = converter.retrieve(Location, location.oparl_id, "test")
+    with django_assert_num_queries(1):
+        assert reference.description == "Rathaus"
+    new_location = Location.objects.create(
+        oparl_id="https://oparl.example.org/location/1", is_official=False
+    )
+    converter.remember(new_location)
+    with django_assert_num_queries(0):
+        assert (
+            converter.retrieve(Location, new_location.oparl_id, "test") == new_location
+        )
+
+
+@pytest.mark.django_db(transaction=True)
+def test_remember_after_commit():
+    """Other import threads only see the objects of committed transactions"""
+    converter = JsonToDb(MockLoader(), ensure_organization_type=False)
+    identity_map = converter.get_identity_map(Person)
+    with transaction.atomic():
+        person = Person.objects.create(
+            oparl_id="https://oparl.example.org/person/0", name="Max Mustermann"
+        )
+        converter.remember(person)
+        assert person.oparl_id not in identity_map
+    assert identity_map[person.oparl_id] == person.pk
+
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            rolled_back = Person.objects.create(
+                oparl_id="https://oparl.example.org/person/1", name="Erika Mustermann"
+            )
+            converter.remember(rolled_back)
+            raise RuntimeError("The chunk failed")
+    assert rolled_back.oparl_id not in identity_map
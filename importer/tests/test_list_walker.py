@@ -0,0 +1,58 @@
+from typing import List
+
+import pytest
+
+from importer import JSON
+from importer.list_walker import ListWalker
+from importer.tests.utils import MockLoader, make_file
+
+list_url = "https://oparl.example.org/files"
+
+
+def make_pages(count: int, predictable: bool) -> List[JSON]:
+    pages = []
+    for page in range(1, count + 1):
+        links = {}
+        if page < count:
+            links["next"] = f"{list_url}?body=1&page={page + 1}"
+        pagination = {"currentPage": page}
+        if predictable:
+            pagination["totalPages"] = count
+        pages.append(
+            {"data": [make_file(page)], "links": links, "pagination": pagination}
+        )
+    return pages
+
+
+def make_loader(pages: List[JSON]) -> MockLoader:
+    loader = MockLoader()
+    loader.api_data[list_url] = pages[0]
+    for number, page in enumerate(pages[1:], start=2):
+        loader.api_data[f"{list_url}?body=1&page={number}"] = page
+    return loader
+
+
+@pytest.mark.parametrize("prefetch", [0, 1, 3])
+@pytest.mark.parametrize("predictable", [True, False])
+def test_walk_in_order(prefetch: int, predictable: bool):
+    pages = make_pages(7, predictable)
+    walker = ListWalker(make_loader(pages), prefetch=prefetch)
+    assert list(walker.walk(list_url)) == pages
+
+
+def test_predict_page_urls():
+    pages = make_pages(3, True)
+    walker = ListWalker(make_loader(pages), prefetch=2)
+    assert walker.predict_page_urls(pages[0]) == [
+        f"{list_url}?body=1&page=2",
+        f"{list_url}?body=1&page=3",
+    ]
+    assert walker.predict_page_urls(make_pages(3, False)[0]) == []
+
+
+def test_list_grew_while_prefetching():
+    """The first page claims 2 pages, but the list has grown to 3 since"""
+    pages = make_pages(3, False)
+    pages[0]["pagination"]["totalPages"] = 2
+    walker = ListWalker(make_loader(pages), prefetch=2)
+    assert list(walker.walk(list_url)) == pages
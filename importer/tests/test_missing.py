@@ -4,13 +4,20 @@ patch those up with dummies.
 """
 
 import json
+import threading
+from typing import Optional
 
 import pytest
+from django import db
 from responses import RequestsMock
 
+from importer import JSON
 from importer.importer import Importer
+from importer.json_to_db import JsonToDb
 from importer.loader import BaseLoader
-from mainapp.models import Organization, Person
+from importer.tests.test_update import build_mock_loader
+from importer.tests.utils import MockLoader, make_body, make_file, make_list, make_paper
+from mainapp.models import Organization, Person, Paper, File, Membership
 
 empty_page = {"data": [], "links": {}, "pagination": {}}
 
@@ -113,6 +120,7 @@ def test_missing_organization(pytestconfig, caplog):
         ]
 
     assert Person.objects.first().name == "Missing Person"
+    # The missing objects are loaded after all meetings were imported
     assert caplog.messages == [
         (
             "The Person http://oparl.wuppertal.de/oparl/bodies/0001/people/292 linked"
@@ -120,11 +128,6 @@ def test_missing_organization(pytestconfig, caplog):
             " supposed to be a part of the external lists, but was not. This is a bug"
             " in the OParl implementation."
         ),
-        (
-            "Failed to load http://oparl.wuppertal.de/oparl/bodies/0001/people/292."
-            " Using a dummy instead. THIS IS BAD: 404 Client Error: Not Found for url:"
-            " http://oparl.wuppertal.de/oparl/bodies/0001/people/292"
-        ),
         (
             "The Organization"
             " http://oparl.wuppertal.de/oparl/bodies/0001/organizations/gr/230 linked"
@@ -132,12 +135,6 @@ def test_missing_organization(pytestconfig, caplog):
             " supposed to be a part of the external lists, but was not. This is a bug"
             " in the OParl implementation."
         ),
-        (
-            "Failed to load "
-            "http://oparl.wuppertal.de/oparl/bodies/0001/organizations/gr/230. Using a "
-            "dummy instead. THIS IS BAD: 404 Client Error: Not Found for url: "
-            "http://oparl.wuppertal.de/oparl/bodies/0001/organizations/gr/230"
-        ),
         (
             "The Organization"
             " http://oparl.wuppertal.de/oparl/bodies/0001/organizations/gr/231 linked"
@@ -145,6 +142,17 @@ def test_missing_organization(pytestconfig, caplog):
             " supposed to be a part of the external lists, but was not. This is a bug"
             " in the OParl implementation."
         ),
+        (
+            "Failed to load http://oparl.wuppertal.de/oparl/bodies/0001/people/292."
+            " Using a dummy instead. THIS IS BAD: 404 Client Error: Not Found for url:"
+            " http://oparl.wuppertal.de/oparl/bodies/0001/people/292"
+        ),
+        (
+            "Failed to load "
+            "http://oparl.wuppertal.de/oparl/bodies/0001/organizations/gr/230. Using a "
+            "dummy instead. THIS IS BAD: 404 Client Error: Not Found for url: "
+            "http://oparl.wuppertal.de/oparl/bodies/0001/organizations/gr/230"
+        ),
         (
             "Failed to load "
             "http://oparl.wuppertal.de/oparl/bodies/0001/organizations/gr/231. Using a "
@@ -152,3 +160,94 @@ def test_missing_organization(pytestconfig, caplog):
             "http://oparl.wuppertal.de/oparl/bodies/0001/organizations/gr/231"
         ),
     ]
+
+
+class CountingLoader(MockLoader):
+    def __init__(self, loader: MockLoader):
+        super().__init__(loader.system, loader.api_data)
+        self.loaded = []
+
+    def load(self, url: str, query: Optional[dict] = None) -> JSON:
+        self.loaded.append(url)
+        return super().load(url, query)
+
+
+@pytest.mark.parametrize("bulk_import", [False, True])
+@pytest.mark.django_db
+def test_deferred_missing_references(settings, monkeypatch, bulk_import):
+    """Objects missing from the lists are loaded once after the type was
+    imported, then the dummies are replaced and the empty references patched"""
+    settings.IMPORTER_BULK_IMPORT = bulk_import
+    loader = CountingLoader(build_mock_loader())
+    person = {
+        "id": "https://oparl.example.org/person/1",
+        "type": "https://schema.oparl.org/1.1/Person",
+        "name": "Max Mustermann",
+    }
+    papers = []
+    for paper_id in range(3):
+        paper = make_paper([make_file(10)["id"]], paper_id)
+        paper["mainFile"] = make_file(11)["id"]
+        paper["originatorPerson"] = [person["id"]]
+        papers.append(paper)
+    loader.api_data[make_body()["paper"]] = make_list(papers)
+    for data in [person, make_file(10), make_file(11)]:
+        loader.api_data[data["id"]] = data
+
+    importer = Importer(loader, force_singlethread=True)
+    importer.converter.warn_missing = False
+    # No object is loaded in the middle of the import
+    monkeypatch.setattr(importer.converter, "import_anything", None)
+    importer.run(make_body()["id"])
+
+    missing = [person["id"], make_file(10)["id"], make_file(11)["id"]]
+    assert sorted(url for url in loader.loaded if url in missing) == sorted(missing)
+    assert Person.objects.get().name == "Max Mustermann"
+    for paper in Paper.objects.all():
+        assert paper.main_file == File.objects.get(oparl_id=make_file(11)["id"])
+        assert list(paper.files.values_list("oparl_id", flat=True)) == [
+            make_file(10)["id"]
+        ]
+        assert list(paper.persons.values_list("name", flat=True)) == ["Max Mustermann"]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_dummies(monkeypatch):
+    """Two import threads that miss the same person share one dummy"""
+    converter = JsonToDb(MockLoader(), ensure_organization_type=False)
+    converter.warn_missing = False
+    oparl_id = "https://oparl.example.org/person/missing"
+    both_missed = threading.Barrier(2)
+    first_done = threading.Event()
+    dummy = Person.dummy
+
+    def waiting_dummy(oparl_id: str) -> Person:
+        # Both threads have checked the database before either saves
+        both_missed.wait()
+        if threading.current_thread().name == "second":
+            first_done.wait()
+        return dummy(oparl_id)
+
+    monkeypatch.setattr(Person, "dummy", waiting_dummy)
+    results = {}
+
+    def retrieve():
+        try:
+            with converter.deferring_missing(Membership):
+                results[threading.current_thread().name] = converter.retrieve(
+                    Person, oparl_id, "https://oparl.example.org/membership/0"
+                )
+        finally:
+            first_done.set()
+            db.connection.close()
+
+    threads = [
+        threading.Thread(target=retrieve, name=name) for name in ["first", "second"]
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results["first"].pk == results["second"].pk
+    assert Person.objects.get().oparl_id == oparl_id
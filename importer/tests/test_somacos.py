@@ -37,7 +37,7 @@ def test_somacos_encoded_urls():
 
 def test_spurious_500(caplog):
     loader = SomacosLoader({})
-    loader.error_sleep_seconds = 0
+    loader.transport.backoff_seconds = 0
     spurious_500(loader)
     assert caplog.messages == [
         "Got an 500 for a Somacos request, retrying after sleeping 0s: 500 Server "
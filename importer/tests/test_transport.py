@@ -0,0 +1,170 @@
+import pytest
+import requests
+import responses
+from requests import HTTPError
+
+from importer.http_cache import ResponseCache, ReplayMiss
+from importer.instrumentation import run_report
+from importer.transport import Transport, AdaptiveLimit, host_limit
+
+url = "https://oparl.example.org/paper"
+
+
+def test_retry_after(monkeypatch, caplog):
+    sleeps = []
+    monkeypatch.setattr("importer.transport.time.sleep", sleeps.append)
+    with responses.RequestsMock() as requests_mock:
+        requests_mock.add(responses.GET, url, status=429, headers={"Retry-After": "7"})
+        requests_mock.add(responses.GET, url, json={"data": []})
+        response = Transport("Test").get(url)
+        assert response.json() == {"data": []}
+    assert sleeps == [7]
+
+
+def test_exponential_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("importer.transport.time.sleep", sleeps.append)
+    with responses.RequestsMock() as requests_mock:
+        requests_mock.add(responses.GET, url, status=503)
+        transport = Transport("Test", max_retries=4, backoff_seconds=2)
+        with pytest.raises(HTTPError):
+            transport.get(url)
+        assert len(requests_mock.calls) == 4
+    assert len(sleeps) == 3
+    for current_try, sleep in enumerate(sleeps, start=1):
+        assert 0 <= sleep <= 2 * 2 ** (current_try - 1)
+
+
+def test_no_retry_on_client_error():
+    with responses.RequestsMock() as requests_mock:
+        requests_mock.add(responses.GET, url, status=404)
+        with pytest.raises(HTTPError):
+            Transport("Test").get(url)
+        assert len(requests_mock.calls) == 1
+
+
+def test_record_and_revalidate(tmp_path):
+    cache = ResponseCache(tmp_path)
+    with responses.RequestsMock() as requests_mock:
+        requests_mock.add(
+            responses.GET, url, json={"name": "Paper"}, headers={"ETag": '"abc"'}
+        )
+        requests_mock.add(responses.GET, url, status=304)
+        transport = Transport("Test", cache=cache)
+        assert transport.get(url).json() == {"name": "Paper"}
+        assert transport.get(url).json() == {"name": "Paper"}
+        assert requests_mock.calls[1].request.headers["If-None-Match"] == '"abc"'
+
+
+def test_replay(tmp_path):
+    with responses.RequestsMock() as requests_mock:
+        requests_mock.add(responses.GET, url, json={"name": "Paper"})
+        requests_mock.add(responses.GET, url + "/missing", status=404)
+        recording = Transport("Test", cache=ResponseCache(tmp_path))
+        recording.get(url, params={"modified_since": "2020-01-01T00:00:00"})
+        with pytest.raises(HTTPError):
+            recording.get(url + "/missing")
+
+    # No requests mock, so any network access would fail
+    replaying = Transport("Test", cache=ResponseCache(tmp_path, replay=True))
+    response = replaying.get(url, params={"modified_since": "2020-01-01T00:00:00"})
+    assert response.json() == {"name": "Paper"}
+    with pytest.raises(HTTPError):
+        replaying.get(url + "/missing")
+    with pytest.raises(ReplayMiss):
+        replaying.get(url)
+
+
+def test_record_streamed(tmp_path, settings):
+    """Streamed responses are recorded while they are read, up to the maximum size"""
+    settings.IMPORTER_MAX_FILE_SIZE = 10
+    cache = ResponseCache(tmp_path)
+    with responses.RequestsMock() as requests_mock:
+        requests_mock.add(responses.GET, url + "/small", body=b"%PDF small")
+        requests_mock.add(responses.GET, url + "/large", body=b"%PDF large file")
+        transport = Transport("Test", cache=cache)
+        response = transport.get(url + "/small", stream=True)
+        assert not response._content_consumed
+        assert cache.get(url + "/small") is None
+        assert b"".join(response.iter_content(chunk_size=4)) == b"%PDF small"
+        response = transport.get(url + "/large", stream=True)
+        assert b"".join(response.iter_content(chunk_size=4)) == b"%PDF large file"
+
+    assert cache.get(url + "/small").content == b"%PDF small"
+    assert cache.get(url + "/large") is None
+    assert not list(tmp_path.glob("*/tmp*"))
+
+
+def test_adaptive_limit(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("importer.transport.time.monotonic", lambda: now[0])
+    limit = AdaptiveLimit("oparl.example.org", 4)
+    assert limit.limit == 1
+    for _ in range(20):
+        limit.acquire()
+        limit.release(0.1, overloaded=False)
+    assert limit.limit == 4
+
+    # Requests that were in flight together only halve the limit once
+    for _ in range(3):
+        limit.acquire()
+    for _ in range(3):
+        limit.release(0.1, overloaded=True)
+    assert limit.limit == 2
+    now[0] += 1
+    limit.acquire()
+    limit.release(0.1, overloaded=True)
+    assert limit.limit == 1
+    assert limit.as_dict()["decreases"] == 2
+    assert limit.as_dict()["highest_limit"] == 4
+
+    # A slow server doesn't get more requests
+    for _ in range(20):
+        limit.acquire()
+        limit.release(1, overloaded=False)
+    assert int(limit.limit) == 1
+
+
+def test_fixed_limit():
+    limit = AdaptiveLimit("oparl.example.org", 4, adaptive=False)
+    limit.acquire()
+    limit.release(0.1, overloaded=True)
+    assert limit.limit == 4
+
+
+def test_host_limit_report(monkeypatch, tmp_path):
+    monkeypatch.setattr("importer.transport.time.sleep", lambda seconds: None)
+    monkeypatch.setattr("importer.transport._host_limits", dict())
+    with responses.RequestsMock() as requests_mock:
+        requests_mock.add(responses.GET, url, json={"data": []})
+        requests_mock.add(responses.GET, url, json={"data": []})
+        requests_mock.add(responses.GET, url, status=503)
+        requests_mock.add(responses.GET, url, json={"data": []})
+        with run_report("import", tmp_path.joinpath("report.json")) as report:
+            transport = Transport("Test")
+            transport.get(url)
+            transport.get(url)
+            transport.get(url)
+    host_limits = report.values["host_limits"]["oparl.example.org"]
+    assert host_limits["highest_limit"] == 2
+    assert host_limits["decreases"] == 1
+
+
+def test_timeout_lowers_limit(monkeypatch, settings):
+    settings.IMPORTER_HTTP_TIMEOUT = 5
+    monkeypatch.setattr("importer.transport.time.sleep", lambda seconds: None)
+    monkeypatch.setattr("importer.transport._host_limits", dict())
+    limit = host_limit(url)
+    limit.limit = 4
+    timeouts = []
+
+    def get(*args, **kwargs):
+        timeouts.append(kwargs["timeout"])
+        raise requests.exceptions.ReadTimeout()
+
+    transport = Transport("Test", max_retries=1)
+    monkeypatch.setattr(transport.session, "get", get)
+    with pytest.raises(requests.exceptions.Timeout):
+        transport.get(url)
+    assert timeouts == [5]
+    assert limit.limit == 2
@@ -1,7 +1,8 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils import timezone
 
 from importer.importer import Importer
+from importer.models import CachedObject
 from importer.tests.utils import (
     MockLoader,
     make_system,
@@ -84,3 +85,28 @@ class TestEmbeddedUpdate(TestCase):
         importer.update(self.body["id"])
         [paper] = Paper.objects.all()
         self.assertEqual(paper.history.count(), 2)
+
+    def test_refetch_removed_embedded(self):
+        loader = build_mock_loader()
+        Importer(loader, force_singlethread=True).run(self.body["id"])
+        update(loader)
+        # The second file is already marked for import with fresh data
+        CachedObject.objects.filter(url=make_file(1)["id"]).update(to_import=True)
+        loader.api_data[make_file(1)["id"]] = make_file(1)
+
+        importer = Importer(loader)
+        urls = [make_file(0)["id"], make_file(1)["id"], make_file(0)["id"]]
+        with self.assertNumQueries(3):
+            importer.refetch_removed_embedded(urls)
+        self.assertEqual(
+            CachedObject.objects.filter(to_import=True).count(),
+            2,
+        )
+        self.assertTrue(
+            CachedObject.objects.get(url=make_file(0)["id"]).data["deleted"]
+        )
+
+
+@override_settings(IMPORTER_BULK_IMPORT=True)
+class TestEmbeddedUpdateBulk(TestEmbeddedUpdate):
+    pass
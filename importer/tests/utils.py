@@ -2,8 +2,8 @@ from typing import Optional, Dict, Any, Tuple, List
 
 import responses
 
-from importer import JSON
-from importer.loader import BaseLoader
+from importer import JSON, transport
+from importer.loader import BaseLoader, FileStream
 
 old_date = "1997-07-31T18:00:00+01:00"
 
@@ -59,6 +59,10 @@ class MockLoader(BaseLoader):
     def load_file(self, url: str) -> Tuple[bytes, str]:
         return self.files[url]
 
+    def load_file_stream(self, url: str) -> Tuple[FileStream, str]:
+        content, content_type = self.files[url]
+        return FileStream([content]), content_type
+
 
 def geocode(search_str: str) -> Optional[Dict[str, Any]]:
     """Makes sure we don't accidentally call the geocoder in the tests"""
@@ -93,6 +97,8 @@ def make_paper(files: List[JSON], paper_id: int = 0) -> JSON:
 
 
 def spurious_500(loader: BaseLoader):
+    # The limits are shared by the whole process, so an earlier test might have raised this one
+    transport._host_limits.clear()
     with responses.RequestsMock() as requests_mock:
         requests_mock.add(
             responses.GET,
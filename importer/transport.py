@@ -0,0 +1,287 @@
+import logging
+import os
+import random
+import threading
+import time
+import warnings
+from contextlib import nullcontext
+from typing import Dict, Optional, Any
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from requests import HTTPError, Response
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import InsecureRequestWarning
+
+from importer import instrumentation
+from importer.functions import get_user_agent
+from importer.http_cache import ResponseCache, ReplayMiss
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveLimit:
+    """Limits the concurrent requests to a host with additive increase and
+    multiplicative decrease (AIMD).
+
+    The limit starts at one and grows by one for every limit's worth of
+    successful responses, up to `max_limit`, as long as the round trip time
+    stays below `slow_factor` times the best one we've seen. Server errors,
+    rate limiting, timeouts and connection errors halve the limit, at most
+    once per round trip, so that a burst of failing requests which were in
+    flight together only counts once.
+
+    Without `adaptive`, this is a fixed limit of `max_limit` requests.
+    """
+
+    slow_factor = 2.0
+    # The weight of a new round trip time in the moving average
+    smoothing = 0.2
+
+    def __init__(self, host: str, max_limit: int, adaptive: bool = True):
+        self.host = host
+        self.max_limit = max_limit
+        self.adaptive = adaptive
+        self.limit = 1.0 if adaptive else float(max_limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.latency: Optional[float] = None
+        self.best_latency: Optional[float] = None
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self.highest_limit = int(self.limit)
+
+    def acquire(self) -> None:
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float, overloaded: bool) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            before = int(self.limit)
+            if self.adaptive:
+                if overloaded:
+                    self._decrease()
+                else:
+                    self._increase(latency)
+            self.condition.notify_all()
+            changed = int(self.limit) != before
+        if changed:
+            report_host_limits()
+
+    def _increase(self, latency: float) -> None:
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+        if self.best_latency is None or self.latency < self.best_latency:
+            self.best_latency = self.latency
+        if self.latency > self.slow_factor * self.best_latency:
+            return
+        self.limit = min(self.limit + 1 / self.limit, float(self.max_limit))
+        self.highest_limit = max(self.highest_limit, int(self.limit))
+
+    def _decrease(self) -> None:
+        now = time.monotonic()
+        if now - self.last_decrease < (self.latency or 0):
+            return
+        self.last_decrease = now
+        before = int(self.limit)
+        self.limit = max(self.limit / 2, 1.0)
+        self.decreases += 1
+        if int(self.limit) < before:
+            logger.warning(
+                f"{self.host} is overloaded, reducing the concurrent requests to"
+                f" {int(self.limit)}"
+            )
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self.condition:
+            return {
+                "limit": int(self.limit),
+                "highest_limit": self.highest_limit,
+                "decreases": self.decreases,
+                "latency": self.latency,
+            }
+
+
+_host_limits: Dict[str, AdaptiveLimit] = dict()
+_host_limits_lock = threading.Lock()
+
+
+def host_limit(url: str) -> AdaptiveLimit:
+    """The request budget of a host, shared by all transports of this process"""
+    host = urlparse(url).netloc
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = AdaptiveLimit(
+                host,
+                settings.IMPORTER_MAX_REQUESTS_PER_HOST,
+                settings.IMPORTER_ADAPTIVE_THROTTLING,
+            )
+        return _host_limits[host]
+
+
+def report_host_limits() -> None:
+    with _host_limits_lock:
+        limits = list(_host_limits.values())
+    instrumentation.set_value(
+        "host_limits", {limit.host: limit.as_dict() for limit in limits}
+    )
+
+
+class Transport:
+    """Makes all requests of a loader through one pooled session.
+
+    Server errors and rate limiting responses are retried with exponential
+    backoff and jitter, connection errors are retried immediately. The number
+    of concurrent requests per host adapts to the health of the server (see
+    `AdaptiveLimit`), up to `IMPORTER_MAX_REQUESTS_PER_HOST`, so the connection
+    pool is sized to match.
+
+    If a response cache is configured (`IMPORTER_HTTP_CACHE`), responses are
+    recorded and revalidated with conditional requests or, in replay mode,
+    served exclusively from the cache.
+    """
+
+    retry_status_codes = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        name: str = "plain OParl",
+        max_retries: int = 3,
+        backoff_seconds: float = 1,
+        max_backoff_seconds: float = 60,
+        cache: Optional[ResponseCache] = None,
+    ):
+        self.name = name
+        self.cache = cache or ResponseCache.from_settings()
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self._session: Optional[requests.Session] = None
+        self._session_pid: Optional[int] = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        # Sessions must not be shared with the worker processes of the file import
+        with self._session_lock:
+            if not self._session or self._session_pid != os.getpid():
+                pool_size = settings.IMPORTER_MAX_REQUESTS_PER_HOST
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers["User-Agent"] = get_user_agent()
+                # Hack to make Landshut work with the RIS' broken SSL setup
+                if settings.SSL_NO_VERIFY:
+                    session.verify = False
+                self._session = session
+                self._session_pid = os.getpid()
+            return self._session
+
+    def get_backoff(self, current_try: int, response: Optional[Response]) -> float:
+        """Full jitter exponential backoff, respecting a Retry-After in seconds"""
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return min(int(response.headers["Retry-After"]), self.max_backoff_seconds)
+        backoff = min(
+            self.backoff_seconds * 2 ** (current_try - 1), self.max_backoff_seconds
+        )
+        return random.uniform(0, backoff)
+
+    def get(
+        self, url: str, params: Optional[Dict[str, str]] = None, **kwargs
+    ) -> Response:
+        current_try = 1
+        while True:
+            try:
+                return self._get_once(url, params, **kwargs)
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                if current_try >= self.max_retries:
+                    raise
+                logger.error(f"Error {e} in request for {url}, retrying")
+            except HTTPError as e:
+                status_code = e.response.status_code
+                if status_code not in self.retry_status_codes:
+                    raise
+                if current_try >= self.max_retries:
+                    logger.error(
+                        f"Request failed {self.max_retries} times with an Error"
+                        f" {status_code}, aborting: {e}"
+                    )
+                    raise
+                backoff = self.get_backoff(current_try, e.response)
+                logger.error(
+                    f"Got an {status_code} for a {self.name} request, "
+                    f"retrying after sleeping {backoff:.3g}s: {e}"
+                )
+                time.sleep(backoff)
+            current_try += 1
+
+    def _get_once(
+        self, url: str, params: Optional[Dict[str, str]] = None, **kwargs
+    ) -> Response:
+        cached = None
+        if self.cache:
+            cached = self.cache.get(url, params)
+            if self.cache.replay:
+                if cached is None:
+                    raise ReplayMiss(f"{url} with {params} was not recorded")
+                cached.raise_for_status()
+                instrumentation.count("http_cache_hits")
+                return cached
+            # Careful: A response is falsy for error status codes
+            if cached is not None:
+                headers = self.cache.conditional_headers(cached)
+                kwargs["headers"] = {**kwargs.get("headers", {}), **headers}
+
+        with warnings.catch_warnings() if settings.SSL_NO_VERIFY else nullcontext():
+            if settings.SSL_NO_VERIFY:
+                warnings.filterwarnings("ignore", category=InsecureRequestWarning)
+            limit = host_limit(url)
+            with instrumentation.timer("http_host_limit_wait"):
+                limit.acquire()
+            start = time.perf_counter()
+            kwargs.setdefault("timeout", settings.IMPORTER_HTTP_TIMEOUT)
+            try:
+                response = self.session.get(url, params=params, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                limit.release(time.perf_counter() - start, overloaded=True)
+                raise
+            except BaseException:
+                limit.release(time.perf_counter() - start, overloaded=False)
+                raise
+            latency = time.perf_counter() - start
+            instrumentation.add_time("http", latency)
+            overloaded = response.status_code in self.retry_status_codes
+            limit.release(latency, overloaded)
+        instrumentation.count("http_requests")
+        if kwargs.get("stream"):
+            content_length = response.headers.get("Content-Length", "")
+            if content_length.isdigit():
+                instrumentation.count("http_bytes", int(content_length))
+        else:
+            instrumentation.count("http_bytes", len(response.content))
+
+        if self.cache:
+            if response.status_code == 304 and cached is not None:
+                logger.debug(f"{url} is unchanged, using the cached response")
+                instrumentation.count("http_cache_hits")
+                response = cached
+            elif kwargs.get("stream") and response.ok:
+                # Reading the content would keep e.g. a whole file in memory
+                self.cache.store_streamed(
+                    url, params, response, settings.IMPORTER_MAX_FILE_SIZE
+                )
+            elif response.status_code < 500:
+                # We also record client errors so the replay behaves the same
+                self.cache.store(url, params, response)
+        response.raise_for_status()
+        return response
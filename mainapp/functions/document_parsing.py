@@ -85,6 +85,16 @@ def limit_memory():
     )
 
 
+def _base_mime_type(mime_type: Optional[str]) -> str:
+    """Strips parameters such as the charset"""
+    return (mime_type or "").split(";")[0].strip()
+
+
+def is_extractable(mime_type: Optional[str]) -> bool:
+    """Whether `extract_from_file` can get text out of files of this type"""
+    return _base_mime_type(mime_type) in ["application/pdf", "text/text"]
+
+
 def extract_from_file(
     file: BytesIO, filename: str, mime_type: str, file_id: int
 ) -> Tuple[Optional[str], Optional[int]]:
@@ -92,7 +102,8 @@ def extract_from_file(
 
     parsed_text = None
     page_count = None
-    if mime_type == "application/pdf" or mime_type.startswith("application/pdf;"):
+    base_mime_type = _base_mime_type(mime_type)
+    if base_mime_type == "application/pdf":
         try:
             command = ["pdftotext", filename, "-"]
             completed = subprocess.run(
@@ -118,7 +129,7 @@ def extract_from_file(
             # Workaround for PyPDF2 bug
             # https://github.com/codeformuenster/kubernetes-deployment/pull/65#issuecomment-894232803
             logger.exception(f"PyPDF2 failed: {e}")
-    elif mime_type == "text/text":
+    elif base_mime_type == "text/text":
         parsed_text = file.read()
     else:
         logger.warning(f"File {file_id} has an unknown mime type: '{mime_type}'")
@@ -28,7 +28,9 @@ class Command(BaseCommand):
 
     def parse_file(self, file: File, fallback_city: str):
         logging.info("- Parsing: " + str(file.id) + " (" + file.name + ")")
-        with minio_client().get_object(minio_file_bucket, str(file.id)) as file_handle:
+        with minio_client().get_object(
+            minio_file_bucket, file.storage_name()
+        ) as file_handle:
             recognized_text = get_ocr_text_from_pdf(file_handle.read())
         if len(recognized_text) > 0:
             file.parsed_text = cleanup_extracted_text(recognized_text)
@@ -1,6 +1,7 @@
 from typing import Set
 
 from django.core.management.base import BaseCommand
+from django.db.models import Q
 
 from mainapp.functions.minio import minio_client, minio_file_bucket
 from mainapp.models import File
@@ -15,7 +16,9 @@ class Command(BaseCommand):
             for file in minio_client().list_objects(minio_file_bucket)
         )
         expected_files: Set[int] = set(
-            File.objects.filter(filesize__gt=0).values_list("id", flat=True)
+            File.objects.filter(filesize__gt=0, duplicate_of=None).values_list(
+                "id", flat=True
+            )
         )
         missing_files = expected_files - existing_files
         if len(missing_files) > 0:
@@ -23,4 +26,6 @@ class Command(BaseCommand):
                 f"{len(missing_files)} files are marked as imported but aren't"
                 " available in minio"
             )
-            File.objects.filter(id__in=missing_files).update(filesize=None)
+            File.objects.filter(
+                Q(id__in=missing_files) | Q(duplicate_of__in=missing_files)
+            ).update(filesize=None)
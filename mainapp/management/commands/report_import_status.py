@@ -67,7 +67,9 @@ class Command(BaseCommand):
         )
         expected_files = set(
             str(i)
-            for i in File.objects.filter(filesize__gt=0).values_list("id", flat=True)
+            for i in File.objects.filter(filesize__gt=0, duplicate_of=None).values_list(
+                "id", flat=True
+            )
         )
         missing_files = len(expected_files - existing_files)
         if missing_files > 0:
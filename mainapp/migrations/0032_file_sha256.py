@@ -0,0 +1,46 @@
+# Generated by Django 4.1.13 on 2026-10-18 04:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mainapp", "0031_alter_historicalagendaitem_options_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="duplicate_of",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="duplicates",
+                to="mainapp.file",
+            ),
+        ),
+        migrations.AddField(
+            model_name="file",
+            name="sha256",
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name="historicalfile",
+            name="duplicate_of",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="+",
+                to="mainapp.file",
+            ),
+        ),
+        migrations.AddField(
+            model_name="historicalfile",
+            name="sha256",
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
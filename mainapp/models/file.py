@@ -32,6 +32,18 @@ class File(DefaultFields):
     # Sometimes we need to delete file even if they were not deleted at the source
     manually_deleted = models.BooleanField(default=False)
 
+    # The sha256 of the content, to find files that are attached multiple times
+    sha256 = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    # Identical files are stored and analysed only once, as this file. The
+    # original can't be deleted while it has duplicates, see `release_duplicates`
+    duplicate_of = models.ForeignKey(
+        "self",
+        null=True,
+        blank=True,
+        on_delete=models.PROTECT,
+        related_name="duplicates",
+    )
+
     # Store these values for we might need them for a proxy
     oparl_access_url = models.CharField(max_length=512, null=True, blank=True)
     oparl_download_url = models.CharField(max_length=512, null=True, blank=True)
@@ -60,12 +72,29 @@ class File(DefaultFields):
     def get_oparl_url(self) -> Optional[str]:
         return self.oparl_download_url or self.oparl_access_url
 
+    def storage_name(self) -> str:
+        """The name of the object in minio, which is shared by identical files"""
+        return str(self.duplicate_of_id or self.id)
+
+    @classmethod
+    def release_duplicates(cls, files: "models.QuerySet[File]") -> None:
+        """Lets the duplicates of files that are about to be deleted download their
+        own content again"""
+        cls.objects_with_deleted.filter(duplicate_of__in=files).update(
+            duplicate_of=None, filesize=None
+        )
+
     def manually_delete(self):
         """Sometimes we need to delete files even if they were not deleted at the source"""
         self.deleted = True
         self.manually_deleted = True
         self.save()
-        minio_client().remove_object(minio_file_bucket, str(self.id))
+        # The duplicates still need the content
+        if (
+            not self.duplicate_of_id
+            and not self.duplicates.filter(deleted=False).exists()
+        ):
+            minio_client().remove_object(minio_file_bucket, str(self.id))
 
     def get_assigned_meetings(self):
         from .meeting import Meeting
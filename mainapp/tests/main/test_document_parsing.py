@@ -1,3 +1,4 @@
+from io import BytesIO
 from typing import Optional, Dict, Any
 from unittest import mock
 
@@ -9,6 +10,7 @@ from mainapp.functions.document_parsing import (
     extract_locations,
     extract_from_file,
     extract_persons,
+    is_extractable,
 )
 from mainapp.models import File, Person
 from mainapp.tests.utils import test_media_root
@@ -103,6 +105,18 @@ def test_pdf_parsing_oom(pytestconfig, caplog):
     assert page_count == 3
 
 
+@pytest.mark.parametrize(
+    "mime_type", ["text/text", "text/text; charset=utf-8", "text/text;charset=utf-8"]
+)
+def test_text_parsing(mime_type, caplog):
+    """Every type that is accepted as extractable is also extracted"""
+    assert is_extractable(mime_type)
+    parsed_text, page_count = extract_from_file(BytesIO(b"text"), "", mime_type, 0)
+    assert caplog.messages == []
+    assert parsed_text == b"text"
+    assert page_count is None
+
+
 @pytest.mark.parametrize("filename", ["sample.tiff", "table.xls", "table.ods"])
 def test_pdf_as_tiff(pytestconfig, caplog, filename):
     """A tiff tagged as pdf, making PyPDF2 fail
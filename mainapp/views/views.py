@@ -268,7 +268,7 @@ def file_serve(request, id):
         public = settings.MINIO_PUBLIC_HOST is not None
         url = minio_client(public).presigned_get_object(
             minio_file_bucket,
-            str(id),
+            file.storage_name(),
             expires=timedelta(hours=2),
             response_headers=headers,
         )
@@ -280,7 +280,7 @@ def file_serve(request, id):
     else:
         logger.warning("Serving media files through django is slow")
 
-        minio_file = minio_client().get_object(minio_file_bucket, str(id))
+        minio_file = minio_client().get_object(minio_file_bucket, file.storage_name())
 
         response = HttpResponse(minio_file.read(), headers=headers)
 
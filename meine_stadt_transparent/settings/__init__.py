@@ -244,6 +244,37 @@ GEOEXTRACT_SEARCH_CITY = env.str("GEOEXTRACT_SEARCH_CITY", None)
 
 SUBPROCESS_MAX_RAM = env.int("SUBPROCESS_MAX_RAM", 1024 * 1024 * 1024)  # 1 GB
 
+# How many pages of an external list the importer loads ahead of the page it is processing
+IMPORTER_LIST_PREFETCH = env.int("IMPORTER_LIST_PREFETCH", 2)
+# Fragile oparl servers shouldn't get more than that many requests at once
+IMPORTER_MAX_REQUESTS_PER_HOST = env.int("IMPORTER_MAX_REQUESTS_PER_HOST", 4)
+# Seconds to wait for connecting and for each read, after which a request counts as failed
+IMPORTER_HTTP_TIMEOUT = env.int("IMPORTER_HTTP_TIMEOUT", 60)
+# Start with one request per host and ramp up while the server is healthy
+IMPORTER_ADAPTIVE_THROTTLING = env.bool("IMPORTER_ADAPTIVE_THROTTLING", True)
+# A directory where the importer stores the responses of the oparl api
+IMPORTER_HTTP_CACHE = env.str("IMPORTER_HTTP_CACHE", None)
+# "record" revalidates stored responses, "replay" serves only stored responses
+IMPORTER_HTTP_CACHE_MODE = env.str("IMPORTER_HTTP_CACHE_MODE", "record").lower()
+if IMPORTER_HTTP_CACHE_MODE not in ["record", "replay"]:
+    raise ValueError("Unknown IMPORTER_HTTP_CACHE_MODE: " + IMPORTER_HTTP_CACHE_MODE)
+# Decode external list pages incrementally instead of loading them as a whole
+IMPORTER_STREAM_LISTS = env.bool("IMPORTER_STREAM_LISTS", False)
+# The number of threads that import objects of independent types concurrently
+IMPORTER_IMPORT_WORKERS = env.int("IMPORTER_IMPORT_WORKERS", 4)
+# How many cached objects the importer reads and imports at once
+IMPORTER_CHUNK_SIZE = env.int("IMPORTER_CHUNK_SIZE", 500)
+# How many bodies import_update updates concurrently, each with its own importer
+IMPORTER_BODY_WORKERS = env.int("IMPORTER_BODY_WORKERS", 1)
+# A directory where import, import_update and import_files write a json report of each run
+IMPORTER_REPORT_DIR = env.str("IMPORTER_REPORT_DIR", None)
+# Save the imported objects with bulk queries (postgres and sqlite only)
+IMPORTER_BULK_IMPORT = env.bool("IMPORTER_BULK_IMPORT", False)
+# How many changed records import_json updates with one query
+IMPORTER_JSON_UPDATE_BATCH_SIZE = env.int("IMPORTER_JSON_UPDATE_BATCH_SIZE", 1000)
+# Downloads of larger files are aborted
+IMPORTER_MAX_FILE_SIZE = env.int("IMPORTER_MAX_FILE_SIZE", 512 * 1024 * 1024)  # 512 MB
+
 CITY_AFFIXES = env.list(
     "CITY_AFFIXES",
     default=[